@@ -8,6 +8,12 @@ Inputs:
   python-stdlib.zip -- pre-compiled CPython-NEAR stdlib .pyc files
   lib/ -- directory with contract source files and arbitrary Python modules to package into the WASM file
 
+Commands:
+  optimize (default) -- build the optimized WASM file, e.g. "cpython-near-wasm-opt -O4 contract.py"
+  bench -- compare the execution cost of contract methods between builds: "cpython-near-wasm-opt bench <wasm files>"
+  compile -- only compile sources to CPython-NEAR .pyc files: "cpython-near-wasm-opt compile <.py files or directories>"
+  A contract file named like a command has to follow an explicit "optimize", e.g. "cpython-near-wasm-opt optimize bench".
+
 Optimizations:
   Optimizer runs the supplied contract with default arguments (or ones specified via @near.optimizer_inputs() decorator) and traces
   which Python modules and WASM functions get loaded/called during the runtime, removing unreferenced ones according to the
@@ -29,8 +35,20 @@ Optimizations:
 
 import argparse
 import json
+import sys
+from pathlib import Path
 
-from .core import LIB_PATH, optimize_wasm_file
+from .core import (
+    LIB_PATH,
+    benchmark_wasm_files,
+    compile_many,
+    create_compiler,
+    encode_test_input,
+    get_abi_test_inputs,
+    get_near_exports_from_file,
+    optimize_wasm_file,
+    watch_wasm_file,
+)
 
 
 def resolve_defaults(args):
@@ -54,12 +72,145 @@ def resolve_defaults(args):
     return args
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description=__doc__.strip(),
-        formatter_class=argparse.RawDescriptionHelpFormatter,
+def bool_arg(v):
+    if isinstance(v, str):
+        return v.lower() in ["1", "true", "yes", "on"]
+    return bool(v)
+
+
+def add_bench_arguments(parser):
+    parser.add_argument("wasm_files", nargs="+", help="WASM files to compare")
+    parser.add_argument(
+        "-c",
+        "--contract-file",
+        default="contract.py",
+        help="Contract file to take the exported methods and @near.optimizer_inputs() from (default: contract.py)",
+    )
+    parser.add_argument(
+        "-e",
+        "--exports",
+        help="Comma-separated list of methods to run (default: contract file exports or ABI functions)",
+    )
+    parser.add_argument(
+        "--abi-file",
+        help="NEAR ABI file name, will be used to generate method test inputs if present",
+    )
+    parser.add_argument(
+        "--inputs-file",
+        help='JSON file with test inputs by method name, e.g. {"method": [{"arg": 1}, "raw input"]}',
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        type=int,
+        default=10,
+        help="Number of runs of each method/input (default: 10)",
+    )
+    parser.add_argument("--json", help="Write the results to the given JSON file")
+    parser.add_argument(
+        "--cache-dir", help="Cache directory for compiled WASM (default: no caching)"
     )
 
+
+def bench_main(parser, args):
+    entry_points = [f.strip() for f in (args.exports or "").split(",") if f.strip()]
+    entry_point_test_inputs = {}
+    if not entry_points and Path(args.contract_file).exists():
+        entry_points, entry_point_test_inputs = get_near_exports_from_file(
+            args.contract_file
+        )
+    if args.abi_file:
+        with open(args.abi_file, "r") as f:
+            abi_test_inputs = get_abi_test_inputs(json.loads(f.read()))
+        entry_points = entry_points or list(abi_test_inputs.keys())
+        entry_point_test_inputs.update(abi_test_inputs)
+    if args.inputs_file:
+        with open(args.inputs_file, "r") as f:
+            file_test_inputs = json.loads(f.read())
+        entry_points = entry_points or list(file_test_inputs.keys())
+        for name, values in file_test_inputs.items():
+            entry_point_test_inputs[name] = [encode_test_input(v) for v in values]
+    if not entry_points:
+        parser.error(
+            "no methods to run (use --contract-file, --exports, --abi-file or --inputs-file)"
+        )
+
+    results = benchmark_wasm_files(
+        args.wasm_files,
+        entry_points,
+        entry_point_test_inputs,
+        repeat=args.repeat,
+        cache_dir=args.cache_dir,
+    )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+def add_compile_arguments(parser):
+    parser.add_argument(
+        "sources", nargs="+", help=".py files or directories to compile recursively"
+    )
+    parser.add_argument(
+        "-i",
+        "--input-file",
+        default=LIB_PATH / "python.wasm",
+        help="CPython-NEAR WASM file to compile with (default: embedded python.wasm)",
+    )
+    parser.add_argument(
+        "--python-stdlib-zip",
+        default=LIB_PATH / "python-stdlib.zip",
+        help="Python standard library zip (default: embedded python-stdlib.zip)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="Directory to write the .pyc files to, keeping paths relative to directory sources (default: next to the sources)",
+    )
+    parser.add_argument(
+        "--no-isolate",
+        action="store_true",
+        help="Don't reset the WASM instance after every source: faster, but the bytecode may differ from that of a "
+        "full build (in marshal references, not in behavior)",
+    )
+    parser.add_argument(
+        "--cache-dir", help="Cache directory for compiled WASM (default: no caching)"
+    )
+
+
+def compile_main(parser, args):
+    source_paths = []  # (source path, .pyc path relative to the output directory)
+    for source in args.sources:
+        source_path = Path(source)
+        if source_path.is_dir():
+            source_paths += [
+                (path, path.relative_to(source_path).with_suffix(".pyc"))
+                for path in sorted(source_path.glob("**/*.py"))
+            ]
+        else:
+            source_paths.append((source_path, Path(source_path.stem + ".pyc")))
+    sources = []
+    for path, _ in source_paths:
+        with open(path, "r") as source_file:
+            sources.append((path.name, source_file.read()))
+
+    with open(args.input_file, "rb") as f:
+        wasm_bytes = f.read()
+    compiler = create_compiler(wasm_bytes, args.python_stdlib_zip, args.cache_dir)
+    bytecodes = compile_many(compiler, sources, isolate=not args.no_isolate)
+
+    for (path, relative_pyc_path), bytecode in zip(source_paths, bytecodes):
+        if args.output_dir:
+            pyc_path = Path(args.output_dir) / relative_pyc_path
+        else:
+            pyc_path = path.with_suffix(".pyc")
+        print(f"writing {pyc_path}..")
+        pyc_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(pyc_path, "wb") as pyc_file:
+            pyc_file.write(bytecode)
+
+
+def add_optimize_arguments(parser):
     parser.add_argument(
         "contract_file",
         nargs="?",
@@ -69,6 +220,16 @@ def main():
     parser.add_argument(
         "--build-dir", default="build", help="Build directory (default: build)"
     )
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache directory for the results of every build stage (parsed input WASM, compiled bytecode, trace "
+        "results, optimized WASM, verification runs), each keyed by a hash of its inputs (default: <build-dir>/cache)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Rerun every build stage instead of reusing cached results (which are still refreshed)",
+    )
     parser.add_argument(
         "-i",
         "--input-file",
@@ -101,11 +262,6 @@ def main():
         help="Optimization level 0-5 (default: 3)",
     )
 
-    def bool_arg(v):
-        if isinstance(v, str):
-            return v.lower() in ["1", "true", "yes", "on"]
-        return bool(v)
-
     parser.add_argument(
         "--module-tracing", type=bool_arg, help="Enable Python module tracing (1/0)"
     )
@@ -142,8 +298,48 @@ def main():
         "--abi-file",
         help="NEAR ABI file name, will be used to generate contract method test cases if present",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of parallel worker processes (default: 1), used for scanning the WAT file (text pipeline), "
+        "tracing test runs and compiling Python sources to bytecode. Test runs are traced in parallel unless a run "
+        "reads a register or storage key written by a run in another process, then they are traced serially",
+    )
+    parser.add_argument(
+        "--profile",
+        type=bool_arg,
+        default=False,
+        help="Write per-function call counts of the test runs to profile.json/profile.csv in the build directory (1/0)",
+    )
+    parser.add_argument(
+        "--fuel-limit",
+        type=int,
+        default=None,
+        help="Abort test runs consuming more than this much wasmtime fuel, keeping their coverage so far",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Abort test runs taking longer than this many seconds, keeping their coverage so far",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Rebuild whenever the contract file or user lib sources change, printing size and fuel changes",
+    )
+    parser.add_argument(
+        "--pipeline",
+        choices=["binary", "text"],
+        default="binary",
+        help="WASM rewriting pipeline: in-process binary edits or wasm-dis/wasm-as text round trips (default: binary)",
+    )
+
 
-    args = resolve_defaults(parser.parse_args())
+def optimize_main(parser, args):
+    args = resolve_defaults(args)
     args.pinned_functions = [
         f.strip() for f in (args.pinned_functions or "").split(",") if f.strip()
     ]
@@ -154,10 +350,11 @@ def main():
         with open(args.abi_file, "r") as f:
             abi = json.loads(f.read())
             
-    optimize_wasm_file(
-        args.build_dir,
-        args.input_file,
-        args.output_file,
+    build = watch_wasm_file if args.watch else optimize_wasm_file
+    build(
+        build_dir=args.build_dir,
+        input_file=args.input_file,
+        output_file=args.output_file,
         module_opt=args.module_tracing,
         function_opt=args.function_tracing,
         compression=args.compression,
@@ -169,8 +366,54 @@ def main():
         contract_exports=args.exports,
         verify_optimized_wasm=args.verify_optimized_wasm,
         abi=abi,
+        pipeline=args.pipeline,
+        cache_dir=args.cache_dir,
+        use_cache=not args.no_cache,
+        jobs=args.jobs,
+        profile=args.profile,
+        fuel_limit=args.fuel_limit,
+        timeout=args.timeout,
     )
 
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    optimize_parser = subparsers.add_parser(
+        "optimize",
+        help="Build the optimized WASM file (the default command)",
+        description="Packages the contract and the Python modules it uses into an optimized CPython-NEAR WASM file",
+    )
+    add_optimize_arguments(optimize_parser)
+    optimize_parser.set_defaults(main=optimize_main)
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Compare the execution cost of contract methods between builds",
+        description="Runs contract methods repeatedly in each of the given WASM files (built with the same contract) "
+        "and compares wall time, fuel, peak memory and return value size",
+    )
+    add_bench_arguments(bench_parser)
+    bench_parser.set_defaults(main=bench_main)
+    compile_parser = subparsers.add_parser(
+        "compile",
+        help="Compile Python sources to CPython-NEAR .pyc files",
+        description="Compiles Python sources to CPython-NEAR .pyc files in a single python.wasm instance",
+    )
+    add_compile_arguments(compile_parser)
+    compile_parser.set_defaults(main=compile_main)
+
+    # without a command, the arguments are those of optimize (as before there were other commands)
+    if not argv or (
+        argv[0] not in subparsers.choices and argv[0] not in ("-h", "--help")
+    ):
+        argv = ["optimize"] + argv
+    args = parser.parse_args(argv)
+    return args.main(subparsers.choices[args.command], args)
+
+
 if __name__ == "__main__":
     main()
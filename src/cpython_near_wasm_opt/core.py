@@ -1,13 +1,29 @@
 import ast
+import concurrent.futures
+import contextlib
+import csv
+import ctypes
+import hashlib
+import importlib.metadata
+import io
+import itertools
 import json
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
 import platform
+import re
 import shutil
+import statistics
 import struct
 import subprocess
-import sys
+import threading
+import time
 import zipfile
-from collections import defaultdict
-from copy import deepcopy
+from array import array
+from collections import Counter, OrderedDict, defaultdict
 from pathlib import Path
 
 import lz4.frame
@@ -20,10 +36,27 @@ from .defaults import (
     SAFELY_REMOVABLE_FUNCTION_NAME_PREFIXES,
     SAFELY_REMOVABLE_FUNCTION_NAME_SUFFIXES,
 )
+from .wasm_module import (
+    EXTERNAL_FUNC,
+    EXTERNAL_GLOBAL,
+    I32,
+    OP_UNREACHABLE,
+    WasmModule,
+    decode_uleb128,
+    encode_uleb128,
+    encode_vector,
+    op_call,
+    op_i32_const,
+    op_i32_store8,
+    op_local_get,
+)
 
 BINARY_PATH = Path(__file__).parent / "bin"
 LIB_PATH = Path(__file__).parent / "lib"
 CONTRACT_MODULE_PREFIX = "__near_contract__"
+CACHE_FORMAT_VERSION = 2
+COVERAGE_SECTION_NAME = "cpython_near_wasm_opt.coverage"
+TRACE_GUARDS_EXPORT = "__trace_guards"
 
 
 _LPAREN = object()
@@ -126,27 +159,592 @@ def parse_sexp(tokens) -> list:
     return root
 
 
-def read_sexp(filename) -> list:
-    with open(filename, "r", encoding="ascii") as f:
-        data = f.read()
-    tokens = tokenize_sexp(data)
+# Whitespace/comment runs are skipped by the non-capturing prefix, the single group captures one token:
+# a paren, a complete quoted string, an atom, or an unterminated string running to the end of the input.
+# The end of the input yields empty tokens (skipped by callers), so that the search never restarts in a comment.
+# Whitespace mirrors str.isspace() on ASCII input to stay token-for-token compatible with tokenize_sexp.
+_SEXP_TOKEN_RE = re.compile(
+    rb"""(?:[\t\n\x0b\x0c\r\x1c-\x1f ]+|;[^\n]*\n?)*"""
+    rb"""([()]|"(?:[^"\\]|\\[\s\S])*"|[^\t\n\x0b\x0c\r\x1c-\x1f ()";]+|"[\s\S]*|\Z)"""
+)
+_SEXP_STRING_RE = re.compile(rb'"(?:[^"\\]|\\[\s\S])*"')
+_SEXP_PAREN_TOKENS = {b"(": _LPAREN, b")": _RPAREN}
+
+
+def tokenize_sexp_bytes(data: bytes) -> list:
+    """Same token stream as tokenize_sexp() for wasm-dis output, but matching whole tokens at a time on bytes.
+
+    Unlike tokenize_sexp(), ';' and '"' always terminate an atom (the per-character tokenizer would glue an atom
+    to the text following a comment), which never occurs in wasm-dis output.
+    """
+    tokens = _SEXP_TOKEN_RE.findall(data)
+    # the empty tokens matched at the end of the input (after trailing whitespace/comments and once more right at
+    # the end) are the only ones
+    while tokens and not tokens[-1]:
+        tokens.pop()
+    if tokens and tokens[-1][:1] == b'"' and not _SEXP_STRING_RE.fullmatch(tokens[-1]):
+        # an odd trailing backslash escapes the (missing) closing quote
+        if _SEXP_STRING_RE.fullmatch(tokens[-1] + b'"') is None:
+            raise ValueError("Unclosed escape sequence at end of string")
+        raise ValueError("Unclosed string")
+    parens = _SEXP_PAREN_TOKENS
+    return [parens.get(t) or t.decode("ascii") for t in tokens]
+
+
+def read_sexp(filename, legacy_tokenizer=False) -> list:
+    if legacy_tokenizer:
+        with open(filename, "r", encoding="ascii") as f:
+            tokens = tokenize_sexp(f.read())
+    else:
+        with open(filename, "rb") as f:
+            tokens = tokenize_sexp_bytes(f.read())
     return parse_sexp(tokens)
 
 
+class SexpTree:
+    """Compact S-expression tree, storing nodes as indices into flat arrays instead of nested Python lists.
+
+    atom_ids[n] is the index of node n's interned atom in `atoms` (or -1 if n is a list); list children are linked
+    through first_child/next_sibling, with -1 marking the absence of a node.
+    """
+
+    def __init__(self):
+        self.atoms = []
+        self.atom_index = {}
+        self.atom_ids = array("i")
+        self.parent = array("i")
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.root = -1
+
+    @classmethod
+    def parse(cls, data: bytes, chunk_size=1 << 20):
+        tree = cls()
+        atom_ids = tree.atom_ids
+        parent = tree.parent
+        first_child = tree.first_child
+        next_sibling = tree.next_sibling
+        token_atom_ids = {}
+        stack = []  # open lists
+        last_children = []  # last child node of each open list (or -1)
+        pos = 0
+        while pos < len(data):
+            # tokens never span lines, so the input can be tokenized in newline-terminated chunks
+            end = data.find(b"\n", pos + chunk_size)
+            end = len(data) if end < 0 else end + 1
+            for token in _SEXP_TOKEN_RE.findall(data, pos, end):
+                if not token:
+                    continue
+                if token == b")":
+                    if not stack:
+                        raise ValueError("Unexpected ')'")
+                    stack.pop()
+                    last_children.pop()
+                    continue
+                node = len(atom_ids)
+                if token == b"(":
+                    atom_ids.append(-1)
+                else:
+                    if not stack:
+                        raise ValueError("Atom outside of list")
+                    atom_id = token_atom_ids.get(token)
+                    if atom_id is None:
+                        if token[:1] == b'"' and not _SEXP_STRING_RE.fullmatch(token):
+                            raise ValueError("Unclosed string")
+                        atom_id = token_atom_ids[token] = tree.intern(
+                            token.decode("ascii")
+                        )
+                    atom_ids.append(atom_id)
+                first_child.append(-1)
+                next_sibling.append(-1)
+                if stack:
+                    parent.append(stack[-1])
+                    if last_children[-1] < 0:
+                        first_child[stack[-1]] = node
+                    else:
+                        next_sibling[last_children[-1]] = node
+                    last_children[-1] = node
+                else:
+                    parent.append(-1)
+                    tree.root = node
+                if token == b"(":
+                    stack.append(node)
+                    last_children.append(-1)
+            pos = end
+        if stack:
+            raise ValueError("Unclosed '('")
+        return tree
+
+    def copy(self):
+        tree = SexpTree()
+        tree.atoms = self.atoms.copy()
+        tree.atom_index = self.atom_index.copy()
+        tree.atom_ids = array("i", self.atom_ids)
+        tree.parent = array("i", self.parent)
+        tree.first_child = array("i", self.first_child)
+        tree.next_sibling = array("i", self.next_sibling)
+        tree.root = self.root
+        return tree
+
+    def intern(self, value: str) -> int:
+        atom_id = self.atom_index.get(value)
+        if atom_id is None:
+            atom_id = self.atom_index[value] = len(self.atoms)
+            self.atoms.append(value)
+        return atom_id
+
+    def is_list(self, node) -> bool:
+        return self.atom_ids[node] < 0
+
+    def atom(self, node):
+        "Returns the atom string of the node, or None for list nodes"
+        atom_id = self.atom_ids[node]
+        return self.atoms[atom_id] if atom_id >= 0 else None
+
+    def head(self, node):
+        "Returns the leading atom of a list node (e.g. 'func' for a (func ...) node), or None"
+        if self.atom_ids[node] >= 0 or self.first_child[node] < 0:
+            return None
+        return self.atom(self.first_child[node])
+
+    def children(self, node=None):
+        child = self.first_child[self.root if node is None else node]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def child(self, node, index):
+        for i, child in enumerate(self.children(node)):
+            if i == index:
+                return child
+        raise IndexError(f"list node {node} has no child {index}")
+
+    def build(self, expr) -> int:
+        "Creates a new (detached) subtree from an atom or a nested Python list of atoms, returns its root node"
+        if not isinstance(expr, list):
+            return self._new_node(self.intern(str(expr)))
+        node = self._new_node(-1)
+        self.set_children(node, [self.build(e) for e in expr])
+        return node
+
+    def _new_node(self, atom_id):
+        self.atom_ids.append(atom_id)
+        self.parent.append(-1)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        return len(self.atom_ids) - 1
+
+    def set_children(self, node, children):
+        "Replaces all children of a list node, the previous children which are not reused stay detached"
+        prev = -1
+        for child in children:
+            self.parent[child] = node
+            if prev < 0:
+                self.first_child[node] = child
+            else:
+                self.next_sibling[prev] = child
+            prev = child
+        if prev < 0:
+            self.first_child[node] = -1
+        else:
+            self.next_sibling[prev] = -1
+
+    def insert_after(self, node, prev, child):
+        "Inserts child into node's children after prev, or as the first child if prev is -1"
+        self.parent[child] = node
+        if prev < 0:
+            self.next_sibling[child] = self.first_child[node]
+            self.first_child[node] = child
+        else:
+            self.next_sibling[child] = self.next_sibling[prev]
+            self.next_sibling[prev] = child
+
+    def append(self, node, expr):
+        "Builds expr and appends it as the last child of node"
+        last = -1
+        for last in self.children(node):
+            pass
+        child = self.build(expr)
+        self.insert_after(node, last, child)
+        return child
+
+
+def read_sexp_tree(filename) -> SexpTree:
+    with open(filename, "rb") as f:
+        return SexpTree.parse(f.read())
+
+
+def iter_sexp_parts(expr):
+    "Yields the text of a WatIndex, SexpTree or nested list S-expression piece by piece, without recursion"
+    if isinstance(expr, WatIndex):
+        yield from expr.iter_parts()
+    elif isinstance(expr, SexpTree):
+        atoms = expr.atoms
+        atom_ids = expr.atom_ids
+        parent = expr.parent
+        first_child = expr.first_child
+        next_sibling = expr.next_sibling
+        node = expr.root
+        while True:
+            if atom_ids[node] >= 0:
+                yield atoms[atom_ids[node]]
+            elif first_child[node] >= 0:
+                yield "("
+                node = first_child[node]
+                continue
+            else:
+                yield "()"
+            while node != expr.root and next_sibling[node] < 0:
+                node = parent[node]
+                yield ")"
+            if node == expr.root:
+                return
+            yield " "
+            node = next_sibling[node]
+    elif not isinstance(expr, list):
+        yield str(expr)
+    else:
+        yield "("
+        stack = [iter(expr)]
+        first = True
+        while stack:
+            for e in stack[-1]:
+                if not first:
+                    yield " "
+                if isinstance(e, list):
+                    yield "("
+                    stack.append(iter(e))
+                    first = True
+                    break
+                yield str(e)
+                first = False
+            else:
+                stack.pop()
+                yield ")"
+                first = False
+
+
 def write_sexp_to_string(expr):
-    def helper(e):
-        if isinstance(e, list):
-            return "(" + " ".join(helper(child) for child in e) + ")"
+    return "".join(iter_sexp_parts(expr))
+
+
+def write_sexp(expr, filename, parts_per_chunk=65536):
+    "Streams expr to a file name or a text file object (e.g. a pipe) in chunks"
+    if not hasattr(filename, "write"):
+        with open(filename, "w", encoding="ascii", buffering=1 << 20) as f:
+            write_sexp(expr, f, parts_per_chunk)
+        return
+    chunk = []
+    for part in iter_sexp_parts(expr):
+        chunk.append(part)
+        if len(chunk) >= parts_per_chunk:
+            filename.write("".join(chunk))
+            chunk.clear()
+    filename.write("".join(chunk))
+
+
+# Structural tokens only: parens, plus strings and comments which have to be skipped over as they may contain parens
+_WAT_STRUCTURE_RE = re.compile(rb'[()]|"(?:[^"\\]|\\[\s\S])*"|;[^\n]*')
+_WAT_STRINGS_AND_COMMENTS_RE = re.compile(rb'"(?:[^"\\]|\\[\s\S])*"|;[^\n]*')
+# wasm-dis puts every top-level form on a new line indented by a single space
+_WAT_FORM_START_RE = re.compile(rb"\n \(")
+_WAT_FORM_HEAD_RE = re.compile(rb'\(\s*([^\s()";]+)(?:\s+([^\s()";]+))?')
+_WAT_CALL_RE = re.compile(rb'\(call\s+\$([^\s()";]+)')
+
+
+def _wat_module_body_start(data) -> int:
+    "Returns the position after the opening paren of the module"
+    m = _SEXP_TOKEN_RE.match(data)
+    if m is None or m.group(1) != b"(":
+        raise ValueError("WAT module expected")
+    return m.end()
+
+
+def _scan_wat_forms(data, pos, stop):
+    """Finds the top-level forms in the data[pos:stop] part of a WAT module body, which must start at a form boundary.
+
+    Returns ([(kind, name, start, stop)], close), close being the position of the closing paren of the module or -1
+    if it is not in the range. Raises ValueError if the range ends inside a form.
+    """
+    spans = []
+    # fast path: split at the wasm-dis top-level form line starts, only counting parens of each chunk
+    form_start = -1
+    balance = 0
+    starts = [m.start() + 2 for m in _WAT_FORM_START_RE.finditer(data, pos, stop)]
+    for start, next_start in zip(starts, starts[1:]):
+        if balance == 0:
+            form_start = start
+        chunk = data[start:next_start]
+        parens = chunk
+        if b'"' in chunk or b";" in chunk:
+            parens = _WAT_STRINGS_AND_COMMENTS_RE.sub(b"", chunk)
+        balance += parens.count(b"(") - parens.count(b")")
+        if balance < 0:
+            break
+        if balance == 0:
+            trailing_space = len(chunk) - len(chunk.rstrip())
+            spans.append((form_start, next_start - trailing_space))
+            pos = next_start
+    # exact scan of the rest, which may contain the closing paren of the module
+    close = -1
+    depth = 1
+    for m in _WAT_STRUCTURE_RE.finditer(data, pos, stop):
+        token = data[m.start()]
+        if token == 0x28:  # (
+            if depth == 1:
+                form_start = m.start()
+            depth += 1
+        elif token == 0x29:  # )
+            depth -= 1
+            if depth == 1:
+                spans.append((form_start, m.end()))
+            elif depth == 0:
+                close = m.start()
+                break
+    if depth > 1:
+        raise ValueError("Unclosed '('")
+    forms = []
+    for start, form_stop in spans:
+        head = _WAT_FORM_HEAD_RE.match(data, start)
+        kind, name = head.group(1), head.group(2)
+        forms.append(
+            (
+                kind.decode("ascii"),
+                name.decode("ascii") if name is not None else None,
+                start,
+                form_stop,
+            )
+        )
+    return forms, close
+
+
+def _scan_wat_file_forms(filename, pos, stop):
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _scan_wat_forms(data, pos, stop)
+
+
+class WatForm:
+    "Top-level WAT module form: a verbatim byte range of the source WAT (plus insertions), or a SexpTree/nested list/text"
+
+    __slots__ = ("kind", "name", "start", "stop", "insertions", "tree")
+
+    def __init__(self, kind, name, start=-1, stop=-1, tree=None):
+        self.kind = kind
+        self.name = name  # second atom of the form (e.g. "$foo" for a (func $foo ...) form), or None
+        self.start = start
+        self.stop = stop
+        self.insertions = []  # (offset, seq, expr) to be written after source offset
+        self.tree = tree
+
+    def copy(self):
+        form = WatForm(self.kind, self.name, self.start, self.stop)
+        form.insertions = self.insertions.copy()
+        form.tree = self.tree.copy() if isinstance(self.tree, SexpTree) else self.tree
+        return form
+
+
+class WatIndex:
+    """Lazy WAT module, indexing the byte ranges of its top-level forms without parsing their contents.
+
+    Forms are only parsed (see tree()) when a pass needs to modify their contents, untouched forms are written out
+    verbatim, so the cost of the passes scales with the number of modified forms instead of the total WAT size.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.forms = []
+        self.header_stop = 0
+        self._insertion_seq = 0
+
+    @classmethod
+    def parse(cls, data: bytes):
+        wat = cls(data)
+        spans, close = _scan_wat_forms(data, _wat_module_body_start(data), len(data))
+        wat._set_forms(spans, close)
+        return wat
+
+    @classmethod
+    def parse_file(cls, filename, jobs=1, chunks_per_job=4):
+        "Parses a WAT file, scanning chunks of it (split at wasm-dis top-level form line starts) in parallel"
+        with open(filename, "rb") as f:
+            data = f.read()
+        pos = _wat_module_body_start(data)
+        chunk_size = (len(data) - pos) // (jobs * chunks_per_job) + 1
+        bounds = [pos]
+        while True:
+            m = _WAT_FORM_START_RE.search(data, bounds[-1] + chunk_size)
+            if m is None:
+                break
+            bounds.append(m.start())
+        bounds.append(len(data))
+        if jobs <= 1 or len(bounds) <= 2:
+            return cls.parse(data)
+        wat = cls(data)
+        spans = []
+        close = -1
+        try:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                for chunk_spans, chunk_close in executor.map(
+                    _scan_wat_file_forms,
+                    [filename] * (len(bounds) - 1),
+                    bounds[:-1],
+                    bounds[1:],
+                ):
+                    if close >= 0:
+                        raise ValueError("Unexpected ')'")
+                    spans += chunk_spans
+                    close = chunk_close
+            wat._set_forms(spans, close)
+        except ValueError:
+            # a chunk split off in the middle of a form, e.g. at a multi-line string
+            return cls.parse(data)
+        return wat
+
+    def _set_forms(self, forms, close):
+        if close < 0:
+            raise ValueError("Unclosed '('")
+        if _SEXP_TOKEN_RE.match(self.data, close + 1).group(1):
+            raise ValueError("Unexpected data after the module")
+        self.header_stop = forms[0][2] if forms else close
+        self.forms = [WatForm(*form) for form in forms]
+
+    def copy(self):
+        wat = WatIndex(self.data)
+        wat.forms = [form.copy() for form in self.forms]
+        wat.header_stop = self.header_stop
+        wat._insertion_seq = self._insertion_seq
+        return wat
+
+    def __getstate__(self):
+        # column-wise, which pickles much faster than the individual WatForm objects
+        forms = self.forms
+        return {
+            "data": self.data,
+            "header_stop": self.header_stop,
+            "insertion_seq": self._insertion_seq,
+            "kinds": [form.kind for form in forms],
+            "names": [form.name for form in forms],
+            "starts": array("q", [form.start for form in forms]),
+            "stops": array("q", [form.stop for form in forms]),
+            "edits": {
+                i: (form.insertions, form.tree)
+                for i, form in enumerate(forms)
+                if form.insertions or form.tree is not None
+            },
+        }
+
+    def __setstate__(self, state):
+        self.data = state["data"]
+        self.header_stop = state["header_stop"]
+        self._insertion_seq = state["insertion_seq"]
+        self.forms = list(
+            map(
+                WatForm, state["kinds"], state["names"], state["starts"], state["stops"]
+            )
+        )
+        for i, (insertions, tree) in state["edits"].items():
+            self.forms[i].insertions = insertions
+            self.forms[i].tree = tree
+
+    def source(self, form: WatForm) -> bytes:
+        return self.data[form.start : form.stop]
+
+    def new_form(self, expr) -> WatForm:
+        "Creates a new (detached) form from a nested Python list of atoms"
+        return WatForm(
+            expr[0],
+            str(expr[1]) if len(expr) > 1 and not isinstance(expr[1], list) else None,
+            tree=expr,
+        )
+
+    def append(self, expr):
+        form = self.new_form(expr)
+        self.forms.append(form)
+        return form
+
+    def tree(self, form: WatForm) -> SexpTree:
+        "Parses the form contents (once), the returned tree's root is the form and can be modified in place"
+        if not isinstance(form.tree, SexpTree):
+            form.tree = SexpTree.parse(
+                "".join(self.iter_form_parts(form)).encode("ascii")
+            )
+            form.insertions = []
+        return form.tree
+
+    def replace(self, form: WatForm, expr):
+        "Replaces the form contents with a nested Python list or raw WAT text"
+        form.tree = expr
+        form.insertions = []
+
+    def function_body_offset(self, form: WatForm) -> int:
+        "Returns the source offset at which the func body starts (after its name or the last leading param/result/local)"
+        tokens = _SEXP_TOKEN_RE.finditer(self.data, form.start, form.stop)
+        next(tokens)  # (
+        next(tokens)  # func
+        body_offset = next(tokens).end()
+        depth = 1
+        for m in tokens:
+            token = m.group(1)
+            if token == b"(":
+                if depth == 1 and next(tokens).group(1) not in (
+                    b"param",
+                    b"result",
+                    b"local",
+                ):
+                    break
+                depth += 1
+            elif token == b")":
+                depth -= 1
+                if depth == 0:
+                    break
+                if depth == 1:
+                    body_offset = m.end()
+            elif depth == 1:
+                break
+        return body_offset
+
+    def insert_after(self, form: WatForm, offset, expr):
+        "Inserts expr at a source offset, before the expressions inserted at the same offset earlier"
+        self._insertion_seq -= 1
+        form.insertions.append((offset, self._insertion_seq, expr))
+
+    def prepend_to_function(self, form: WatForm, expr):
+        "Inserts expr at the start of the func body, before the expressions prepended earlier"
+        if form.tree is None:
+            self.insert_after(form, self.function_body_offset(form), expr)
         else:
-            return str(e)
+            tree = self.tree(form)
+            tree.insert_after(
+                tree.root, get_function_body_prev(tree, tree.root), tree.build(expr)
+            )
 
-    return helper(expr)
+    def iter_form_parts(self, form: WatForm):
+        if form.tree is not None:
+            if isinstance(form.tree, str):
+                yield form.tree
+            else:
+                yield from iter_sexp_parts(form.tree)
+            return
+        pos = form.start
+        for offset, _, expr in sorted(form.insertions):
+            yield self.data[pos:offset].decode("ascii")
+            yield " "
+            yield from iter_sexp_parts(expr)
+            pos = offset
+        yield self.data[pos : form.stop].decode("ascii")
+
+    def iter_parts(self):
+        yield self.data[: self.header_stop].decode("ascii")
+        for i, form in enumerate(self.forms):
+            if i:
+                yield "\n "
+            yield from self.iter_form_parts(form)
+        yield "\n)"
 
 
-def write_sexp(expr, filename):
-    with open(filename, "w", encoding="ascii") as f:
-        sexp_str = write_sexp_to_string(expr)
-        f.write(sexp_str)
+def read_wat_index(filename, jobs=1) -> WatIndex:
+    return WatIndex.parse_file(filename, jobs)
 
 
 def fnv1a_32(data):
@@ -157,27 +755,305 @@ def fnv1a_32(data):
     return hash_val & 0xFFFFFFFF
 
 
+_wasmtime_engines = {}  # by configuration: (consume_fuel, epoch_interruption)
+# compiled modules by (WASM hash, consume_fuel, epoch_interruption), least recently used first
+_wasmtime_modules = OrderedDict()
+# enough for a build's input, instrumented, profiled and optimized modules; older ones are evicted, so watch mode's
+# rebuilds don't keep every module they replaced
+MAX_WASMTIME_MODULES = 4
+EPOCH_TICK_SECONDS = 0.01
+
+
+def _lru_get(cache: OrderedDict, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _lru_put(cache: OrderedDict, key, value, max_size):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def _increment_epochs(engine: wasmtime.Engine):
+    while True:
+        time.sleep(EPOCH_TICK_SECONDS)
+        engine.increment_epoch()
+
+
+def get_wasmtime_engine(
+    consume_fuel=False, epoch_interruption=False
+) -> wasmtime.Engine:
+    """Returns the process-wide wasmtime engine for a configuration, so that compiled modules can be shared between
+    runners. The epochs of epoch_interruption engines are incremented every EPOCH_TICK_SECONDS by a daemon thread.
+    """
+    engine = _wasmtime_engines.get((consume_fuel, epoch_interruption))
+    if engine is None:
+        config = wasmtime.Config()
+        config.consume_fuel = consume_fuel
+        config.epoch_interruption = epoch_interruption
+        engine = wasmtime.Engine(config)
+        _wasmtime_engines[(consume_fuel, epoch_interruption)] = engine
+        if epoch_interruption:
+            threading.Thread(
+                target=_increment_epochs, args=(engine,), daemon=True
+            ).start()
+    return engine
+
+
+def load_wasmtime_module(
+    wasm_bytes: bytes, cache_dir=None, consume_fuel=False, epoch_interruption=False
+) -> wasmtime.Module:
+    """Compiles WASM bytes with the shared engine, reusing modules compiled recently in the process or, if cache_dir
+    is set, serialized native code stored there by earlier builds. Every distinct module leaves a .cwasm file in
+    cache_dir, so it's meant for modules which stay the same between builds, like the input WASM.
+    """
+    engine = get_wasmtime_engine(consume_fuel, epoch_interruption)
+    wasm_hash = hashlib.sha256(wasm_bytes).hexdigest()
+    module = _lru_get(_wasmtime_modules, (wasm_hash, consume_fuel, epoch_interruption))
+    if module is not None:
+        return module
+    if cache_dir is None:
+        module = wasmtime.Module(engine, wasm_bytes)
+    else:
+        cache_path = (
+            Path(cache_dir)
+            / f"module-{wasm_hash}{'-fuel' if consume_fuel else ''}{'-epoch' if epoch_interruption else ''}"
+            f"-wasmtime-{importlib.metadata.version('wasmtime')}.cwasm"
+        )
+        try:
+            module = wasmtime.Module.deserialize_file(engine, str(cache_path))
+        except (wasmtime.WasmtimeError, OSError) as e:
+            if cache_path.exists():
+                print(f"ignoring unusable compiled module {cache_path}: {e}")
+            module = wasmtime.Module(engine, wasm_bytes)
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            with open(temp_path, "wb") as f:
+                f.write(module.serialize())
+            os.replace(temp_path, cache_path)
+    _lru_put(
+        _wasmtime_modules,
+        (wasm_hash, consume_fuel, epoch_interruption),
+        module,
+        MAX_WASMTIME_MODULES,
+    )
+    return module
+
+
+def export_mutable_globals(module: WasmModule) -> list[str]:
+    "Exports the mutable globals of the module (if not exported already), returns their export names"
+    exported_globals = {
+        index: name for name, kind, index in module.exports if kind == EXTERNAL_GLOBAL
+    }
+    # first-hit trace guards (see instrument_wat()) keep their state across runs
+    first_guard_index = next(
+        (
+            index
+            for name, kind, index in module.exports
+            if kind == EXTERNAL_GLOBAL and name == TRACE_GUARDS_EXPORT
+        ),
+        None,
+    )
+    names = []
+    for global_index in module.mutable_globals():
+        if first_guard_index is not None and global_index >= first_guard_index:
+            break
+        if global_index not in exported_globals:
+            exported_globals[global_index] = f"__snapshot_global_{global_index}"
+            module.add_export(
+                exported_globals[global_index], EXTERNAL_GLOBAL, global_index
+            )
+        names.append(exported_globals[global_index])
+    return names
+
+
+def read_coverage_section(module: WasmModule):
+    "Returns (coverage bitmap address, function name hash for every bitmap byte) of a module instrumented for it"
+    payload, pos = module.custom_section(COVERAGE_SECTION_NAME)
+    if payload is None:
+        return None, []
+    bitmap_addr, pos = decode_uleb128(payload, pos)
+    count, pos = decode_uleb128(payload, pos)
+    return bitmap_addr, list(struct.unpack_from(f"<{count}L", payload, pos))
+
+
+class HostStateDict(defaultdict):
+    """defaultdict(bytes) which records the keys written (or deleted) and the keys observed before being written,
+    i.e. the ones whose values came from the state it started with"""
+
+    def __init__(self):
+        super().__init__(bytes)
+        self.written = set()
+        self.read_unwritten = set()
+
+    def __missing__(self, key):
+        # unlike defaultdict, a read of an absent key doesn't store it, so it isn't recorded as written
+        return bytes()
+
+    def _observe(self, key):
+        if key not in self.written:
+            self.read_unwritten.add(key)
+
+    def __getitem__(self, key):
+        self._observe(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._observe(key)
+        return super().__contains__(key)
+
+    def __setitem__(self, key, value):
+        self.written.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.written.add(key)
+        super().__delitem__(key)
+
+
 class WasmRunner:
-    def __init__(self, wasm_bytes: bytes):
-        self.wasm_bytes = wasm_bytes
+    SNAPSHOT_PAGE_SIZE = 65536
+    FUEL_LIMIT = 2**62
+
+    def __init__(
+        self,
+        wasm_bytes: bytes,
+        cache_dir=None,
+        count_calls=False,
+        consume_fuel=False,
+        fuel_limit=None,
+        timeout=None,
+    ):
+        module = WasmModule(wasm_bytes)
+        self.global_names = export_mutable_globals(module)
+        self.wasm_bytes = module.to_bytes() if module.dirty else wasm_bytes
+        self.coverage_bitmap_addr, self.coverage_function_hashes = (
+            read_coverage_section(module)
+        )
         self.input_bytes = b""
+        self.return_value = b""
         self.called_functions = set[int]()
         self.loaded_frozen_modules = set[str]()
         self.loaded_builtin_modules = set[str]()
-        self.engine = wasmtime.Engine()
+        # profiling mode: call counts of the current run by function name hash (needs per-call instrumentation)
+        self.count_calls = count_calls
+        self.call_counts = Counter()
+        # NEAR host state (registers and contract storage), kept across runs
+        self.registers = HostStateDict()
+        self.storage = HostStateDict()
+        # fuel metering mode: [(entry point, input bytes, fuel consumed, None or the "fuel"/"timeout" limit which
+        # aborted the run)] of the runs made with run_entry_point()
+        self.consume_fuel = consume_fuel or fuel_limit is not None
+        self.fuel_usage = []
+        # per-run budgets (fuel, wall-clock seconds), [(entry point, input bytes, "fuel"/"timeout")] of the aborted runs
+        self.fuel_limit = fuel_limit or self.FUEL_LIMIT
+        self.timeout = timeout
+        self.aborted_runs = []
+        self.engine = get_wasmtime_engine(self.consume_fuel, timeout is not None)
         self.store = wasmtime.Store(self.engine)
-        self.module = wasmtime.Module(self.engine, self.wasm_bytes)
+        if self.consume_fuel:
+            self.store.set_fuel(self.fuel_limit)
+        self.module = load_wasmtime_module(
+            self.wasm_bytes, cache_dir, self.consume_fuel, timeout is not None
+        )
         self.memory = None
+        self.snapshot_pages = None
+        self.snapshot_globals = None
         imports = self.create_host_imports()
         self.linker = wasmtime.Linker(self.engine)
         for name, func in imports.items():
             self.linker.define(self.store, "env", name, func)
-        self.reset()
+        self.instantiate()
+        self.snapshot()
 
-    def reset(self):
+    def instantiate(self):
+        if self.timeout is not None:
+            self.store.set_epoch_deadline(2**62)
         self.instance = self.linker.instantiate(self.store, self.module)
         self.memory = self.instance.exports(self.store)["memory"]
 
+    def memory_address(self) -> int:
+        return ctypes.addressof(self.memory.data_ptr(self.store).contents)
+
+    def snapshot(self):
+        "Captures linear memory and mutable globals, to be restored by reset()"
+        address = self.memory_address()
+        self.snapshot_pages = [
+            ctypes.string_at(address + pos, self.SNAPSHOT_PAGE_SIZE)
+            for pos in range(
+                0, self.memory.data_len(self.store), self.SNAPSHOT_PAGE_SIZE
+            )
+        ]
+        exports = self.instance.exports(self.store)
+        self.snapshot_globals = [
+            exports[name].value(self.store) for name in self.global_names
+        ]
+
+    def reset(self):
+        "Restores the snapshot, copying back only the memory pages that were modified since"
+        snapshot_len = len(self.snapshot_pages) * self.SNAPSHOT_PAGE_SIZE
+        restore_all = self.memory.data_len(self.store) != snapshot_len
+        if restore_all:
+            # linear memory can't shrink, start over with a new instance
+            self.instantiate()
+            missing_len = snapshot_len - self.memory.data_len(self.store)
+            if missing_len > 0:
+                self.memory.grow(
+                    self.store, missing_len // self.memory.page_size(self.store)
+                )
+        address = self.memory_address()
+        for i, page in enumerate(self.snapshot_pages):
+            page_address = address + i * self.SNAPSHOT_PAGE_SIZE
+            if restore_all or ctypes.string_at(page_address, len(page)) != page:
+                ctypes.memmove(page_address, page, len(page))
+        exports = self.instance.exports(self.store)
+        for name, value in zip(self.global_names, self.snapshot_globals):
+            exports[name].set_value(self.store, value)
+
+    def save_host_state(self):
+        "Returns a copy of the registers and storage, to be restored by restore_host_state()"
+        return dict(self.registers), dict(self.storage)
+
+    def restore_host_state(self, host_state):
+        for host_state_dict, values in zip((self.registers, self.storage), host_state):
+            host_state_dict.clear()
+            host_state_dict.update(values)
+
+    def memory_grown(self) -> bool:
+        "Whether linear memory has grown since snapshot()"
+        return (
+            self.memory.data_len(self.store)
+            != len(self.snapshot_pages) * self.SNAPSHOT_PAGE_SIZE
+        )
+
+    def collect_coverage(self):
+        "Adds the functions marked in the coverage bitmap (if instrumented for it) to called_functions"
+        if self.coverage_function_hashes:
+            bitmap = self.read(
+                self.coverage_bitmap_addr, len(self.coverage_function_hashes)
+            )
+            self.called_functions.update(
+                itertools.compress(self.coverage_function_hashes, bitmap)
+            )
+
+    def start_run(self):
+        self.call_counts = Counter()
+        self.return_value = b""
+        if self.consume_fuel:
+            self.store.set_fuel(self.fuel_limit)
+        if self.timeout is not None:
+            self.store.set_epoch_deadline(
+                max(1, math.ceil(self.timeout / EPOCH_TICK_SECONDS))
+            )
+
+    def fuel_consumed(self) -> int:
+        "Fuel consumed since start_run()"
+        return self.fuel_limit - self.store.get_fuel()
+
     def set_input_bytes(self, input_bytes: bytes):
         self.input_bytes = input_bytes
 
@@ -189,29 +1065,39 @@ class WasmRunner:
 
         return exported_func_wrapper
 
-    def data_ptr(self):
-        return self.memory.data_ptr(self.store)
+    # bulk linear memory access
+
+    def _check_bounds(self, ptr: int, length: int):
+        if ptr < 0 or length < 0 or ptr + length > self.memory.data_len(self.store):
+            raise IndexError(f"memory access out of bounds: {ptr}+{length}")
+
+    def read(self, ptr: int, length: int) -> bytes:
+        self._check_bounds(ptr, length)
+        return ctypes.string_at(self.memory_address() + ptr, length)
+
+    def write(self, ptr: int, data: bytes):
+        self._check_bounds(ptr, len(data))
+        ctypes.memmove(self.memory_address() + ptr, data, len(data))
+
+    def read_cstr(self, ptr: int, max_length=4096) -> bytes:
+        "Reads a null-terminated string (without the terminator), at most max_length bytes"
+        length = max(0, min(max_length, self.memory.data_len(self.store) - ptr))
+        data = self.read(ptr, length)
+        end = data.find(b"\0")
+        return data if end < 0 else data[:end]
 
     def create_host_imports(self) -> dict:
         # Auxilary functions which are not part of the NEAR API
         def c_str_from_ptr(ptr: int) -> str:
-            chars = []
-            data = self.memory.data_ptr(self.store)
-            for i in range(ptr, ptr + 4096):
-                if data[i] == 0:
-                    break
-                chars.append(data[i])
-            return bytes(chars).decode()
-
-        def bytes_from_ptr(ptr: int, length: int) -> bytes:
-            data = self.memory.data_ptr(self.store)
-            return bytes(data[ptr : ptr + length])
+            return self.read_cstr(ptr).decode()
 
         def str_from_ptr(ptr: int, length: int) -> str:
-            return bytes_from_ptr(ptr, length).decode()
+            return self.read(ptr, length).decode()
 
         def trace_function_call(function_name_hash: int) -> None:
             self.called_functions.add(function_name_hash & 0xFFFFFFFF)
+            if self.count_calls:
+                self.call_counts[function_name_hash & 0xFFFFFFFF] += 1
 
         def trace_frozen_module_load(module_path_ptr: int) -> None:
             module_path = c_str_from_ptr(module_path_ptr)
@@ -222,21 +1108,18 @@ class WasmRunner:
             self.loaded_builtin_modules.add(module_name)
 
         # NEAR API impl
-        registers = defaultdict(bytes)
-        storage = defaultdict(bytes)
+        registers = self.registers
+        storage = self.storage
 
         # Registers
         def read_register(register_id: int, ptr: int) -> None:
-            data_bytes = registers[register_id]
-            data = self.memory.data_ptr(self.store)
-            for i, byte in enumerate(data_bytes):
-                data[ptr + i] = byte
+            self.write(ptr, registers[register_id])
 
         def register_len(register_id: int) -> int:
             return len(registers[register_id])
 
         def write_register(register_id: int, length: int, ptr: int) -> None:
-            registers[register_id] = bytes_from_ptr(ptr, length)
+            registers[register_id] = self.read(ptr, length)
 
         # Context API
         def current_account_id(register_id: int) -> None:
@@ -323,9 +1206,8 @@ class WasmRunner:
 
         # Miscellaneous API
         def value_return(value_len: int, value_ptr: int) -> None:
-            print(
-                f"value_return: {value_len} bytes: {bytes_from_ptr(value_ptr, value_len)}"
-            )
+            self.return_value = self.read(value_ptr, value_len)
+            print(f"value_return: {value_len} bytes: {self.return_value}")
 
         def panic() -> None:
             print(">>panic")
@@ -483,26 +1365,24 @@ class WasmRunner:
         def storage_write(
             key_len: int, key_ptr: int, value_len: int, value_ptr: int, register_id: int
         ) -> int:
-            storage[bytes_from_ptr(key_ptr, key_len)] = bytes_from_ptr(
-                value_ptr, value_len
-            )
+            storage[self.read(key_ptr, key_len)] = self.read(value_ptr, value_len)
             return 1
 
         def storage_read(key_len: int, key_ptr: int, register_id: int) -> int:
-            key = bytes_from_ptr(key_ptr, key_len)
+            key = self.read(key_ptr, key_len)
             if key in storage:
                 registers[register_id] = storage[key]
                 return 1
             return 0
 
         def storage_remove(key_len: int, key_ptr: int, register_id: int) -> int:
-            key = bytes_from_ptr(key_ptr, key_len)
+            key = self.read(key_ptr, key_len)
             if key in storage:
                 del storage[key]
             return 1
 
         def storage_has_key(key_len: int, key_ptr: int) -> int:
-            key = bytes_from_ptr(key_ptr, key_len)
+            key = self.read(key_ptr, key_len)
             return 1 if key in storage else 0
 
         # Validator API
@@ -824,171 +1704,582 @@ class WasmRunner:
 
 
 def trace_wasm(
-    wasm_runner: WasmRunner, entry_points: list, entry_point_test_inputs: dict
+    wasm_runner: WasmRunner,
+    entry_points: list,
+    entry_point_test_inputs: dict,
+    jobs=1,
 ) -> tuple[set[int], set[str]]:
+    runs = get_entry_point_runs(entry_points, entry_point_test_inputs)
+    if jobs <= 1 or len(runs) <= 1 or not trace_wasm_parallel(wasm_runner, runs, jobs):
+        trace_wasm_runs(wasm_runner, runs)
+    return (
+        wasm_runner.called_functions,
+        wasm_runner.loaded_frozen_modules,
+        wasm_runner.loaded_builtin_modules,
+    )
+
+
+def get_entry_point_runs(entry_points: list, entry_point_test_inputs: dict) -> list:
+    "Returns the (entry point, input bytes) pairs to run, with an empty input for entry points without test inputs"
+    runs = []
     for entry_point in entry_points:
         test_inputs = entry_point_test_inputs.get(entry_point, [])
         if len(test_inputs) == 0:
             test_inputs.append(b"")
-        for input_bytes in test_inputs:
-            print(f"running method {entry_point}({input_bytes})")
-            wasm_runner.set_input_bytes(input_bytes)
-            entry_point_export = wasm_runner.export(entry_point)
-            try:
-                entry_point_export()
-            except Exception as e:
-                print(f"trace_wasm(): exception {e}")
-            wasm_runner.reset()
+        runs += [(entry_point, input_bytes) for input_bytes in test_inputs]
+    return runs
+
+
+def run_entry_point(wasm_runner: WasmRunner, entry_point, input_bytes: bytes):
+    print(f"running method {entry_point}({input_bytes})")
+    wasm_runner.start_run()
+    wasm_runner.set_input_bytes(input_bytes)
+    entry_point_export = wasm_runner.export(entry_point)
+    aborted = None
+    try:
+        entry_point_export()
+    except (wasmtime.Trap, wasmtime.WasmtimeError) as e:
+        trap_code = getattr(e, "trap_code", None)
+        if trap_code in (wasmtime.TrapCode.OUT_OF_FUEL, wasmtime.TrapCode.INTERRUPT):
+            aborted = (
+                "fuel" if trap_code == wasmtime.TrapCode.OUT_OF_FUEL else "timeout"
+            )
+            print(
+                f"trace_wasm(): {entry_point}({input_bytes}) aborted: {aborted} limit exceeded"
+            )
+            wasm_runner.aborted_runs.append((entry_point, input_bytes, aborted))
+        else:
+            print(f"trace_wasm(): exception {e}")
+    if wasm_runner.consume_fuel:
+        wasm_runner.fuel_usage.append(
+            (entry_point, input_bytes, wasm_runner.fuel_consumed(), aborted)
+        )
+    wasm_runner.collect_coverage()
+    wasm_runner.reset()
+
+
+def trace_wasm_runs(wasm_runner: WasmRunner, runs: list):
+    "Runs (entry point, input bytes) pairs in order"
+    for entry_point, input_bytes in runs:
+        run_entry_point(wasm_runner, entry_point, input_bytes)
+
+
+def _trace_wasm_shard(wasm_bytes, serialized_module, runner_options, runs):
+    engine_config = (
+        runner_options["consume_fuel"],
+        runner_options["timeout"] is not None,
+    )
+    _lru_put(
+        _wasmtime_modules,
+        (hashlib.sha256(wasm_bytes).hexdigest(), *engine_config),
+        wasmtime.Module.deserialize(
+            get_wasmtime_engine(*engine_config), serialized_module
+        ),
+        MAX_WASMTIME_MODULES,
+    )
+    wasm_runner = WasmRunner(wasm_bytes, **runner_options)
+    trace_wasm_runs(wasm_runner, runs)
     return (
         wasm_runner.called_functions,
         wasm_runner.loaded_frozen_modules,
         wasm_runner.loaded_builtin_modules,
+        wasm_runner.fuel_usage,
+        wasm_runner.aborted_runs,
+        {
+            name: (dict(host_state), host_state.written, host_state.read_unwritten)
+            for name, host_state in (
+                ("registers", wasm_runner.registers),
+                ("storage", wasm_runner.storage),
+            )
+        },
     )
 
 
-def get_function_names(wat: list) -> set[str]:
+def trace_wasm_parallel(wasm_runner: WasmRunner, runs: list, jobs: int) -> bool:
+    """Traces contiguous shards of runs in worker processes and merges the results into wasm_runner.
+
+    Every worker starts with empty registers and storage, while in a serial trace a shard would start with the
+    registers and storage left by the earlier shards. A shard's runs behave the same either way unless they read a
+    register or storage key, before writing it themselves, that was written by an earlier shard (or held by
+    wasm_runner beforehand). So the parallel trace applies to runs which only read back state written by earlier runs
+    of the same shard, such as a method writing and reading its own storage keys, or state nobody wrote. Returns
+    False (merging nothing) otherwise, to fall back to a serial trace.
+    """
+    shard_size = -(-len(runs) // jobs)
+    shards = [runs[i : i + shard_size] for i in range(0, len(runs), shard_size)]
+    serialized_module = wasm_runner.module.serialize()
+    print(f"tracing {len(runs)} runs in {len(shards)} processes..")
+    # spawned (rather than forked) workers don't inherit the parent's wasmtime engine state
+    with concurrent.futures.ProcessPoolExecutor(
+        len(shards), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        results = list(
+            executor.map(
+                _trace_wasm_shard,
+                [wasm_runner.wasm_bytes] * len(shards),
+                [serialized_module] * len(shards),
+                [
+                    {
+                        "consume_fuel": wasm_runner.consume_fuel,
+                        "fuel_limit": wasm_runner.fuel_limit
+                        if wasm_runner.consume_fuel
+                        else None,
+                        "timeout": wasm_runner.timeout,
+                    }
+                ]
+                * len(shards),
+                shards,
+            )
+        )
+    earlier_keys = {
+        "registers": set(wasm_runner.registers),
+        "storage": set(wasm_runner.storage),
+    }
+    for *_, host_states in results:
+        for name, (_, written, read_unwritten) in host_states.items():
+            if read_unwritten & earlier_keys[name]:
+                print(
+                    f"trace_wasm(): runs read {name} left by runs in another process, tracing serially.."
+                )
+                return False
+            earlier_keys[name] |= written
+    for (
+        called_functions,
+        loaded_frozen_modules,
+        loaded_builtin_modules,
+        fuel_usage,
+        aborted_runs,
+        host_states,
+    ) in results:
+        wasm_runner.called_functions.update(called_functions)
+        wasm_runner.loaded_frozen_modules.update(loaded_frozen_modules)
+        wasm_runner.loaded_builtin_modules.update(loaded_builtin_modules)
+        wasm_runner.fuel_usage += fuel_usage
+        wasm_runner.aborted_runs += aborted_runs
+        # leave the host state as a serial trace would
+        for name, (values, written, _) in host_states.items():
+            host_state = getattr(wasm_runner, name)
+            for key in written:
+                if key in values:
+                    host_state[key] = values[key]
+                elif key in host_state:
+                    del host_state[key]
+    return True
+
+
+def profile_wasm(
+    wasm_runner: WasmRunner, entry_points: list, entry_point_test_inputs: dict
+) -> list:
+    "Returns [(entry point, input bytes, call counts by function name hash)] for a runner created with count_calls"
+    profile = []
+    for entry_point, input_bytes in get_entry_point_runs(
+        entry_points, entry_point_test_inputs
+    ):
+        run_entry_point(wasm_runner, entry_point, input_bytes)
+        profile.append((entry_point, input_bytes, wasm_runner.call_counts))
+    return profile
+
+
+def write_call_count_profile(profile: list, function_names, json_path, csv_path):
+    "Writes the call counts of profile_wasm() per run and in total, by function name and sorted by count"
+    names = {fnv1a_32(name): name for name in function_names}
+    total_counts = sum((call_counts for _, _, call_counts in profile), Counter())
+
+    def sorted_counts(call_counts: Counter):
+        return [
+            {"function": names.get(h, f"#{h:08x}"), "calls": count}
+            for h, count in call_counts.most_common()
+        ]
+
+    runs = [
+        {
+            "entry_point": entry_point,
+            "input": input_bytes.decode("utf-8", "backslashreplace"),
+            "functions": sorted_counts(call_counts),
+        }
+        for entry_point, input_bytes, call_counts in profile
+    ]
+    total = sorted_counts(total_counts)
+    print(f"writing {json_path}..")
+    with open(json_path, "w") as f:
+        json.dump({"total": total, "runs": runs}, f, indent=1)
+    print(f"writing {csv_path}..")
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["entry_point", "input", "function", "calls"])
+        for item in total:
+            writer.writerow(["*", "", item["function"], item["calls"]])
+        for run in runs:
+            for item in run["functions"]:
+                writer.writerow(
+                    [run["entry_point"], run["input"], item["function"], item["calls"]]
+                )
+
+
+def write_fuel_report(fuel_usages: dict, json_path):
+    """Prints a per-method table of the fuel consumed by the entry point runs of one or more modules and writes it,
+    along with the per-run numbers, as JSON. fuel_usages maps module labels to WasmRunner.fuel_usage lists
+    (of the same runs). Runs aborted by the fuel limit or timeout in any of the modules are marked with the
+    aborting limit per label and left out of the method totals, which would otherwise count a partial run.
+    """
+    labels = list(fuel_usages.keys())
+    methods = {}
+    runs = []
+    for run_usages in zip(*fuel_usages.values()):
+        entry_point, input_bytes, _, _ = run_usages[0]
+        method = methods.setdefault(
+            entry_point, {"runs": 0, "aborted": 0, **{label: 0 for label in labels}}
+        )
+        run = {
+            "entry_point": entry_point,
+            "input": input_bytes.decode("utf-8", "backslashreplace"),
+        }
+        aborted = {}
+        for label, (_, _, fuel, run_aborted) in zip(labels, run_usages):
+            run[label] = fuel
+            if run_aborted is not None:
+                aborted[label] = run_aborted
+        if aborted:
+            run["aborted"] = aborted
+            method["aborted"] += 1
+        else:
+            method["runs"] += 1
+            for label in labels:
+                method[label] += run[label]
+        runs.append(run)
+    print("fuel consumed per method (all test inputs, aborted runs excluded):")
+    print(
+        f"  {'method':<32} {'runs':>5} {'aborted':>7}"
+        + "".join(f" {label:>14}" for label in labels)
+        + (f" {'change':>8}" if len(labels) > 1 else "")
+    )
+    for entry_point, method in methods.items():
+        change = ""
+        if len(labels) > 1 and method[labels[0]]:
+            change = f" {(method[labels[-1]] / method[labels[0]] - 1) * 100:>+7.1f}%"
+        print(
+            f"  {entry_point:<32} {method['runs']:>5} {method['aborted']:>7}"
+            + "".join(f" {method[label]:>14}" for label in labels)
+            + change
+        )
+    print(f"writing {json_path}..")
+    with open(json_path, "w") as f:
+        json.dump({"methods": methods, "runs": runs}, f, indent=1)
+
+
+def benchmark_wasm_files(
+    wasm_paths: list,
+    entry_points: list,
+    entry_point_test_inputs: dict,
+    repeat=10,
+    cache_dir=None,
+) -> dict:
+    """Runs every (entry point, input) pair repeatedly in each of the WASM files, measuring wall time, fuel, peak
+    linear memory size and return value size. Prints a comparison table (relative to the first file) and returns
+    the results.
+    """
+    runs = get_entry_point_runs(entry_points, entry_point_test_inputs)
+    results = {"files": [], "runs": []}
+    for wasm_path in wasm_paths:
+        with open(wasm_path, "rb") as f:
+            wasm_bytes = f.read()
+        print(f"benchmarking {wasm_path} ({len(wasm_bytes)} bytes)..")
+        results["files"].append({"path": str(wasm_path), "size": len(wasm_bytes)})
+        wasm_runner = WasmRunner(wasm_bytes, cache_dir, consume_fuel=True)
+        for run_index, (entry_point, input_bytes) in enumerate(runs):
+            times, fuel, peak_memory, output_size = [], set(), 0, set()
+            # every repeat starts from the registers and storage left by the previous (entry point, input) pair
+            host_state = wasm_runner.save_host_state()
+            for i in range(repeat):
+                wasm_runner.restore_host_state(host_state)
+                # only the first run of each method/input is logged
+                output = io.StringIO() if i > 0 else None
+                with (
+                    contextlib.redirect_stdout(output)
+                    if output
+                    else contextlib.nullcontext()
+                ):
+                    wasm_runner.start_run()
+                    wasm_runner.set_input_bytes(input_bytes)
+                    entry_point_export = wasm_runner.export(entry_point)
+                    start_time = time.perf_counter()
+                    try:
+                        entry_point_export()
+                    except (wasmtime.Trap, wasmtime.WasmtimeError) as e:
+                        print(f"benchmark_wasm_files(): exception {e}")
+                    times.append(time.perf_counter() - start_time)
+                fuel.add(wasm_runner.fuel_consumed())
+                peak_memory = max(
+                    peak_memory, wasm_runner.memory.data_len(wasm_runner.store)
+                )
+                output_size.add(len(wasm_runner.return_value))
+                wasm_runner.reset()
+            if run_index == len(results["runs"]):
+                results["runs"].append(
+                    {
+                        "entry_point": entry_point,
+                        "input": input_bytes.decode("utf-8", "backslashreplace"),
+                        "results": [],
+                    }
+                )
+            results["runs"][run_index]["results"].append(
+                {
+                    "time_median": statistics.median(times),
+                    "time_mean": statistics.mean(times),
+                    "time_stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+                    "time_min": min(times),
+                    "time_max": max(times),
+                    "fuel": max(fuel),
+                    "fuel_varies": len(fuel) > 1,
+                    "peak_memory": peak_memory,
+                    "output_size": max(output_size),
+                }
+            )
+    print_benchmark_results(results)
+    return results
+
+
+def print_benchmark_results(results: dict):
+    print("WASM files:")
+    for index, file_result in enumerate(results["files"]):
+        print(f"  [{index}] {file_result['path']}: {file_result['size']} bytes")
+
+    def change(value, base):
+        return f"{(value / base - 1) * 100:+.1f}%" if base and value != base else ""
+
+    print(
+        f"  {'method(input)':<40} {'wasm':>4} {'median ms':>10} {'stdev ms':>9} {'min ms':>9} {'':>8}"
+        f" {'fuel':>14} {'':>7} {'peak mem KiB':>12} {'output':>7}"
+    )
+    for run in results["runs"]:
+        label = f"{run['entry_point']}({run['input']})"
+        if len(label) > 40:
+            label = label[:37] + "..."
+        base = run["results"][0]
+        for index, r in enumerate(run["results"]):
+            print(
+                f"  {label if index == 0 else '':<40} {index:>4}"
+                f" {r['time_median'] * 1000:>10.3f} {r['time_stdev'] * 1000:>9.3f} {r['time_min'] * 1000:>9.3f}"
+                f" {change(r['time_median'], base['time_median']):>8}"
+                f" {r['fuel']:>14}{'*' if r['fuel_varies'] else ' '}{change(r['fuel'], base['fuel']):>7}"
+                f" {r['peak_memory'] // 1024:>12} {r['output_size']:>7}"
+            )
+
+
+def get_function_names(wat: WatIndex) -> set[str]:
     names = set()
-    for item in wat:
-        if item[0] == "func":
-            names.add(str(item[1]).lstrip("$"))
+    for form in wat.forms:
+        if form.kind == "func":
+            names.add(form.name.lstrip("$"))
     return names
 
 
-def instrument_wat(wat):
-    instrumented_wat = []
+def get_function_body_prev(wat: SexpTree, func):
+    "Returns the func child after which its body starts (its name or the last leading param/result/local)"
+    children = wat.children(func)
+    next(children)
+    prev = next(children)
+    for func_item in children:
+        if wat.head(func_item) not in ("param", "result", "local"):
+            break
+        prev = func_item
+    return prev
+
+
+def instrument_wat(wat: WatIndex, first_hit_only=True):
+    """Adds tracing of function calls and module loads. With first_hit_only, each function reports its call only
+    on the first entry, guarded by a global of its own, so that later calls cost a global load and a branch.
+    """
+    instrumented_wat = wat.copy()
     imports_added = False
-    for item in wat:
-        if item[0] == "func":
-            func = deepcopy(item)
-            func_name = str(func[1]).lstrip("$")
+    forms = []
+    guard_count = 0
+    for form in instrumented_wat.forms:
+        if form.kind == "func":
+            func_name = form.name.lstrip("$")
             func_name_hash = fnv1a_32(func_name)
-            pos = 2
-            for func_item in func[2:]:
-                if func_item[0] not in ("param", "result", "local"):
-                    break
-                pos += 1
-            func.insert(
-                pos, ["call", "$trace_function_call", ["i32.const", func_name_hash]]
-            )
+            trace_call = ["call", "$trace_function_call", ["i32.const", func_name_hash]]
+            if first_hit_only:
+                guard = f"$trace_guard.{guard_count}"
+                guard_count += 1
+                trace_call = [
+                    "if",
+                    ["i32.eqz", ["global.get", guard]],
+                    ["then", ["global.set", guard, ["i32.const", 1]], trace_call],
+                ]
+            instrumented_wat.prepend_to_function(form, trace_call)
             if func_name == "load_frozen_module":
-                func.insert(
-                    pos, ["call", "$trace_frozen_module_load", ["local.get", "$0"]]
+                instrumented_wat.prepend_to_function(
+                    form, ["call", "$trace_frozen_module_load", ["local.get", "$0"]]
                 )
             if func_name == "notify_builtin_module_load":
-                func.insert(
-                    pos, ["call", "$trace_builtin_module_load", ["local.get", "$0"]]
+                instrumented_wat.prepend_to_function(
+                    form, ["call", "$trace_builtin_module_load", ["local.get", "$0"]]
                 )
-            instrumented_wat.append(func)
-        elif item[0] == "import" and not imports_added:
-            instrumented_wat.append(
-                [
-                    "import",
-                    '"env"',
-                    '"trace_function_call"',
-                    ["func", "$trace_function_call", ["param", "i32"]],
-                ]
+        elif form.kind == "import" and not imports_added:
+            forms += [
+                instrumented_wat.new_form(
+                    [
+                        "import",
+                        '"env"',
+                        '"trace_function_call"',
+                        ["func", "$trace_function_call", ["param", "i32"]],
+                    ]
+                ),
+                instrumented_wat.new_form(
+                    [
+                        "import",
+                        '"env"',
+                        '"trace_frozen_module_load"',
+                        ["func", "$trace_frozen_module_load", ["param", "i32"]],
+                    ]
+                ),
+                instrumented_wat.new_form(
+                    [
+                        "import",
+                        '"env"',
+                        '"trace_builtin_module_load"',
+                        ["func", "$trace_builtin_module_load", ["param", "i32"]],
+                    ]
+                ),
+            ]
+            imports_added = True
+        forms.append(form)
+    instrumented_wat.forms = forms
+    # the guards go last, as the globals from the exported first guard on are treated as trace guards
+    for i in range(guard_count):
+        instrumented_wat.append(
+            ["global", f"$trace_guard.{i}", ["mut", "i32"], ["i32.const", 0]]
+        )
+    if guard_count:
+        instrumented_wat.append(
+            ["export", f'"{TRACE_GUARDS_EXPORT}"', ["global", "$trace_guard.0"]]
+        )
+    return instrumented_wat
+
+
+def get_module_function_names(module: WasmModule) -> set[str]:
+    return {func_name for _, func_name in module.defined_functions()}
+
+
+def instrument_module(
+    module: WasmModule, coverage_bitmap_addr=None, coverage_bitmap_size=0
+):
+    """Adds tracing of function calls and module loads. Function calls are reported to the host (by name hash),
+    or, if coverage_bitmap_addr is set, marked in a byte per defined function at that address in linear memory,
+    which the host reads after each run.
+    """
+    instrumented_module = module.copy()
+    imports = [
+        ("env", "trace_frozen_module_load", [I32], []),
+        ("env", "trace_builtin_module_load", [I32], []),
+    ]
+    if coverage_bitmap_addr is None:
+        imports.append(("env", "trace_function_call", [I32], []))
+    elif len(module.functions) > coverage_bitmap_size:
+        raise ValueError(
+            f"{len(module.functions)} functions don't fit into the {coverage_bitmap_size} byte coverage bitmap"
+        )
+    trace_frozen_module_load, trace_builtin_module_load, *trace_function_call = (
+        instrumented_module.add_function_imports(imports)
+    )
+    function_name_hashes = []
+    for func_index, func_name in instrumented_module.defined_functions():
+        if coverage_bitmap_addr is None:
+            instructions = op_i32_const(fnv1a_32(func_name)) + op_call(
+                trace_function_call[0]
             )
-            instrumented_wat.append(
-                [
-                    "import",
-                    '"env"',
-                    '"trace_frozen_module_load"',
-                    ["func", "$trace_frozen_module_load", ["param", "i32"]],
-                ]
+        else:
+            instructions = (
+                op_i32_const(len(function_name_hashes))
+                + op_i32_const(1)
+                + op_i32_store8(coverage_bitmap_addr)
             )
-            instrumented_wat.append(
-                [
-                    "import",
-                    '"env"',
-                    '"trace_builtin_module_load"',
-                    ["func", "$trace_builtin_module_load", ["param", "i32"]],
-                ]
+            function_name_hashes.append(fnv1a_32(func_name))
+        if func_name == "load_frozen_module":
+            instructions = (
+                op_local_get(0) + op_call(trace_frozen_module_load) + instructions
             )
-            instrumented_wat.append(item)
-            imports_added = True
-        else:
-            instrumented_wat.append(item)
-    return instrumented_wat
+        if func_name == "notify_builtin_module_load":
+            instructions = (
+                op_local_get(0) + op_call(trace_builtin_module_load) + instructions
+            )
+        instrumented_module.prepend_to_function(func_index, instructions)
+    if coverage_bitmap_addr is not None:
+        instrumented_module.add_custom_section(
+            COVERAGE_SECTION_NAME,
+            encode_uleb128(coverage_bitmap_addr)
+            + encode_vector(struct.pack("<L", h) for h in function_name_hashes),
+        )
+    return instrumented_module
+
+
+# WAT string escapes, as (escape sequence, byte value) pairs: named escapes, plus \XX for every hex digit pair
+_DATA_STR_UNESCAPES = {
+    **{
+        b"\\" + c.encode("ascii"): bytes([ord(v)])
+        for c, v in zip("tnr\"'\\", "\t\n\r\"'\\")
+    },
+    **{
+        b"\\" + (hi + lo).encode("ascii"): bytes([int(hi + lo, 16)])
+        for hi in "0123456789abcdefABCDEF"
+        for lo in "0123456789abcdefABCDEF"
+    },
+}
+_DATA_STR_ESCAPE_RE = re.compile(rb"""(\\[tnr"'\\]|\\[0-9a-fA-F]{2})""")
+# str.translate() table escaping every byte value (of latin-1 decoded data)
+_DATA_STR_ESCAPES = [
+    {'"': '\\"', "'": "\\'", "\\": "\\\\"}.get(chr(b), chr(b))
+    if 32 <= b <= 126
+    else f"\\{b:02x}"
+    for b in range(256)
+]
 
 
 def unescape_data_str(s):
     if not (s.startswith('"') and s.endswith('"')):
         raise ValueError("String must be doubly-quoted")
-    content, result, i = s[1:-1], [], 0
-    while i < len(content):
-        if content[i] == "\\" and i + 1 < len(content):
-            next_char = content[i + 1]
-            if next_char == "t":
-                result.append(ord("\t"))
-                i += 2
-            elif next_char == "n":
-                result.append(ord("\n"))
-                i += 2
-            elif next_char == "r":
-                result.append(ord("\r"))
-                i += 2
-            elif next_char == '"':
-                result.append(ord('"'))
-                i += 2
-            elif next_char == "'":
-                result.append(ord("'"))
-                i += 2
-            elif next_char == "\\":
-                result.append(ord("\\"))
-                i += 2
-            elif i + 2 < len(content) and all(
-                c in "0123456789abcdefABCDEF" for c in content[i + 1 : i + 3]
-            ):
-                result.append(int(content[i + 1 : i + 3], 16))
-                i += 3
-            else:
-                result.append(ord("\\"))
-                i += 1
-        else:
-            result.append(ord(content[i]))
-            i += 1
-    return bytes(result)
+    # the split alternates between literal text and escape sequences, backslashes not starting any valid escape
+    # sequence stay in the literal text as-is, literal text never matches an escape sequence lookup
+    parts = _DATA_STR_ESCAPE_RE.split(s[1:-1].encode("latin-1"))
+    return b"".join(map(_DATA_STR_UNESCAPES.get, parts, parts))
 
 
 def escape_data_str(data: bytes):
-    result = []
-    for b in data:
-        # if b == ord('\t'): result.append('\\t')
-        # elif b == ord('\n'): result.append('\\n')
-        # elif b == ord('\r'): result.append('\\r')
-        if b == ord('"'):
-            result.append('\\"')
-        elif b == ord("'"):
-            result.append("\\'")
-        elif b == ord("\\"):
-            result.append("\\\\")
-        elif 32 <= b <= 126:
-            result.append(chr(b))
-        else:
-            result.append(f"\\{b:02x}")
-    # assert(unescape_data_str('"' + ''.join(result) + '"') == data)
-    return '"' + "".join(result) + '"'
+    return '"' + data.decode("latin-1").translate(_DATA_STR_ESCAPES) + '"'
 
 
-def get_wasm_data_initializer(wat):
+def get_wasm_data_initializer(wat: WatIndex):
     initialized_memory_length = 0
     initializer = bytearray(20000000)
-    for item in wat:
-        if item[0] == "data":
-            data = unescape_data_str(item[-1])
-            offset = int(item[-2][1])
+    for form in wat.forms:
+        if form.kind == "data":
+            tree = wat.tree(form)
+            *_, offset_expr, data_str = tree.children()
+            data = unescape_data_str(tree.atom(data_str))
+            offset = int(tree.atom(tree.child(offset_expr, 1)))
             length = len(data)
             initialized_memory_length = max(initialized_memory_length, offset + length)
             initializer[offset : offset + length] = data
     return bytes(initializer[0:initialized_memory_length])
 
 
-def compress_wasm_data_initializer(wat):
+def get_module_data_initializer(module: WasmModule):
+    initialized_memory_length = 0
+    initializer = bytearray(20000000)
+    for offset, data in module.active_data_segments():
+        length = len(data)
+        initialized_memory_length = max(initialized_memory_length, offset + length)
+        initializer[offset : offset + length] = data
+    return bytes(initializer[0:initialized_memory_length])
+
+
+def get_compressed_data_segments(wasm_data: bytes):
+    "Returns the [(name, address, data)] data segments replacing the wasm_data initializer"
     FROZEN_MODULE_BASE_ADDR = 1048576
     WASM_DATA_BASE_ADDR = 8388608
     COMPRESSION_TYPE_LZ4 = 0x00347A6C
     COMPRESSED_BLOCK_HEADER_ADDR = 1024
-    wasm_data = get_wasm_data_initializer(wat)
     frozen_module_data_last_addr = 0
     for i in range(FROZEN_MODULE_BASE_ADDR, min(WASM_DATA_BASE_ADDR, len(wasm_data))):
         if wasm_data[i] != 0:
@@ -1016,46 +2307,48 @@ def compress_wasm_data_initializer(wat):
     print(
         f" data1: {len(wasm_data1)} bytes @{WASM_DATA_BASE_ADDR} -> {len(compressed_data1)} bytes @{compressed_data_addr1}"
     )
-    modified_wat = []
-    for item in wat:
-        if item[0] != "data":
-            modified_wat.append(item)
-    modified_wat.append(
-        [
-            "data",
-            "$.compressed_data.header",
-            ["i32.const", COMPRESSED_BLOCK_HEADER_ADDR],
-            escape_data_str(
-                struct.pack("<L", COMPRESSION_TYPE_LZ4)
-                + struct.pack("<L", compressed_data_addr0)
-                + struct.pack("<L", len(compressed_data0))
-                + struct.pack("<L", FROZEN_MODULE_BASE_ADDR)
-                + struct.pack("<L", COMPRESSION_TYPE_LZ4)
-                + struct.pack("<L", compressed_data_addr1)
-                + struct.pack("<L", len(compressed_data1))
-                + struct.pack("<L", WASM_DATA_BASE_ADDR)
-            ),
-        ]
-    )
-    modified_wat.append(
-        [
-            "data",
-            "$.compressed_data.0",
-            ["i32.const", compressed_data_addr0],
-            escape_data_str(compressed_data0),
-        ]
-    )
-    modified_wat.append(
-        [
-            "data",
-            "$.compressed_data.1",
-            ["i32.const", compressed_data_addr1],
-            escape_data_str(compressed_data1),
-        ]
+    return [
+        (
+            ".compressed_data.header",
+            COMPRESSED_BLOCK_HEADER_ADDR,
+            struct.pack("<L", COMPRESSION_TYPE_LZ4)
+            + struct.pack("<L", compressed_data_addr0)
+            + struct.pack("<L", len(compressed_data0))
+            + struct.pack("<L", FROZEN_MODULE_BASE_ADDR)
+            + struct.pack("<L", COMPRESSION_TYPE_LZ4)
+            + struct.pack("<L", compressed_data_addr1)
+            + struct.pack("<L", len(compressed_data1))
+            + struct.pack("<L", WASM_DATA_BASE_ADDR),
+        ),
+        (".compressed_data.0", compressed_data_addr0, compressed_data0),
+        (".compressed_data.1", compressed_data_addr1, compressed_data1),
+    ]
+
+
+def compress_wasm_data_initializer(wat: WatIndex):
+    compressed_data_segments = get_compressed_data_segments(
+        get_wasm_data_initializer(wat)
     )
+    modified_wat = wat.copy()
+    modified_wat.forms = [form for form in modified_wat.forms if form.kind != "data"]
+    for name, addr, data in compressed_data_segments:
+        modified_wat.append(
+            ["data", f"${name}", ["i32.const", addr], escape_data_str(data)],
+        )
     return modified_wat
 
 
+def compress_module_data_initializer(module: WasmModule):
+    compressed_data_segments = get_compressed_data_segments(
+        get_module_data_initializer(module)
+    )
+    modified_module = module.copy()
+    modified_module.remove_data_segments()
+    for name, addr, data in compressed_data_segments:
+        modified_module.add_data_segment(addr, data, name)
+    return modified_module
+
+
 class WasmDataStore:
     BASE_ADDR = 1048576
     MAX_ADDR = 8388608
@@ -1063,12 +2356,16 @@ class WasmDataStore:
     FROZEN_MODULE_MAX_PATH_LENGTH = 248
     MAX_FROZEN_MODULES = 512
     STRINGS_OFFSET = FROZEN_MODULE_HEADER_LENGTH * MAX_FROZEN_MODULES
+    COVERAGE_BITMAP_SIZE = 65536
+    COVERAGE_BITMAP_ADDR = MAX_ADDR - COVERAGE_BITMAP_SIZE
 
     # memory layout:
     #   BASE_ADDR: <frozen module header:256 bytes> * MAX_FROZEN_MODULES
     #              <allocated null-terminated strings>
     #              <frozen module data chunks linked from the header>
     #              ...
+    #   COVERAGE_BITMAP_ADDR: <function call coverage bitmap of instrumented modules:1 byte per function>
+    #                         (only reserved with coverage_bitmap, frozen module data may extend up to MAX_ADDR otherwise)
     #   MAX_ADDR: start of the regular WASM data area (-sGLOBAL_BASE=<MAX_ADDR> Emscripten option)
 
     # frozen module header (64 bytes):
@@ -1077,7 +2374,8 @@ class WasmDataStore:
     #   path: 248 bytes (null-terminated)
     #   both data addr and size fields is a empty header/end of valid headers marker
 
-    def __init__(self):
+    def __init__(self, coverage_bitmap=False):
+        self.coverage_bitmap = coverage_bitmap
         self.frozen_modules = []
         self.packed_strings = bytearray()
         self.packed_strings_cache = dict()
@@ -1117,7 +2415,9 @@ class WasmDataStore:
             data[alloc_offset : alloc_offset + len(bytecode)] = bytecode
             alloc_offset += len(bytecode)
             frozen_module_index += 1
-        assert alloc_offset < self.MAX_ADDR
+        assert self.BASE_ADDR + alloc_offset <= (
+            self.COVERAGE_BITMAP_ADDR if self.coverage_bitmap else self.MAX_ADDR
+        )
         del data[alloc_offset:]
         if len(self.frozen_modules) < 100:
             print(
@@ -1126,12 +2426,9 @@ class WasmDataStore:
         return bytes(data)
 
     def add_to_wasm_runner(self, wasm_runner: WasmRunner):
-        data = self.to_bytes()
-        data_ptr = wasm_runner.data_ptr()
-        for i in range(0, len(data)):
-            data_ptr[self.BASE_ADDR + i] = data[i]
+        wasm_runner.write(self.BASE_ADDR, self.to_bytes())
 
-    def add_to_wat(self, wat):
+    def add_to_wat(self, wat: WatIndex):
         modified_wat = wat.copy()
         modified_wat.append(
             [
@@ -1139,13 +2436,20 @@ class WasmDataStore:
                 "$.data.frozen",
                 ["i32.const", self.BASE_ADDR],
                 escape_data_str(self.to_bytes()),
-            ]
+            ],
         )
         return modified_wat
 
+    def add_to_module(self, module: WasmModule):
+        modified_module = module.copy()
+        modified_module.add_data_segment(
+            self.BASE_ADDR, self.to_bytes(), ".data.frozen"
+        )
+        return modified_module
+
 
 def add_contract_entry_points_to_wat(
-    wat, wasm_data: WasmDataStore, contract_module_name, entry_points
+    wat: WatIndex, wasm_data: WasmDataStore, contract_module_name, entry_points
 ):
     modified_wat = wat.copy()
     for func_name in entry_points:
@@ -1156,7 +2460,7 @@ def add_contract_entry_points_to_wat(
                 "export",
                 f'"{func_name}"',
                 ["func", f"${contract_module_name}_{func_name}"],
-            ]
+            ],
         )
         modified_wat.append(
             [
@@ -1168,25 +2472,76 @@ def add_contract_entry_points_to_wat(
                     ["i32.const", module_name_address],
                     ["i32.const", func_name_address],
                 ],
-            ]
+            ],
         )
     return modified_wat
 
 
+def add_contract_entry_points_to_module(
+    module: WasmModule, wasm_data: WasmDataStore, contract_module_name, entry_points
+):
+    modified_module = module.copy()
+    contract_entry_point = modified_module.function_index("contract_entry_point")
+    for func_name in entry_points:
+        module_name_address = wasm_data.allocate_string(contract_module_name)
+        func_name_address = wasm_data.allocate_string(func_name)
+        func_index = modified_module.add_function(
+            [],
+            [],
+            op_i32_const(module_name_address)
+            + op_i32_const(func_name_address)
+            + op_call(contract_entry_point),
+            name=f"{contract_module_name}_{func_name}",
+        )
+        modified_module.add_export(func_name, EXTERNAL_FUNC, func_index)
+    return modified_module
+
+
+def remove_module_functions(
+    module: WasmModule, function_removable, wasm_data: WasmDataStore
+) -> set[str]:
+    """Removes the defined functions for which function_removable(name) is true, like the text pipeline does: their
+    bodies become a single `unreachable`, and calls to them are replaced by a call to
+    optimized_out_function_panic_handler with the function name (allocated in wasm_data). Function indices don't
+    change, so table elements and exports referring to removed functions stay valid (and trap when reached).
+    Returns the names of the removed functions.
+    """
+    panic_handler = module.function_index("optimized_out_function_panic_handler")
+
+    def replace_removed_function_call(callee):
+        func_name = module.function_name(callee)
+        if not function_removable(func_name):
+            return None
+        # print(f"optimizing out {func_name}")
+        return (
+            op_i32_const(wasm_data.allocate_string(func_name))
+            + op_call(panic_handler)
+            + OP_UNREACHABLE
+        )
+
+    removed_function_names = set()
+    for func_index, func_name in module.defined_functions():
+        module.replace_calls(func_index, replace_removed_function_call)
+        if function_removable(func_name):
+            removed_function_names.add(func_name)
+            module.replace_function_body(func_index, OP_UNREACHABLE)
+    return removed_function_names
+
+
 def compile_to_bytecode(
     wasm_runner: WasmRunner, wasm_data: WasmDataStore, source_code, filename
 ):
+    """Compiles source code to bytecode in wasm_runner, after adding wasm_data (the frozen modules) to it. Pass None
+    for wasm_data with compilers from create_compiler(), which hold the frozen stdlib already."""
+    if wasm_data is not None:
+        wasm_data.add_to_wasm_runner(wasm_runner)
     alloc_buffer = wasm_runner.export("_alloc_buffer")
     compile_contract_source = wasm_runner.export("_compile_contract_source")
-    wasm_data.add_to_wasm_runner(wasm_runner)
-    data_ptr = wasm_runner.data_ptr()
 
     def alloc_null_terminated_string(string, encoding="utf-8"):
-        string_bytes = string.encode(encoding)
-        buffer_ptr = alloc_buffer(len(string_bytes) + 1)
-        for i in range(0, len(string_bytes)):
-            data_ptr[buffer_ptr + i] = string_bytes[i]
-        data_ptr[buffer_ptr + len(string_bytes)] = 0
+        string_bytes = string.encode(encoding) + b"\0"
+        buffer_ptr = alloc_buffer(len(string_bytes))
+        wasm_runner.write(buffer_ptr, string_bytes)
         return buffer_ptr
 
     bytecode_len_ptr = alloc_buffer(4)
@@ -1195,10 +2550,149 @@ def compile_to_bytecode(
         alloc_null_terminated_string(filename),
         bytecode_len_ptr,
     )
-    bytecode_len = struct.unpack(
-        "<L", bytes(data_ptr[bytecode_len_ptr : bytecode_len_ptr + 4])
-    )[0]
-    return bytes(data_ptr[bytecode_ptr : bytecode_ptr + bytecode_len])
+    bytecode_len = struct.unpack("<L", wasm_runner.read(bytecode_len_ptr, 4))[0]
+    return wasm_runner.read(bytecode_ptr, bytecode_len)
+
+
+def create_compiler(wasm_bytes: bytes, stdlib_zip, cache_dir=None) -> WasmRunner:
+    "Creates a runner for compile_to_bytecode() with the frozen stdlib loaded, snapshotted to be reset after each compile"
+    wasm_data = WasmDataStore()
+    add_frozen_modules(wasm_data, None, None, stdlib_zip, None)
+    compiler = WasmRunner(wasm_bytes, cache_dir)
+    wasm_data.add_to_wasm_runner(compiler)
+    compiler.snapshot()
+    return compiler
+
+
+def compile_to_bytecode_timed(compiler: WasmRunner, filename, source_code):
+    "Returns the bytecode of a source and the seconds taken to compile it, resetting the compiler afterwards"
+    start_time = time.perf_counter()
+    bytecode = compile_to_bytecode(compiler, None, source_code, filename)
+    compiler.reset()
+    return bytecode, time.perf_counter() - start_time
+
+
+def compile_many(compiler: WasmRunner, sources: list, isolate=True) -> list[bytes]:
+    """Compiles (filename, source code) pairs to bytecode in a single compiler instance (see create_compiler()), so
+    the frozen stdlib is loaded only once. With isolate, the instance is reset to its snapshot after every source,
+    making the bytecode identical to that of separate compiles (as in optimize_wasm_file()). Otherwise it's only
+    reset when a compile fails or grows linear memory, and once at the end, which is faster; interpreter state like
+    interned strings then carries over between sources, so the bytecode may differ (in marshal references, not in
+    behavior) from separate compiles.
+    """
+    bytecodes = []
+    for filename, source_code in sources:
+        try:
+            bytecodes.append(compile_to_bytecode(compiler, None, source_code, filename))
+        except Exception:
+            compiler.reset()
+            raise
+        if isolate or compiler.memory_grown():
+            compiler.reset()
+    if not isolate:
+        compiler.reset()
+    return bytecodes
+
+
+_compilers = {}  # compiler runners of compile_to_bytecode_cached(), by compiler_hash
+
+# the compiler runner of a compile_sources_parallel() worker process
+_worker_compiler = None
+
+
+def _init_compiler_worker(wasm_bytes, serialized_module, stdlib_zip):
+    global _worker_compiler
+    _lru_put(
+        _wasmtime_modules,
+        (hashlib.sha256(wasm_bytes).hexdigest(), False, False),
+        wasmtime.Module.deserialize(get_wasmtime_engine(), serialized_module),
+        MAX_WASMTIME_MODULES,
+    )
+    _worker_compiler = create_compiler(wasm_bytes, stdlib_zip)
+
+
+def _compile_in_worker(filename, source_code):
+    return compile_to_bytecode_timed(_worker_compiler, filename, source_code)
+
+
+def compile_sources_parallel(
+    compiler: WasmRunner, stdlib_zip, sources: list, jobs: int
+) -> list:
+    """Compiles (filename, source code) pairs in worker processes, each owning a warm copy of compiler. Returns the
+    (bytecode, seconds) of every source, in the order of sources.
+    """
+    serialized_module = compiler.module.serialize()
+    jobs = min(jobs, len(sources))
+    print(f"compiling {len(sources)} sources in {jobs} processes..")
+    # spawned (rather than forked) workers don't inherit the parent's wasmtime engine state
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_compiler_worker,
+        initargs=(compiler.wasm_bytes, serialized_module, str(stdlib_zip)),
+    ) as executor:
+        return list(
+            executor.map(
+                _compile_in_worker,
+                [filename for filename, _ in sources],
+                [source_code for _, source_code in sources],
+            )
+        )
+
+
+def compile_to_bytecode_cached(
+    wasm_bytes: bytes,
+    stdlib_zip,
+    sources: list,
+    cache_dir,
+    compiler_hash,
+    refresh=False,
+    jobs=1,
+) -> list[bytes]:
+    """Compiles (filename, source code) pairs to bytecode, reusing the .pyc files stored in <cache_dir>/bytecode by
+    a hash of the filename, the source code and compiler_hash (identifying wasm_bytes and stdlib_zip), so that edited
+    sources or a new python.wasm never hit stale entries. The cache misses are compiled in up to jobs processes.
+    """
+    bytecode_path = Path(cache_dir) / "bytecode"
+    cache_paths = [
+        bytecode_path
+        / f"{hash_inputs(CACHE_FORMAT_VERSION, compiler_hash, filename, source_code)}.pyc"
+        for filename, source_code in sources
+    ]
+    bytecodes = [None] * len(sources)
+    misses = []
+    for i, cache_path in enumerate(cache_paths):
+        if not refresh and cache_path.exists():
+            with open(cache_path, "rb") as f:
+                bytecodes[i] = f.read()
+        else:
+            misses.append(i)
+    if misses:
+        compiler = _compilers.get(compiler_hash)
+        if compiler is None:
+            compiler = _compilers[compiler_hash] = create_compiler(
+                wasm_bytes, stdlib_zip, cache_dir
+            )
+        if jobs > 1 and len(misses) > 1:
+            results = compile_sources_parallel(
+                compiler, stdlib_zip, [sources[i] for i in misses], jobs
+            )
+        else:
+            results = [compile_to_bytecode_timed(compiler, *sources[i]) for i in misses]
+        bytecode_path.mkdir(parents=True, exist_ok=True)
+        for i, (bytecode, seconds) in zip(misses, results):
+            print(f"compiled {sources[i][0]} in {seconds * 1000:.1f} ms")
+            temp_path = cache_paths[i].with_name(
+                f"{cache_paths[i].name}.{os.getpid()}.tmp"
+            )
+            with open(temp_path, "wb") as f:
+                f.write(bytecode)
+            os.replace(temp_path, cache_paths[i])
+            bytecodes[i] = bytecode
+    print(
+        f"compiled {len(misses)} sources, reused {len(sources) - len(misses)} cached bytecodes"
+    )
+    return bytecodes
 
 
 def should_include_lib_path(pinned_module_paths, path: str):
@@ -1207,6 +2701,9 @@ def should_include_lib_path(pinned_module_paths, path: str):
     )
 
 
+_stdlib_modules = {}  # [(frozen path, bytecode)] of the stdlib zips read, by (path, mtime, size)
+
+
 def add_frozen_modules(
     wasm_data: WasmDataStore,
     pinned_module_paths,
@@ -1214,15 +2711,19 @@ def add_frozen_modules(
     stdlib_zip_path,
     user_lib_path,
 ):
-    with zipfile.ZipFile(stdlib_zip_path, "r") as zip_file:
-        for info in zip_file.infolist():
-            frozen_path = info.filename.lstrip("/")
-            if (
-                not info.is_dir()
-                and frozen_path.endswith(".pyc")
-                and should_include_lib_path(pinned_module_paths, frozen_path)
-            ):
-                wasm_data.add_frozen_module(frozen_path, zip_file.read(info.filename))
+    stat = os.stat(stdlib_zip_path)
+    stdlib_key = (str(stdlib_zip_path), stat.st_mtime_ns, stat.st_size)
+    stdlib_modules = _stdlib_modules.get(stdlib_key)
+    if stdlib_modules is None:
+        with zipfile.ZipFile(stdlib_zip_path, "r") as zip_file:
+            stdlib_modules = _stdlib_modules[stdlib_key] = [
+                (info.filename.lstrip("/"), zip_file.read(info.filename))
+                for info in zip_file.infolist()
+                if not info.is_dir() and info.filename.endswith(".pyc")
+            ]
+    for frozen_path, bytecode in stdlib_modules:
+        if should_include_lib_path(pinned_module_paths, frozen_path):
+            wasm_data.add_frozen_module(frozen_path, bytecode)
     if user_lib_path:
         for path in Path(user_lib_path).glob("**/*.pyc"):
             frozen_path = str(path.relative_to(user_lib_path)).replace("\\", "/")
@@ -1236,6 +2737,52 @@ def add_frozen_modules(
             )
 
 
+def encode_test_input(value) -> bytes:
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    elif isinstance(value, bytes):
+        return value
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value).encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+def get_abi_test_inputs(abi) -> dict:
+    "Generates test inputs (JSON args objects) for the functions in a NEAR ABI, by function name"
+    arg_test_values = {
+        "string": ["", "An ascii string value", "此地无银三百两"],
+        "integer": [0, -3, 10000000000000000],
+        "boolean": [True, False],
+        "object": [{}, None],
+    }
+    entry_point_test_inputs = defaultdict(list)
+    for f in abi.get("body", {}).get("functions", {}):
+        name = f.get("name")
+        args = {}
+        for arg in f.get("params", {}).get("args", {}):
+            args[arg.get("name")] = arg.get("type_schema", {}).get("type", "string")
+        test_args_sets = []
+        if len(args.keys()) > 0:
+            max_values = max(len(values) for values in arg_test_values.values())
+            test_args = [
+                dict(
+                    zip(
+                        args.keys(),
+                        [
+                            arg_test_values[t][i % len(arg_test_values[t])]
+                            for t in args.values()
+                        ],
+                    )
+                )
+                for i in range(max_values)
+            ]
+            test_args_sets.extend(test_args)
+        entry_point_test_inputs[name] = [
+            json.dumps(args_set).encode("utf-8") for args_set in test_args_sets
+        ]
+    return entry_point_test_inputs
+
+
 def get_near_exports_from_file(file_path: str) -> set[str]:
     with open(file_path, "r") as file:
         content = file.read()
@@ -1301,16 +2848,9 @@ def get_near_exports_from_file(file_path: str) -> set[str]:
                     ):
                         for elt in decorator.args[0].elts:
                             if isinstance(elt, ast.Constant):
-                                value = None
-                                if isinstance(elt.value, str):
-                                    value = elt.value.encode("utf-8")
-                                elif isinstance(elt.value, bytes):
-                                    value = elt.value
-                                elif isinstance(elt.value, (dict, list)):
-                                    value = json.dumps(elt.value).encode("utf-8")
-                                else:
-                                    value = str(elt.value).encode("utf-8")
-                                near_optimizer_inputs[node.name].append(value)
+                                near_optimizer_inputs[node.name].append(
+                                    encode_test_input(elt.value)
+                                )
 
     return near_exports, near_optimizer_inputs
 
@@ -1331,6 +2871,128 @@ def run_tool(tool_name, args):
     return subprocess.run(cmd, text=True, check=True)
 
 
+def get_tool_version(tool_name):
+    return subprocess.run(
+        [get_binary_path(tool_name), "--version"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+
+
+def hash_inputs(*inputs) -> str:
+    "Returns a hex digest of build stage inputs: bytes, strings, (nested) lists/tuples of them, or values with a stable repr()"
+    h = hashlib.sha256()
+
+    def update(value):
+        if isinstance(value, (list, tuple)):
+            h.update(f"list:{len(value)}:".encode("ascii"))
+            for item in value:
+                update(item)
+            return
+        if isinstance(value, bytes):
+            data = value
+        elif isinstance(value, str):
+            data = value.encode("utf-8")
+        else:
+            data = repr(value).encode("utf-8")
+        h.update(f"{type(value).__name__}:{len(data)}:".encode("ascii"))
+        h.update(data)
+
+    for value in inputs:
+        update(value)
+    return h.hexdigest()
+
+
+# cache keys of the optimize_wasm_file() stages, each hashing all inputs of the stage (including the previous stage's key)
+
+
+def trace_stage_key(
+    wasm_hash,
+    pipeline,
+    binaryen_version,
+    wasm_data: bytes,
+    contract_module,
+    test_runs,
+    fuel_limit,
+    timeout,
+) -> str:
+    return f"trace-v{CACHE_FORMAT_VERSION}-" + hash_inputs(
+        wasm_hash,
+        pipeline,
+        binaryen_version,
+        wasm_data,
+        contract_module,
+        test_runs,
+        fuel_limit,
+        timeout,
+    )
+
+
+def optimize_stage_key(
+    trace_key,
+    module_opt,
+    function_opt,
+    pinned_functions,
+    compression,
+    debug_info,
+    wasm_opt_version,
+) -> str:
+    return f"optimized-v{CACHE_FORMAT_VERSION}-" + hash_inputs(
+        trace_key,
+        module_opt,
+        function_opt,
+        sorted(pinned_functions),
+        compression,
+        debug_info,
+        wasm_opt_version,
+    )
+
+
+def verify_stage_key(
+    optimized_wasm_bytes: bytes, test_runs, fuel_limit, timeout
+) -> str:
+    return f"verified-v{CACHE_FORMAT_VERSION}-" + hash_inputs(
+        optimized_wasm_bytes, test_runs, fuel_limit, timeout
+    )
+
+
+# values returned by load_cached() in this process, by cache file path, least recently used first
+_loaded_values = OrderedDict()
+# a few builds' worth of stage values, older ones are evicted so watch mode's rebuilds don't keep every value
+MAX_LOADED_VALUES = 16
+
+
+def load_cached(cache_dir, key, compute, refresh=False):
+    """Returns the value stored at <cache_dir>/<key>.pickle, or computes and stores it there on a cache miss (or
+    always, if refresh is set). Recently used values stay resident for later builds in the same process, so must not
+    be modified.
+    """
+    cache_path = Path(cache_dir) / f"{key}.pickle"
+    value = None if refresh else _lru_get(_loaded_values, cache_path)
+    if value is not None:
+        return value
+    try:
+        if not refresh:
+            with open(cache_path, "rb") as f:
+                value = pickle.load(f)
+            print(f"loaded cached {cache_path}..")
+            _lru_put(_loaded_values, cache_path, value, MAX_LOADED_VALUES)
+            return value
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        print(f"ignoring unreadable cache file {cache_path}: {e}")
+    value = compute()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(temp_path, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, cache_path)
+    _lru_put(_loaded_values, cache_path, value, MAX_LOADED_VALUES)
+    return value
+
+
 def optimize_wasm_file(
     build_dir="build",
     input_file=LIB_PATH / "python.wasm",
@@ -1346,8 +3008,16 @@ def optimize_wasm_file(
     contract_exports=[],
     verify_optimized_wasm=True,
     abi=None,
+    pipeline="binary",  # valid values: "binary", "text"
+    cache_dir=None,  # defaults to <build_dir>/cache
+    use_cache=True,  # False recomputes (and re-stores) every cached stage
+    jobs=1,
+    profile=False,
+    fuel_limit=None,  # per entry point run
+    timeout=None,  # per entry point run, in seconds
 ):
     build_path = Path(build_dir)
+    cache_path = Path(cache_dir) if cache_dir is not None else build_path / "cache"
     wasm_path = Path(input_file)
     wat_path = build_path / "python.wat"
     instrumented_wasm_path = build_path / "python-instrumented.wasm"
@@ -1355,20 +3025,43 @@ def optimize_wasm_file(
 
     build_path.mkdir(parents=True, exist_ok=True)
 
-    sys.setrecursionlimit(10000)
-
-    run_tool("wasm-dis", [wasm_path, "-o", wat_path])
-    print(f"reading {wat_path}..")
-    wat = read_sexp(wat_path)
-
-    function_names = get_function_names(wat)
-    function_name_hashes = {fnv1a_32(s) for s in function_names}
-
     with open(wasm_path, "rb") as f:
         wasm_bytes = f.read()
 
-    wasm_data = WasmDataStore()
-    add_frozen_modules(wasm_data, None, None, stdlib_zip, None)
+    wasm_hash = hashlib.sha256(wasm_bytes).hexdigest()
+
+    if pipeline == "text":
+
+        def read_wat():
+            run_tool("wasm-dis", [wasm_path, "-o", wat_path])
+            print(f"reading {wat_path}..")
+            wat = read_wat_index(wat_path, jobs)
+            function_names = get_function_names(wat)
+            return wat, function_names, {fnv1a_32(s) for s in function_names}
+
+        binaryen_version = hashlib.sha256(
+            get_tool_version("wasm-dis").encode("utf-8")
+        ).hexdigest()
+        base_wat, function_names, function_name_hashes = load_cached(
+            cache_path,
+            f"wat-v{CACHE_FORMAT_VERSION}-{wasm_hash}-{binaryen_version[:16]}",
+            read_wat,
+            refresh=not use_cache,
+        )
+    else:
+
+        def read_function_names():
+            function_names = get_module_function_names(module)
+            return function_names, {fnv1a_32(s) for s in function_names}
+
+        binaryen_version = None
+        module = WasmModule(wasm_bytes)
+        function_names, function_name_hashes = load_cached(
+            cache_path,
+            f"functions-v{CACHE_FORMAT_VERSION}-{wasm_hash}",
+            read_function_names,
+            refresh=not use_cache,
+        )
 
     contract_path = Path(contract_file)
     contract_pyc_path = contract_path.with_suffix(".pyc")
@@ -1381,261 +3074,491 @@ def optimize_wasm_file(
             contract_path
         )
     elif abi is not None:
-        arg_test_values = {
-            "string": ["", "An ascii string value", "此地无银三百两"],
-            "integer": [0, -3, 10000000000000000],
-            "boolean": [True, False],
-            "object": [{}, None],
-        }
-        for f in abi.get("body", {}).get("functions", {}):
-            name = f.get("name")
-            args = {}
-            for arg in f.get("params", {}).get("args", {}):
-                args[arg.get("name")] = arg.get("type_schema", {}).get("type", "string")
-            test_args_sets = []
-            if len(args.keys()) > 0:
-                max_values = max(len(values) for values in arg_test_values.values())
-                test_args = [
-                    dict(
-                        zip(
-                            args.keys(),
-                            [
-                                arg_test_values[t][i % len(arg_test_values[t])]
-                                for t in args.values()
-                            ],
-                        )
-                    )
-                    for i in range(max_values)
-                ]
-                test_args_sets.extend(test_args)
-            entry_point_test_inputs[name] = [
-                json.dumps(args_set).encode("utf-8") for args_set in test_args_sets
-            ]
+        entry_point_test_inputs = get_abi_test_inputs(abi)
 
     print(f"contract {contract_file} entry points: {entry_points}")
     print(
         f"contract {contract_file} entry point test inputs: {entry_point_test_inputs}"
     )
-
-    compiler = WasmRunner(wasm_bytes)
-    for path in Path(user_lib_dir).glob("**/*.py"):
-        pyc_path = path.with_suffix(".pyc")
-        # print(f"compiling {path} to {pyc_path}..")
+    test_runs = get_entry_point_runs(entry_points, entry_point_test_inputs)
+
+    # each of the following stages is cached by a hash of all of its inputs (including the hash of the stage before)
+    with open(stdlib_zip, "rb") as f:
+        stdlib_hash = hashlib.sha256(f.read()).hexdigest()
+    lib_paths = sorted(Path(user_lib_dir).glob("**/*.py"))
+    lib_sources = []
+    for path in lib_paths:
         with open(path, "r") as source_file:
+            lib_sources.append(source_file.read())
+    with open(contract_path, "r") as source_file:
+        contract_source = source_file.read()
+
+    *lib_bytecode, contract_bytecode = compile_to_bytecode_cached(
+        wasm_bytes,
+        stdlib_zip,
+        [(path.name, source_code) for path, source_code in zip(lib_paths, lib_sources)]
+        + [(contract_path.name, contract_source)],
+        cache_path,
+        hash_inputs(wasm_hash, stdlib_hash),
+        refresh=not use_cache,
+        jobs=jobs,
+    )
+    for pyc_path, bytecode in [
+        (path.with_suffix(".pyc"), bytecode)
+        for path, bytecode in zip(lib_paths, lib_bytecode)
+    ] + [(contract_pyc_path, contract_bytecode)]:
+        # unchanged .pyc files are left alone, keeping their mtimes
+        if not pyc_path.exists() or pyc_path.read_bytes() != bytecode:
             with open(pyc_path, "wb") as pyc_file:
-                pyc_file.write(
-                    compile_to_bytecode(
-                        compiler, wasm_data, source_file.read(), path.name
+                pyc_file.write(bytecode)
+
+    # only the binary pipeline's instrumentation marks calls in the coverage bitmap
+    wasm_data = WasmDataStore(coverage_bitmap=pipeline != "text")
+    add_frozen_modules(wasm_data, None, contract_pyc_path, stdlib_zip, user_lib_dir)
+
+    def trace():
+        if pipeline == "text":
+            instrumented_wat = wasm_data.add_to_wat(
+                instrument_wat(
+                    add_contract_entry_points_to_wat(
+                        base_wat,
+                        wasm_data,
+                        CONTRACT_MODULE_PREFIX + contract_pyc_path.stem,
+                        entry_points,
                     )
                 )
-                compiler.reset()
+            )
+            print(f"writing {instrumented_wat_path}..")
+            write_sexp(instrumented_wat, instrumented_wat_path)
 
-    # print(f"compiling {contract_path} to {contract_pyc_path}..")
-    with open(contract_path, "r") as source_file:
-        with open(contract_pyc_path, "wb") as pyc_file:
-            pyc_file.write(
-                compile_to_bytecode(
-                    compiler, wasm_data, source_file.read(), contract_path.name
+            run_tool(
+                "wasm-as",
+                [
+                    "-g",
+                    instrumented_wat_path,
+                    "-o",
+                    instrumented_wasm_path,
+                    "--enable-nontrapping-float-to-int",
+                    "--enable-sign-ext",
+                ],
+            )
+        else:
+            # the contract entry points are added after instrumenting, so that the instrumented base module can be
+            # cached across contracts (entry points themselves are never removal candidates, so need no tracing)
+            instrumented_wasm_bytes = load_cached(
+                cache_path,
+                f"instrumented-v{CACHE_FORMAT_VERSION}-{wasm_hash}",
+                lambda: instrument_module(
+                    module,
+                    WasmDataStore.COVERAGE_BITMAP_ADDR,
+                    WasmDataStore.COVERAGE_BITMAP_SIZE,
+                ).to_bytes(),
+                refresh=not use_cache,
+            )
+            instrumented_module = wasm_data.add_to_module(
+                add_contract_entry_points_to_module(
+                    WasmModule(instrumented_wasm_bytes),
+                    wasm_data,
+                    CONTRACT_MODULE_PREFIX + contract_pyc_path.stem,
+                    entry_points,
                 )
             )
+            print(f"writing {instrumented_wasm_path}..")
+            instrumented_module.write(instrumented_wasm_path)
 
-    wasm_data = WasmDataStore()
-    add_frozen_modules(wasm_data, None, contract_pyc_path, stdlib_zip, user_lib_dir)
+        print(
+            f"tracing called functions and loaded modules in {instrumented_wasm_path}.."
+        )
+        with open(instrumented_wasm_path, "rb") as f:
+            instrumented_wasm_bytes = f.read()
+
+        # not compiled into the cache: the instrumented module changes with the contract
+        trace_runner = WasmRunner(
+            instrumented_wasm_bytes,
+            consume_fuel=True,
+            fuel_limit=fuel_limit,
+            timeout=timeout,
+        )
+        return trace_wasm(
+            trace_runner,
+            entry_points,
+            entry_point_test_inputs,
+            jobs,
+        ) + (trace_runner.fuel_usage, trace_runner.aborted_runs)
+
+    trace_key = trace_stage_key(
+        wasm_hash,
+        pipeline,
+        binaryen_version,
+        wasm_data.to_bytes(),
+        contract_pyc_path.stem,
+        test_runs,
+        fuel_limit,
+        timeout,
+    )
+    (
+        called_function_name_hashes,
+        loaded_frozen_modules,
+        loaded_builtin_modules,
+        trace_fuel_usage,
+        aborted_runs,
+    ) = load_cached(cache_path, trace_key, trace, refresh=not use_cache)
+    print(f"loaded builtin modules: {loaded_builtin_modules}")
+    print(f"loaded frozen modules: {loaded_frozen_modules}")
+    for entry_point, input_bytes, reason in aborted_runs:
+        print(
+            f"warning: tracing {entry_point}({input_bytes}) aborted ({reason} limit), only its coverage up to then is included"
+        )
 
-    instrumented_wat = wasm_data.add_to_wat(
-        instrument_wat(
-            add_contract_entry_points_to_wat(
-                wat,
+    if profile:
+        # every call has to reach the host to be counted, so profiling needs its own (unguarded) instrumentation
+        print("profiling function calls..")
+        profiled_module = wasm_data.add_to_module(
+            add_contract_entry_points_to_module(
+                instrument_module(WasmModule(wasm_bytes)),
                 wasm_data,
                 CONTRACT_MODULE_PREFIX + contract_pyc_path.stem,
                 entry_points,
             )
         )
-    )
-    print(f"writing {instrumented_wat_path}..")
-    write_sexp(instrumented_wat, instrumented_wat_path)
-
-    run_tool(
-        "wasm-as",
-        [
-            "-g",
-            instrumented_wat_path,
-            "-o",
-            instrumented_wasm_path,
-            "--enable-nontrapping-float-to-int",
-            "--enable-sign-ext",
-        ],
-    )
-
-    print(f"tracing called functions and loaded modules in {instrumented_wasm_path}..")
-    with open(instrumented_wasm_path, "rb") as f:
-        instrumented_wasm_bytes = f.read()
-
-    called_function_name_hashes, loaded_frozen_modules, loaded_builtin_modules = (
-        trace_wasm(
-            WasmRunner(instrumented_wasm_bytes), entry_points, entry_point_test_inputs
+        write_call_count_profile(
+            profile_wasm(
+                WasmRunner(
+                    profiled_module.to_bytes(),
+                    count_calls=True,
+                    fuel_limit=fuel_limit,
+                    timeout=timeout,
+                ),
+                entry_points,
+                entry_point_test_inputs,
+            ),
+            function_names,
+            build_path / "profile.json",
+            build_path / "profile.csv",
         )
-    )
-    print(f"loaded builtin modules: {loaded_builtin_modules}")
-    print(f"loaded frozen modules: {loaded_frozen_modules}")
-
-    pinned_function_names = set(DEFAULT_PINNED_FUNCTIONS + pinned_functions)
 
-    if function_opt in ("safe", "safest"):
-        pinned_function_names.update(SAFE_PINNED_FUNCTIONS)
-
-    pinned_function_name_hashes = set()
-    pinned_function_name_hashes = pinned_function_name_hashes.union(
-        {fnv1a_32(s.strip()) for s in pinned_function_names}
+    modified_wat_path = build_path / "python-modified.wat"
+    modified_wasm_path = build_path / "python-modified.wasm"
+    optimized_wasm_path = build_path / "python-optimized.wasm"
+    optimized_wat_path = build_path / "python-optimized.wat"
+    compressed_optimized_wasm_path = build_path / "python-compressed.wasm"
+    compressed_optimized_wat_path = build_path / "python-compressed.wat"
+    final_wasm_path = (
+        compressed_optimized_wasm_path if compression else optimized_wasm_path
     )
-    unreferenced_function_name_hashes = function_name_hashes.difference(
-        called_function_name_hashes
-    ).difference(pinned_function_name_hashes)
-    non_loaded_builtin_modules_removable_function_name_prefixes = [
-        v
-        for module, prefixes in BUILTIN_MODULE_FUNCTION_NAME_PREFIXES.items()
-        for v in prefixes
-        if module not in loaded_builtin_modules
-    ]
 
-    def removing_function_allowed(func_name):
-        if function_opt in ("aggressive", "safe"):
-            return True
-        elif function_opt == "safest":
-            for prefix in (
-                SAFELY_REMOVABLE_FUNCTION_NAME_PREFIXES
-                + non_loaded_builtin_modules_removable_function_name_prefixes
-            ):
-                if func_name.startswith(prefix):
-                    return True
-            for suffix in SAFELY_REMOVABLE_FUNCTION_NAME_SUFFIXES:
-                if func_name.endswith(suffix):
-                    return True
-        return False
+    def optimize():
+        # the functions are removed in place, which the resident base WAT must not be
+        wat = base_wat.copy() if pipeline == "text" else None
+        pinned_function_names = set(DEFAULT_PINNED_FUNCTIONS + pinned_functions)
 
-    wasm_data = WasmDataStore()
+        if function_opt in ("safe", "safest"):
+            pinned_function_names.update(SAFE_PINNED_FUNCTIONS)
 
-    def replace_removed_function_calls(items):
-        for item in items:
-            if isinstance(item, list):
-                if len(item) > 1 and item[0] == "call":
-                    func_name = str(item[1]).lstrip("$")
-                    if (
-                        fnv1a_32(func_name) in unreferenced_function_name_hashes
-                        and removing_function_allowed(func_name)
-                    ):
-                        # print(f"optimizing out {func_name}")
-                        del item[0:]
-                        item += [
-                            "block",
-                            [
-                                "call",
-                                "$optimized_out_function_panic_handler",
-                                ["i32.const", wasm_data.allocate_string(func_name)],
-                            ],
-                            ["unreachable"],
-                        ]
-                else:
-                    replace_removed_function_calls(item)
-
-    if function_opt != "off":
-        removed_function_names = set()
-        for item in wat:
-            if item[0] == "func":
-                replace_removed_function_calls(item)
-                func_name = str(item[1]).lstrip("$")
-                if fnv1a_32(
+        pinned_function_name_hashes = set()
+        pinned_function_name_hashes = pinned_function_name_hashes.union(
+            {fnv1a_32(s.strip()) for s in pinned_function_names}
+        )
+        unreferenced_function_name_hashes = function_name_hashes.difference(
+            called_function_name_hashes
+        ).difference(pinned_function_name_hashes)
+        non_loaded_builtin_modules_removable_function_name_prefixes = [
+            v
+            for module, prefixes in BUILTIN_MODULE_FUNCTION_NAME_PREFIXES.items()
+            for v in prefixes
+            if module not in loaded_builtin_modules
+        ]
+
+        def removing_function_allowed(func_name):
+            if function_opt in ("aggressive", "safe"):
+                return True
+            elif function_opt == "safest":
+                for prefix in (
+                    SAFELY_REMOVABLE_FUNCTION_NAME_PREFIXES
+                    + non_loaded_builtin_modules_removable_function_name_prefixes
+                ):
+                    if func_name.startswith(prefix):
+                        return True
+                for suffix in SAFELY_REMOVABLE_FUNCTION_NAME_SUFFIXES:
+                    if func_name.endswith(suffix):
+                        return True
+            return False
+
+        removable_functions = {}
+
+        def function_removable(func_name):
+            removable = removable_functions.get(func_name)
+            if removable is None:
+                removable = removable_functions[func_name] = fnv1a_32(
                     func_name
                 ) in unreferenced_function_name_hashes and removing_function_allowed(
                     func_name
+                )
+            return removable
+
+        wasm_data = WasmDataStore()
+
+        def replace_removed_function_calls(func: SexpTree):
+            # pre-order walk over the func body, not descending into call operands
+            stack = [func.first_child[func.root]]
+            while stack:
+                item = stack.pop()
+                if item < 0:
+                    continue
+                stack.append(func.next_sibling[item])
+                if not func.is_list(item):
+                    continue
+                if (
+                    func.head(item) == "call"
+                    and func.next_sibling[func.first_child[item]] >= 0
                 ):
-                    removed_function_names.add(func_name)
-                    pos = 2
-                    for func_item in item[2:]:
-                        if func_item[0] not in ("param", "result", "local"):
-                            break
-                        pos += 1
-                    item.insert(pos, ["unreachable"])
-                    del item[pos + 1 :]
-
-        with open(build_path / "removed_functions.txt", "w") as f:
-            for fn in sorted(removed_function_names):
-                f.write(f"{fn}\n")
-
-        with open(build_path / "retained_functions.txt", "w") as f:
-            for fn in sorted(function_names):
-                if fn not in removed_function_names:
-                    f.write(f"{fn}\n")
+                    func_name = func.atom(func.child(item, 1)).lstrip("$")
+                    if function_removable(func_name):
+                        # print(f"optimizing out {func_name}")
+                        func.set_children(
+                            item,
+                            [
+                                func.build("block"),
+                                func.build(
+                                    [
+                                        "call",
+                                        "$optimized_out_function_panic_handler",
+                                        [
+                                            "i32.const",
+                                            wasm_data.allocate_string(func_name),
+                                        ],
+                                    ]
+                                ),
+                                func.build(["unreachable"]),
+                            ],
+                        )
+                else:
+                    stack.append(func.first_child[item])
+
+        removed_function_names = None
+        if function_opt != "off":
+            removed_function_names = set()
+            if pipeline == "text":
+                for form in wat.forms:
+                    if form.kind == "func":
+                        # only parse the funcs which call any of the removed functions
+                        if any(
+                            function_removable(name.decode("ascii"))
+                            for name in _WAT_CALL_RE.findall(
+                                wat.data, form.start, form.stop
+                            )
+                        ):
+                            replace_removed_function_calls(wat.tree(form))
+                        func_name = form.name.lstrip("$")
+                        if function_removable(func_name):
+                            removed_function_names.add(func_name)
+                            body_offset = wat.function_body_offset(form)
+                            wat.replace(
+                                form,
+                                wat.data[form.start : body_offset].decode("ascii")
+                                + " (unreachable))",
+                            )
+            else:
+                removed_function_names = remove_module_functions(
+                    module, function_removable, wasm_data
+                )
 
-    add_frozen_modules(
-        wasm_data,
-        loaded_frozen_modules if module_opt else None,
-        contract_pyc_path,
-        stdlib_zip,
-        user_lib_dir,
-    )
-    modified_wat = wasm_data.add_to_wat(
-        add_contract_entry_points_to_wat(
-            wat,
+        add_frozen_modules(
             wasm_data,
-            CONTRACT_MODULE_PREFIX + contract_pyc_path.stem,
-            entry_points,
+            loaded_frozen_modules if module_opt else None,
+            contract_pyc_path,
+            stdlib_zip,
+            user_lib_dir,
         )
-    )
 
-    modified_wat_path = build_path / "python-modified.wat"
-    optimized_wasm_path = build_path / "python-optimized.wasm"
-    optimized_wat_path = build_path / "python-optimized.wat"
-    compressed_optimized_wasm_path = build_path / "python-compressed.wasm"
-    compressed_optimized_wat_path = build_path / "python-compressed.wat"
-
-    print(f"writing {modified_wat_path}..")
-    write_sexp(modified_wat, modified_wat_path)
-
-    run_tool(
-        "wasm-opt",
-        [
-            "-Oz",
-            modified_wat_path,
-            "-o",
-            optimized_wasm_path,
-            "--enable-nontrapping-float-to-int",
-            "--enable-sign-ext",
-        ]
-        + (["-g"] if debug_info else []),
-    )
-
-    run_tool("wasm-dis", [optimized_wasm_path, "-o", optimized_wat_path])
-    print(f"reading {optimized_wat_path}..")
-    optimized_wat = read_sexp(optimized_wat_path)
+        if pipeline == "text":
+            modified_wat = wasm_data.add_to_wat(
+                add_contract_entry_points_to_wat(
+                    wat,
+                    wasm_data,
+                    CONTRACT_MODULE_PREFIX + contract_pyc_path.stem,
+                    entry_points,
+                )
+            )
+            print(f"writing {modified_wat_path}..")
+            write_sexp(modified_wat, modified_wat_path)
+        else:
+            modified_module = wasm_data.add_to_module(
+                add_contract_entry_points_to_module(
+                    module,
+                    wasm_data,
+                    CONTRACT_MODULE_PREFIX + contract_pyc_path.stem,
+                    entry_points,
+                )
+            )
+            print(f"writing {modified_wasm_path}..")
+            modified_module.write(modified_wasm_path)
 
-    if compression:
-        compressed_optimized_wat = compress_wasm_data_initializer(optimized_wat)
-        print(f"writing {compressed_optimized_wat_path}..")
-        write_sexp(compressed_optimized_wat, compressed_optimized_wat_path)
         run_tool(
-            "wasm-as",
+            "wasm-opt",
             [
-                compressed_optimized_wat_path,
+                "-Oz",
+                modified_wat_path if pipeline == "text" else modified_wasm_path,
                 "-o",
-                compressed_optimized_wasm_path,
+                optimized_wasm_path,
                 "--enable-nontrapping-float-to-int",
                 "--enable-sign-ext",
             ]
             + (["-g"] if debug_info else []),
         )
 
-    final_wasm_path = (
-        compressed_optimized_wasm_path if compression else optimized_wasm_path
+        if compression and pipeline == "text":
+            run_tool("wasm-dis", [optimized_wasm_path, "-o", optimized_wat_path])
+            print(f"reading {optimized_wat_path}..")
+            optimized_wat = read_wat_index(optimized_wat_path, jobs)
+            compressed_optimized_wat = compress_wasm_data_initializer(optimized_wat)
+            print(f"writing {compressed_optimized_wat_path}..")
+            write_sexp(compressed_optimized_wat, compressed_optimized_wat_path)
+            run_tool(
+                "wasm-as",
+                [
+                    compressed_optimized_wat_path,
+                    "-o",
+                    compressed_optimized_wasm_path,
+                    "--enable-nontrapping-float-to-int",
+                    "--enable-sign-ext",
+                ]
+                + (["-g"] if debug_info else []),
+            )
+        elif compression:
+            compressed_optimized_module = compress_module_data_initializer(
+                WasmModule.read(optimized_wasm_path)
+            )
+            print(f"writing {compressed_optimized_wasm_path}..")
+            compressed_optimized_module.write(compressed_optimized_wasm_path)
+
+        with open(final_wasm_path, "rb") as f:
+            return f.read(), removed_function_names
+
+    optimized_wasm_bytes, removed_function_names = load_cached(
+        cache_path,
+        optimize_stage_key(
+            trace_key,
+            module_opt,
+            function_opt,
+            pinned_functions,
+            compression,
+            debug_info,
+            get_tool_version("wasm-opt"),
+        ),
+        optimize,
+        refresh=not use_cache,
     )
+    with open(final_wasm_path, "wb") as f:
+        f.write(optimized_wasm_bytes)
+
+    if removed_function_names is not None:
+        with open(build_path / "removed_functions.txt", "w") as f:
+            for fn in sorted(removed_function_names):
+                f.write(f"{fn}\n")
 
+        with open(build_path / "retained_functions.txt", "w") as f:
+            for fn in sorted(function_names):
+                if fn not in removed_function_names:
+                    f.write(f"{fn}\n")
+
+    fuel_usages = {"instrumented": trace_fuel_usage}
     if verify_optimized_wasm:
-        with open(final_wasm_path, "rb") as f:
-            wasm_bytes = f.read()
-        print(
-            f"verifying optimized WASM at {final_wasm_path} ({len(wasm_bytes)} bytes).."
+
+        def verify():
+            print(
+                f"verifying optimized WASM at {final_wasm_path} ({len(optimized_wasm_bytes)} bytes).."
+            )
+            verify_runner = WasmRunner(
+                optimized_wasm_bytes,
+                consume_fuel=True,
+                fuel_limit=fuel_limit,
+                timeout=timeout,
+            )
+            trace_wasm(verify_runner, entry_points, entry_point_test_inputs, jobs)
+            return verify_runner.fuel_usage
+
+        fuel_usages["optimized"] = load_cached(
+            cache_path,
+            verify_stage_key(optimized_wasm_bytes, test_runs, fuel_limit, timeout),
+            verify,
+            refresh=not use_cache,
         )
-        trace_wasm(WasmRunner(wasm_bytes), entry_points, entry_point_test_inputs)
+    write_fuel_report(fuel_usages, build_path / "fuel.json")
 
     print(f"copying optimized WASM to {Path(output_file).absolute()}")
     shutil.copy(final_wasm_path, Path(output_file).absolute())
+    return {"size": len(optimized_wasm_bytes), "fuel_usages": fuel_usages}
+
+
+def get_watched_sources(contract_file, user_lib_dir) -> dict:
+    "Returns the (mtime, size) of the contract file and the .py files in user_lib_dir, by path"
+    sources = {}
+    for path in [Path(contract_file)] + sorted(Path(user_lib_dir).glob("**/*.py")):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        sources[str(path)] = (stat.st_mtime_ns, stat.st_size)
+    return sources
+
+
+def print_build_changes(previous: dict, current: dict):
+    "Prints the output size and per-method fuel changes between two optimize_wasm_file() results"
+    print(
+        f"output size: {previous['size']} -> {current['size']} bytes ({current['size'] - previous['size']:+})"
+    )
+    # the fuel of the optimized WASM if verified, otherwise of the instrumented one
+    label = list(current["fuel_usages"].keys())[-1]
+    fuel = [Counter(), Counter()]
+    for method_fuel, result in zip(fuel, [previous, current]):
+        for entry_point, _, run_fuel, aborted in result["fuel_usages"].get(label, []):
+            if aborted is None:
+                method_fuel[entry_point] += run_fuel
+    print(f"{label} fuel consumed per method (all test inputs):")
+    print(f"  {'method':<32} {'before':>14} {'after':>14} {'change':>8}")
+    for entry_point in sorted(set(fuel[0]) | set(fuel[1])):
+        before, after = fuel[0].get(entry_point), fuel[1].get(entry_point)
+        change = f" {(after / before - 1) * 100:>+7.1f}%" if before and after else ""
+        print(
+            f"  {entry_point:<32} {before if before is not None else '-':>14} {after if after is not None else '-':>14}"
+            + change
+        )
+
+
+def watch_wasm_file(
+    contract_file="contract.py", user_lib_dir="lib", poll_interval=0.5, **build_options
+):
+    """Builds like optimize_wasm_file(contract_file=..., user_lib_dir=..., **build_options), then rebuilds whenever
+    the contract file or a .py file in the user lib directory changes, until interrupted. Compiled wasmtime modules,
+    the compiler runner, the stdlib and the cached stage results stay resident between builds, and unchanged stages
+    are reused (see load_cached()).
+    """
+    previous_result = None
+    while True:
+        sources = get_watched_sources(contract_file, user_lib_dir)
+        start_time = time.perf_counter()
+        try:
+            result = optimize_wasm_file(
+                contract_file=contract_file, user_lib_dir=user_lib_dir, **build_options
+            )
+        # failures caused by the sources being edited (missing files, contracts which don't compile or trap in
+        # tracing, failing binaryen tools, frozen data overflowing its area), to be retried after the next change
+        except (
+            OSError,
+            SyntaxError,
+            ValueError,
+            IndexError,
+            AssertionError,
+            subprocess.CalledProcessError,
+            wasmtime.WasmtimeError,
+        ) as e:
+            print(f"build failed: {e!r}")
+        else:
+            print(f"built in {time.perf_counter() - start_time:.2f} s")
+            if previous_result is not None:
+                print_build_changes(previous_result, result)
+            previous_result = result
+        print(f"watching {contract_file} and {user_lib_dir} for changes..")
+        while get_watched_sources(contract_file, user_lib_dir) == sources:
+            time.sleep(poll_interval)
@@ -0,0 +1,920 @@
+"""Minimal in-process WASM binary module model
+
+Supports exactly the structural edits the optimizer needs (adding imports/functions/exports/data segments,
+prepending instructions to function bodies and replacing them), so that no wasm-dis/wasm-as text round trip
+is necessary. Sections which are not edited are written back byte-for-byte.
+"""
+
+import re
+from copy import copy
+
+WASM_MAGIC = b"\0asm\1\0\0\0"
+
+SECTION_CUSTOM = 0
+SECTION_TYPE = 1
+SECTION_IMPORT = 2
+SECTION_FUNCTION = 3
+SECTION_TABLE = 4
+SECTION_MEMORY = 5
+SECTION_GLOBAL = 6
+SECTION_EXPORT = 7
+SECTION_START = 8
+SECTION_ELEMENT = 9
+SECTION_CODE = 10
+SECTION_DATA = 11
+SECTION_DATA_COUNT = 12
+SECTION_TAG = 13
+
+# canonical order of the non-custom sections
+SECTION_ORDER = [1, 2, 3, 4, 5, 13, 6, 7, 8, 9, 12, 10, 11]
+
+EXTERNAL_FUNC = 0
+EXTERNAL_TABLE = 1
+EXTERNAL_MEMORY = 2
+EXTERNAL_GLOBAL = 3
+
+I32 = 0x7F
+I64 = 0x7E
+F32 = 0x7D
+F64 = 0x7C
+
+NAME_SUBSECTION_MODULE = 0
+NAME_SUBSECTION_FUNCTION = 1
+NAME_SUBSECTION_LOCAL = 2
+NAME_SUBSECTION_LABEL = 3
+NAME_SUBSECTION_DATA = 9
+
+OP_UNREACHABLE = b"\x00"
+OP_END = b"\x0b"
+
+
+def encode_uleb128(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def encode_sleb128(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def decode_uleb128(data, pos: int):
+    "Returns (value, position after the encoded value)"
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def decode_sleb128(data, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return result, pos
+
+
+def encode_name(name: str) -> bytes:
+    name_bytes = name.encode("utf-8")
+    return encode_uleb128(len(name_bytes)) + name_bytes
+
+
+def decode_name(data, pos: int):
+    length, pos = decode_uleb128(data, pos)
+    return bytes(data[pos : pos + length]).decode("utf-8"), pos + length
+
+
+def encode_vector(items) -> bytes:
+    items = list(items)
+    return encode_uleb128(len(items)) + b"".join(items)
+
+
+def encode_func_type(params, results) -> bytes:
+    return (
+        b"\x60"
+        + encode_vector(bytes([t]) for t in params)
+        + encode_vector(bytes([t]) for t in results)
+    )
+
+
+def op_i32_const(value: int) -> bytes:
+    "Encodes i32.const, accepting both signed and unsigned 32-bit values"
+    return b"\x41" + encode_sleb128((value + 0x80000000) % 0x100000000 - 0x80000000)
+
+
+def op_call(func_index: int) -> bytes:
+    return b"\x10" + encode_uleb128(func_index)
+
+
+def op_local_get(local_index: int) -> bytes:
+    return b"\x20" + encode_uleb128(local_index)
+
+
+def op_i32_store8(offset: int) -> bytes:
+    return b"\x3a\x00" + encode_uleb128(offset)
+
+
+# instruction immediate kinds
+_IMM_NONE = 0
+_IMM_LEB = 1  # a single (u32, s32 or s64) LEB128 value
+_IMM_LEB2 = 2
+_IMM_BLOCK = 3
+_IMM_END = 4
+_IMM_FUNC = 5
+_IMM_BR_TABLE = 6
+_IMM_MEMARG = 7
+_IMM_BYTES4 = 8
+_IMM_BYTES8 = 9
+_IMM_SELECT_T = 10
+_IMM_PREFIX_FC = 11
+_IMM_PREFIX_FE = 12
+_IMM_INVALID = 13
+
+_OPCODE_IMMEDIATES = [_IMM_INVALID] * 256
+for _op in (0x00, 0x01, 0x05, 0x0F, 0x1A, 0x1B, 0xD1):
+    _OPCODE_IMMEDIATES[_op] = _IMM_NONE
+for _op in range(0x45, 0xC5):  # numeric instructions (including sign-extension ops)
+    _OPCODE_IMMEDIATES[_op] = _IMM_NONE
+for _op in (0x02, 0x03, 0x04):  # block, loop, if
+    _OPCODE_IMMEDIATES[_op] = _IMM_BLOCK
+# br, br_if, local.get/set/tee, global.get/set, table.get/set, memory.size/grow, i32/i64.const, ref.null
+for _op in (0x0C, 0x0D, 0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x3F, 0x40):
+    _OPCODE_IMMEDIATES[_op] = _IMM_LEB
+for _op in (0x41, 0x42, 0xD0):
+    _OPCODE_IMMEDIATES[_op] = _IMM_LEB
+for _op in (0x11, 0x13):  # call_indirect, return_call_indirect
+    _OPCODE_IMMEDIATES[_op] = _IMM_LEB2
+for _op in (0x10, 0x12, 0xD2):  # call, return_call, ref.func
+    _OPCODE_IMMEDIATES[_op] = _IMM_FUNC
+for _op in range(0x28, 0x3F):  # loads and stores
+    _OPCODE_IMMEDIATES[_op] = _IMM_MEMARG
+_OPCODE_IMMEDIATES[0x0B] = _IMM_END
+_OPCODE_IMMEDIATES[0x0E] = _IMM_BR_TABLE
+_OPCODE_IMMEDIATES[0x1C] = _IMM_SELECT_T
+_OPCODE_IMMEDIATES[0x43] = _IMM_BYTES4
+_OPCODE_IMMEDIATES[0x44] = _IMM_BYTES8
+_OPCODE_IMMEDIATES[0xFC] = _IMM_PREFIX_FC
+_OPCODE_IMMEDIATES[0xFE] = _IMM_PREFIX_FE
+
+# 0xFC-prefixed (saturating truncation, bulk memory, table) instruction immediate counts, by sub-opcode
+_PREFIX_FC_LEB_COUNTS = [0, 0, 0, 0, 0, 0, 0, 0, 2, 1, 2, 1, 2, 1, 2, 1, 1, 1]
+
+_FUNC_REFERENCE_OPCODES = frozenset((0x10, 0x12, 0xD2))  # call, return_call, ref.func
+_BLOCK_TYPE_BYTES = frozenset((0x40, 0x7F, 0x7E, 0x7D, 0x7C, 0x7B, 0x70, 0x6F))
+
+
+def _skip_leb(data, pos: int) -> int:
+    while data[pos] & 0x80:
+        pos += 1
+    return pos + 1
+
+
+def _skip_locals(body) -> int:
+    count, pos = decode_uleb128(body, 0)
+    for _ in range(count):
+        pos = _skip_leb(body, pos)
+        if body[pos] in (0x63, 0x64):  # (ref null? heaptype)
+            pos = _skip_leb(body, pos + 1)
+        else:
+            pos += 1
+    return pos
+
+
+def _skip_instruction(data, pos: int):
+    "Returns (position after the instruction at pos, its function index immediate or None)"
+    op = data[pos]
+    pos += 1
+    kind = _OPCODE_IMMEDIATES[op]
+    if kind == _IMM_NONE or kind == _IMM_END:
+        pass
+    elif kind == _IMM_LEB:
+        pos = _skip_leb(data, pos)
+    elif kind == _IMM_MEMARG:
+        align, pos = decode_uleb128(data, pos)
+        if align & 0x40:  # multi-memory: explicit memory index
+            pos = _skip_leb(data, pos)
+        pos = _skip_leb(data, pos)
+    elif kind == _IMM_BLOCK:
+        if data[pos] in _BLOCK_TYPE_BYTES:
+            pos += 1
+        else:
+            pos = _skip_leb(data, pos)
+    elif kind == _IMM_FUNC:
+        return decode_uleb128(data, pos)[::-1]
+    elif kind == _IMM_LEB2:
+        pos = _skip_leb(data, _skip_leb(data, pos))
+    elif kind == _IMM_BR_TABLE:
+        count, pos = decode_uleb128(data, pos)
+        for _ in range(count + 1):
+            pos = _skip_leb(data, pos)
+    elif kind == _IMM_BYTES4:
+        pos += 4
+    elif kind == _IMM_BYTES8:
+        pos += 8
+    elif kind == _IMM_SELECT_T:
+        count, pos = decode_uleb128(data, pos)
+        pos += count
+    elif kind == _IMM_PREFIX_FC:
+        sub_op, pos = decode_uleb128(data, pos)
+        if sub_op >= len(_PREFIX_FC_LEB_COUNTS):
+            raise ValueError(f"unsupported instruction 0xfc {sub_op} at {pos}")
+        for _ in range(_PREFIX_FC_LEB_COUNTS[sub_op]):
+            pos = _skip_leb(data, pos)
+    elif kind == _IMM_PREFIX_FE:
+        sub_op, pos = decode_uleb128(data, pos)
+        if sub_op == 0x03:  # atomic.fence
+            pos += 1
+        else:
+            pos = _skip_leb(data, _skip_leb(data, pos))
+    elif op == 0xFD:
+        raise ValueError(f"unsupported SIMD (0xfd prefixed) instruction at {pos - 1}")
+    else:
+        raise ValueError(f"unsupported instruction 0x{op:02x} at {pos - 1}")
+    return pos, None
+
+
+# A run of instructions which neither have function index immediates nor variable-length immediate lists, matched
+# in one go: the same encodings as _skip_instruction() (with single byte sub-opcodes), minus call/return_call/ref.func,
+# br_table and select t*, which end the run.
+_LEB = rb"[\x80-\xff]*[\x00-\x7f]"
+_SIMPLE_INSTRUCTIONS_RE = re.compile(
+    rb"(?:"
+    + rb"|".join(
+        [
+            rb"[\x00\x01\x05\x0b\x0f\x1a\x1b\xd1\x45-\xc4]",
+            rb"[\x0c\x0d\x20-\x26\x3f-\x42\xd0]" + _LEB,
+            rb"[\x11\x13]" + _LEB + _LEB,
+            rb"[\x02-\x04](?:[\x40\x6f\x70\x7b-\x7f]|" + _LEB + rb")",
+            rb"[\x28-\x3e](?:[\x00-\x3f]|[\x40-\x7f]" + _LEB + rb")" + _LEB,
+            rb"\x43[\s\S]{4}",
+            rb"\x44[\s\S]{8}",
+            rb"\xfc[\x00-\x07]",
+            rb"\xfc[\x09\x0b\x0d\x0f-\x11]" + _LEB,
+            rb"\xfc[\x08\x0a\x0c\x0e]" + _LEB + _LEB,
+            rb"\xfe\x03[\s\S]",
+            rb"\xfe[\x00-\x02\x04-\x7f]" + _LEB + _LEB,
+        ]
+    )
+    + rb")*"
+)
+
+
+def scan_function_references(data, pos: int, end=None):
+    """Walks the instructions of an expression (a function body or a constant expression) starting at pos.
+
+    Returns (refs, end), refs being a list of (start, stop, function index) of every call/return_call/ref.func
+    immediate and end the position right after the expression's final `end` instruction. When the end of the
+    expression is already known (e.g. for function bodies), the instructions in between are matched in runs.
+    """
+    refs = []
+    if end is not None:
+        match_simple_instructions = _SIMPLE_INSTRUCTIONS_RE.match
+        while True:
+            pos = match_simple_instructions(data, pos, end).end()
+            if pos >= end:
+                return refs, end
+            if data[pos] in _FUNC_REFERENCE_OPCODES:
+                func_index, next_pos = decode_uleb128(data, pos + 1)
+                refs.append((pos + 1, next_pos, func_index))
+                pos = next_pos
+                continue
+            next_pos, func_index = _skip_instruction(data, pos)
+            if func_index is not None:
+                refs.append((pos + 1, next_pos, func_index))
+            pos = next_pos
+    depth = 0
+    kinds = _OPCODE_IMMEDIATES
+    while True:
+        op = data[pos]
+        next_pos, func_index = _skip_instruction(data, pos)
+        if func_index is not None:
+            refs.append((pos + 1, next_pos, func_index))
+        elif kinds[op] == _IMM_BLOCK:
+            depth += 1
+        elif kinds[op] == _IMM_END:
+            if depth == 0:
+                return refs, next_pos
+            depth -= 1
+        pos = next_pos
+
+
+def _remap_references(data, start: int, end: int, refs, remap) -> bytes:
+    "Copies data[start:end], re-encoding the function index immediates listed in refs through remap()"
+    parts = []
+    prev = start
+    for ref_start, ref_stop, func_index in refs:
+        parts.append(data[prev:ref_start])
+        parts.append(encode_uleb128(remap(func_index)))
+        prev = ref_stop
+    parts.append(data[prev:end])
+    return b"".join(parts)
+
+
+def _read_name_map(data, pos: int):
+    "Returns ({index: name}, position after the name map)"
+    names = {}
+    count, pos = decode_uleb128(data, pos)
+    for _ in range(count):
+        index, pos = decode_uleb128(data, pos)
+        names[index], pos = decode_name(data, pos)
+    return names, pos
+
+
+def _encode_name_map(names: dict) -> bytes:
+    return encode_vector(
+        encode_uleb128(index) + encode_name(name)
+        for index, name in sorted(names.items())
+    )
+
+
+def _read_indirect_name_map(data, pos: int):
+    "Returns {outer index: raw encoded inner name map}"
+    names = {}
+    count, pos = decode_uleb128(data, pos)
+    for _ in range(count):
+        index, pos = decode_uleb128(data, pos)
+        start = pos
+        inner_count, pos = decode_uleb128(data, pos)
+        for _ in range(inner_count):
+            pos = _skip_leb(data, pos)
+            name_length, pos = decode_uleb128(data, pos)
+            pos += name_length
+        names[index] = bytes(data[start:pos])
+    return names
+
+
+def _encode_indirect_name_map(names: dict) -> bytes:
+    return encode_vector(
+        encode_uleb128(index) + inner for index, inner in sorted(names.items())
+    )
+
+
+class WasmModule:
+    """WASM binary module split into sections, with the ones needed for editing decoded on demand.
+
+    Function indices follow the WASM index space: imported functions first, then the defined ones, whose
+    bodies (local declarations + instructions, without the size prefix) are kept as separate bytes objects.
+    """
+
+    def __init__(self, data: bytes):
+        if data[:8] != WASM_MAGIC:
+            raise ValueError("Not a WASM binary module (version 1)")
+        self.sections = []  # [section id, payload] in file order, payload None for decoded sections
+        # decoded section ids (or "name") to be re-encoded when writing
+        self.dirty = set()
+        pos = 8
+        while pos < len(data):
+            section_id = data[pos]
+            size, pos = decode_uleb128(data, pos + 1)
+            self.sections.append([section_id, data[pos : pos + size]])
+            pos += size
+        self._types = None
+        self._imports = None
+        self._functions = None
+        self._exports = None
+        self._bodies = None
+        self._data_segments = None
+        self._names = None
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename, "rb") as f:
+            return cls(f.read())
+
+    def copy(self):
+        "Copies the module structure, sharing the immutable bytes of section payloads, bodies, segments etc."
+        module = copy(self)
+        module.sections = [section.copy() for section in self.sections]
+        module.dirty = self.dirty.copy()
+        for attr in ("_types", "_functions", "_bodies"):
+            if getattr(self, attr) is not None:
+                setattr(module, attr, getattr(self, attr).copy())
+        for attr in ("_imports", "_exports", "_data_segments"):
+            if getattr(self, attr) is not None:
+                setattr(module, attr, [item.copy() for item in getattr(self, attr)])
+        if self._names is not None:
+            module._names = {
+                subsection_id: value.copy() if isinstance(value, dict) else value
+                for subsection_id, value in self._names.items()
+            }
+        return module
+
+    def section(self, section_id):
+        for section in self.sections:
+            if section[0] == section_id:
+                return section[1]
+        return None
+
+    def custom_section(self, name):
+        for section_id, payload in self.sections:
+            if section_id == SECTION_CUSTOM:
+                section_name, pos = decode_name(payload, 0)
+                if section_name == name:
+                    return payload, pos
+        return None, 0
+
+    # decoded section accessors
+
+    @property
+    def types(self):
+        "Raw encoded function types (0x60 params results)"
+        if self._types is None:
+            self._types = []
+            data = self.section(SECTION_TYPE) or b"\0"
+            count, pos = decode_uleb128(data, 0)
+            for _ in range(count):
+                if data[pos] != 0x60:
+                    raise ValueError(
+                        f"unsupported type section entry 0x{data[pos]:02x}"
+                    )
+                start = pos
+                params, pos = decode_uleb128(data, pos + 1)
+                results, pos = decode_uleb128(data, pos + params)
+                pos += results
+                self._types.append(bytes(data[start:pos]))
+        return self._types
+
+    @property
+    def imports(self):
+        "List of [module, name, external kind, raw encoded import description]"
+        if self._imports is None:
+            self._imports = []
+            data = self.section(SECTION_IMPORT) or b"\0"
+            count, pos = decode_uleb128(data, 0)
+            for _ in range(count):
+                module, pos = decode_name(data, pos)
+                name, pos = decode_name(data, pos)
+                kind = data[pos]
+                start = pos + 1
+                if kind == EXTERNAL_FUNC:
+                    pos = _skip_leb(data, start)
+                elif kind == EXTERNAL_TABLE:
+                    pos = self._skip_limits(data, start + 1)
+                elif kind == EXTERNAL_MEMORY:
+                    pos = self._skip_limits(data, start)
+                elif kind == EXTERNAL_GLOBAL:
+                    pos = start + 2
+                else:
+                    raise ValueError(f"unsupported import kind {kind}")
+                self._imports.append([module, name, kind, bytes(data[start:pos])])
+        return self._imports
+
+    @staticmethod
+    def _skip_limits(data, pos: int) -> int:
+        flags = data[pos]
+        pos = _skip_leb(data, pos + 1)
+        return _skip_leb(data, pos) if flags & 1 else pos
+
+    @property
+    def num_func_imports(self) -> int:
+        return sum(1 for imp in self.imports if imp[2] == EXTERNAL_FUNC)
+
+    @property
+    def functions(self):
+        "Type indices of the defined functions"
+        if self._functions is None:
+            data = self.section(SECTION_FUNCTION) or b"\0"
+            count, pos = decode_uleb128(data, 0)
+            self._functions = []
+            for _ in range(count):
+                type_index, pos = decode_uleb128(data, pos)
+                self._functions.append(type_index)
+        return self._functions
+
+    @property
+    def bodies(self):
+        "Bodies of the defined functions"
+        if self._bodies is None:
+            data = self.section(SECTION_CODE) or b"\0"
+            count, pos = decode_uleb128(data, 0)
+            self._bodies = []
+            for _ in range(count):
+                size, pos = decode_uleb128(data, pos)
+                self._bodies.append(bytes(data[pos : pos + size]))
+                pos += size
+        return self._bodies
+
+    @property
+    def exports(self):
+        "List of [name, external kind, index]"
+        if self._exports is None:
+            data = self.section(SECTION_EXPORT) or b"\0"
+            count, pos = decode_uleb128(data, 0)
+            self._exports = []
+            for _ in range(count):
+                name, pos = decode_name(data, pos)
+                kind = data[pos]
+                index, pos = decode_uleb128(data, pos + 1)
+                self._exports.append([name, kind, index])
+        return self._exports
+
+    @property
+    def data_segments(self):
+        "List of [mode flags, memory index, raw offset expression, data, name]"
+        if self._data_segments is None:
+            data = self.section(SECTION_DATA) or b"\0"
+            data_names = self.names.get(NAME_SUBSECTION_DATA, {})
+            count, pos = decode_uleb128(data, 0)
+            self._data_segments = []
+            for i in range(count):
+                flags, pos = decode_uleb128(data, pos)
+                memory_index = 0
+                offset_expr = None
+                if flags == 2:
+                    memory_index, pos = decode_uleb128(data, pos)
+                if flags in (0, 2):
+                    start = pos
+                    _, pos = scan_function_references(data, pos)
+                    offset_expr = bytes(data[start:pos])
+                size, pos = decode_uleb128(data, pos)
+                self._data_segments.append(
+                    [
+                        flags,
+                        memory_index,
+                        offset_expr,
+                        bytes(data[pos : pos + size]),
+                        data_names.get(i),
+                    ]
+                )
+                pos += size
+        return self._data_segments
+
+    @property
+    def names(self):
+        "Name section subsections: {1: function names, 9: data names, ...}, undecoded ones as raw bytes"
+        if self._names is None:
+            self._names = {}
+            data, pos = self.custom_section("name")
+            while data is not None and pos < len(data):
+                subsection_id = data[pos]
+                size, pos = decode_uleb128(data, pos + 1)
+                payload = data[pos : pos + size]
+                if subsection_id in (NAME_SUBSECTION_FUNCTION, NAME_SUBSECTION_DATA):
+                    self._names[subsection_id] = _read_name_map(payload, 0)[0]
+                elif subsection_id in (NAME_SUBSECTION_LOCAL, NAME_SUBSECTION_LABEL):
+                    self._names[subsection_id] = _read_indirect_name_map(payload, 0)
+                else:
+                    self._names[subsection_id] = bytes(payload)
+                pos += size
+        return self._names
+
+    # queries
+
+    def function_name(self, func_index: int) -> str:
+        """Function name as wasm-dis would print it (without the $ prefix). Unnamed defined functions are numbered
+        among the defined functions only, so their names don't change when function imports are added."""
+        name = self.names.get(NAME_SUBSECTION_FUNCTION, {}).get(func_index)
+        if name is not None:
+            return name
+        if func_index < self.num_func_imports:
+            return f"fimport${func_index}"
+        return str(func_index - self.num_func_imports)
+
+    def defined_functions(self):
+        "Yields (function index, function name) for all defined (non-imported) functions"
+        base = self.num_func_imports
+        for i in range(len(self.functions)):
+            yield base + i, self.function_name(base + i)
+
+    def function_index(self, name: str) -> int:
+        for index, func_name in self.names.get(NAME_SUBSECTION_FUNCTION, {}).items():
+            if func_name == name:
+                return index
+        raise KeyError(f"function {name} not found in the WASM name section")
+
+    def body_instructions_offset(self, func_index: int) -> int:
+        "Returns the offset of the first instruction in the function body, right after the local declarations"
+        return _skip_locals(self.bodies[func_index - self.num_func_imports])
+
+    def mutable_globals(self):
+        "Yields the global indices of the mutable defined (non-imported) globals"
+        global_index = sum(1 for imp in self.imports if imp[2] == EXTERNAL_GLOBAL)
+        data = self.section(SECTION_GLOBAL) or b"\0"
+        count, pos = decode_uleb128(data, 0)
+        for _ in range(count):
+            pos = _skip_leb(data, pos + 1) if data[pos] in (0x63, 0x64) else pos + 1
+            if data[pos]:
+                yield global_index
+            _, pos = scan_function_references(data, pos + 1)
+            global_index += 1
+
+    def active_data_segments(self):
+        "Yields (offset, data) of active data segments with constant i32 offsets"
+        for flags, _, offset_expr, data, _ in self.data_segments:
+            if flags == 1:
+                continue
+            if offset_expr[0] != 0x41 or offset_expr[-1] != 0x0B:
+                raise ValueError("unsupported non-constant data segment offset")
+            yield decode_sleb128(offset_expr, 1)[0] & 0xFFFFFFFF, data
+
+    # edits
+
+    def add_type(self, params, results) -> int:
+        "Returns the index of the function type, adding it if necessary"
+        encoded = encode_func_type(params, results)
+        if encoded in self.types:
+            return self.types.index(encoded)
+        self.types.append(encoded)
+        self.dirty.add(SECTION_TYPE)
+        return len(self.types) - 1
+
+    def add_function_imports(self, imports) -> list:
+        """Appends (module, name, params, results) function imports, returns their function indices.
+
+        All references to defined functions get shifted by the number of added imports.
+        """
+        base = self.num_func_imports
+        shift = len(imports)
+        insert_at = max(
+            (i + 1 for i, imp in enumerate(self.imports) if imp[2] == EXTERNAL_FUNC),
+            default=len(self.imports),
+        )
+        for i, (module, name, params, results) in enumerate(imports):
+            type_index = self.add_type(params, results)
+            self.imports.insert(
+                insert_at + i,
+                [module, name, EXTERNAL_FUNC, encode_uleb128(type_index)],
+            )
+        self.dirty.add(SECTION_IMPORT)
+        if self.functions:
+            self._shift_function_indices(base, shift)
+        func_names = self.names.setdefault(NAME_SUBSECTION_FUNCTION, {})
+        for i, (_, name, _, _) in enumerate(imports):
+            func_names[base + i] = name
+        self.dirty.add("name")
+        return list(range(base, base + shift))
+
+    def add_function_import(self, module, name, params, results) -> int:
+        return self.add_function_imports([(module, name, params, results)])[0]
+
+    def _shift_function_indices(self, base: int, shift: int):
+        def remap(func_index):
+            return func_index + shift if func_index >= base else func_index
+
+        for i, body in enumerate(self.bodies):
+            refs, _ = scan_function_references(body, _skip_locals(body), len(body))
+            if refs:
+                self.bodies[i] = _remap_references(body, 0, len(body), refs, remap)
+        self.dirty.add(SECTION_CODE)
+        for export in self.exports:
+            if export[1] == EXTERNAL_FUNC:
+                export[2] = remap(export[2])
+        self.dirty.add(SECTION_EXPORT)
+        start = self.section(SECTION_START)
+        if start is not None:
+            self._set_section(
+                SECTION_START, encode_uleb128(remap(decode_uleb128(start, 0)[0]))
+            )
+        for section_id, remap_section in (
+            (SECTION_GLOBAL, self._remap_global_section),
+            (SECTION_ELEMENT, self._remap_element_section),
+        ):
+            payload = self.section(section_id)
+            if payload is not None:
+                self._set_section(section_id, remap_section(payload, remap))
+        for subsection_id in (
+            NAME_SUBSECTION_FUNCTION,
+            NAME_SUBSECTION_LOCAL,
+            NAME_SUBSECTION_LABEL,
+        ):
+            if subsection_id in self.names:
+                self.names[subsection_id] = {
+                    remap(index): value
+                    for index, value in self.names[subsection_id].items()
+                }
+        self.dirty.add("name")
+
+    @staticmethod
+    def _remap_global_section(data, remap) -> bytes:
+        count, pos = decode_uleb128(data, 0)
+        parts = [data[:pos]]
+        for _ in range(count):
+            start = pos
+            pos = _skip_leb(data, pos + 1) if data[pos] in (0x63, 0x64) else pos + 1
+            refs, pos = scan_function_references(data, pos + 1)  # skip mutability
+            parts.append(_remap_references(data, start, pos, refs, remap))
+        return b"".join(parts)
+
+    @staticmethod
+    def _remap_element_section(data, remap) -> bytes:
+        count, pos = decode_uleb128(data, 0)
+        parts = [data[:pos]]
+        for _ in range(count):
+            start = pos
+            flags, pos = decode_uleb128(data, pos)
+            if flags & 3 == 2:
+                pos = _skip_leb(data, pos)  # table index
+            if not flags & 1:
+                _, pos = scan_function_references(data, pos)  # offset expression
+            if flags & 3:
+                pos += 1  # element kind or reference type
+            parts.append(data[start:pos])
+            items, pos = decode_uleb128(data, pos)
+            parts.append(encode_uleb128(items))
+            for _ in range(items):
+                if flags & 4:
+                    expr_start = pos
+                    refs, pos = scan_function_references(data, pos)
+                    parts.append(_remap_references(data, expr_start, pos, refs, remap))
+                else:
+                    func_index, pos = decode_uleb128(data, pos)
+                    parts.append(encode_uleb128(remap(func_index)))
+        return b"".join(parts)
+
+    def add_function(self, params, results, instructions: bytes, name=None) -> int:
+        "Adds a defined function without locals, instructions excluding the final `end`"
+        self.functions.append(self.add_type(params, results))
+        self.bodies.append(b"\0" + instructions + OP_END)
+        self.dirty.update((SECTION_FUNCTION, SECTION_CODE))
+        func_index = self.num_func_imports + len(self.functions) - 1
+        if name is not None:
+            self.names.setdefault(NAME_SUBSECTION_FUNCTION, {})[func_index] = name
+            self.dirty.add("name")
+        return func_index
+
+    def prepend_to_function(self, func_index: int, instructions: bytes):
+        "Inserts instructions at the function entry (after its local declarations)"
+        i = func_index - self.num_func_imports
+        body = self.bodies[i]
+        pos = _skip_locals(body)
+        self.bodies[i] = body[:pos] + instructions + body[pos:]
+        self.dirty.add(SECTION_CODE)
+
+    def replace_function_body(self, func_index: int, instructions: bytes):
+        "Replaces the locals and instructions of a function, instructions excluding the final `end`"
+        self.bodies[func_index - self.num_func_imports] = b"\0" + instructions + OP_END
+        self.dirty.add(SECTION_CODE)
+        self.names.get(NAME_SUBSECTION_LOCAL, {}).pop(func_index, None)
+        self.names.get(NAME_SUBSECTION_LABEL, {}).pop(func_index, None)
+        self.dirty.add("name")
+
+    def replace_calls(self, func_index: int, replace) -> int:
+        """Replaces the call/return_call instructions of a function body by the instructions returned by
+        replace(callee function index), unless it returns None. Returns the number of replaced calls.
+        """
+        i = func_index - self.num_func_imports
+        body = self.bodies[i]
+        refs, _ = scan_function_references(body, _skip_locals(body), len(body))
+        parts = []
+        prev = 0
+        for start, stop, callee in refs:
+            if body[start - 1] not in (0x10, 0x12):  # ref.func
+                continue
+            instructions = replace(callee)
+            if instructions is not None:
+                parts.append(body[prev : start - 1])
+                parts.append(instructions)
+                prev = stop
+        if parts:
+            parts.append(body[prev:])
+            self.bodies[i] = b"".join(parts)
+            self.dirty.add(SECTION_CODE)
+        return len(parts) // 2
+
+    def add_export(self, name: str, kind: int, index: int):
+        self.exports.append([name, kind, index])
+        self.dirty.add(SECTION_EXPORT)
+
+    def add_custom_section(self, name: str, payload: bytes):
+        self.sections.append([SECTION_CUSTOM, encode_name(name) + payload])
+
+    def add_data_segment(self, offset: int, data: bytes, name=None):
+        "Adds an active data segment for memory 0 at a constant offset"
+        self.data_segments.append([0, 0, op_i32_const(offset) + OP_END, data, name])
+        self.dirty.add(SECTION_DATA)
+
+    def remove_data_segments(self):
+        self.data_segments.clear()
+        self.dirty.add(SECTION_DATA)
+
+    # serialization
+
+    def _set_section(self, section_id, payload):
+        for section in self.sections:
+            if section[0] == section_id:
+                section[1] = payload
+                return
+        order = SECTION_ORDER.index(section_id)
+        pos = 0
+        for i, (other_id, _) in enumerate(self.sections):
+            if other_id != SECTION_CUSTOM and SECTION_ORDER.index(other_id) < order:
+                pos = i + 1
+        self.sections.insert(pos, [section_id, payload])
+
+    def _encode_section(self, section_id) -> bytes:
+        if section_id == SECTION_TYPE:
+            return encode_vector(self.types)
+        if section_id == SECTION_IMPORT:
+            return encode_vector(
+                encode_name(module) + encode_name(name) + bytes([kind]) + desc
+                for module, name, kind, desc in self.imports
+            )
+        if section_id == SECTION_FUNCTION:
+            return encode_vector(encode_uleb128(t) for t in self.functions)
+        if section_id == SECTION_CODE:
+            return encode_vector(
+                encode_uleb128(len(body)) + body for body in self.bodies
+            )
+        if section_id == SECTION_EXPORT:
+            return encode_vector(
+                encode_name(name) + bytes([kind]) + encode_uleb128(index)
+                for name, kind, index in self.exports
+            )
+        if section_id == SECTION_DATA:
+            return encode_vector(
+                encode_uleb128(flags)
+                + (encode_uleb128(memory_index) if flags == 2 else b"")
+                + (offset_expr or b"")
+                + encode_uleb128(len(data))
+                + data
+                for flags, memory_index, offset_expr, data, _ in self.data_segments
+            )
+        raise ValueError(f"section {section_id} can't be encoded")
+
+    def _encode_name_section(self) -> bytes:
+        parts = [encode_name("name")]
+        data_names = {
+            i: segment[4]
+            for i, segment in enumerate(self._data_segments or [])
+            if segment[4] is not None
+        }
+        if self._data_segments is not None:
+            self.names[NAME_SUBSECTION_DATA] = data_names
+        for subsection_id, value in sorted(self.names.items()):
+            if subsection_id in (NAME_SUBSECTION_FUNCTION, NAME_SUBSECTION_DATA):
+                if not value:
+                    continue
+                payload = _encode_name_map(value)
+            elif subsection_id in (NAME_SUBSECTION_LOCAL, NAME_SUBSECTION_LABEL):
+                payload = _encode_indirect_name_map(value)
+            else:
+                payload = value
+            parts.append(
+                bytes([subsection_id]) + encode_uleb128(len(payload)) + payload
+            )
+        return b"".join(parts)
+
+    def to_bytes(self) -> bytes:
+        dirty = set(self.dirty)
+        if SECTION_DATA in dirty:
+            dirty.add("name")
+            if self.section(SECTION_DATA_COUNT) is not None:
+                self._set_section(
+                    SECTION_DATA_COUNT, encode_uleb128(len(self.data_segments))
+                )
+        for section_id in sorted(s for s in dirty if s != "name"):
+            self._set_section(section_id, self._encode_section(section_id))
+        if "name" in dirty and self.names:
+            payload = self._encode_name_section()
+            for section in self.sections:
+                if (
+                    section[0] == SECTION_CUSTOM
+                    and decode_name(section[1], 0)[0] == "name"
+                ):
+                    section[1] = payload
+                    break
+            else:
+                self.sections.append([SECTION_CUSTOM, payload])
+        if SECTION_CODE in dirty:
+            # DWARF and source maps refer to code offsets which are no longer valid
+            self.sections = [
+                section
+                for section in self.sections
+                if section[0] != SECTION_CUSTOM
+                or not decode_name(section[1], 0)[0].startswith(
+                    (".debug_", "sourceMappingURL")
+                )
+            ]
+        self.dirty.clear()
+        parts = [WASM_MAGIC]
+        for section_id, payload in self.sections:
+            parts.append(bytes([section_id]) + encode_uleb128(len(payload)) + payload)
+        return b"".join(parts)
+
+    def write(self, filename):
+        with open(filename, "wb") as f:
+            f.write(self.to_bytes())
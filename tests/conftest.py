@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import pytest
+import wasmtime
+
+from cpython_near_wasm_opt.core import get_binary_path
+
+# A module in the style of wasm-dis output: named types/funcs, escaped data strings, comments, trailing newline
+WASM_DIS_WAT = """(module
+ (type $0 (func (param i32) (result i32)))
+ (type $1 (func (param i32)))
+ (type $2 (func))
+ (type $3 (func (param i64 i64)))
+ (import "env" "log_utf8" (func $log_utf8 (type $3) (param i64 i64)))
+ (global $__stack_pointer (mut i32) (i32.const 65536))
+ (memory $0 2)
+ (data $.rodata (i32.const 1024) "a\\00b\\ff\\"quoted\\"\\\\back;slash (paren) \\n\\t")
+ (data $.data (i32.const 2048) "")
+ (table $0 2 2 funcref)
+ (elem $0 (i32.const 0) $square $optimized_out_function_panic_handler)
+ (export "memory" (memory $0))
+ (export "square" (func $square))
+ (export "run" (func $run))
+ (func $square (param $0 i32) (result i32)
+  ;; comment inside a function
+  (i32.mul
+   (local.get $0)
+   (local.get $0)
+  )
+ )
+ (func $unused (param $0 i32) (result i32)
+  (call $square
+   (i32.add
+    (local.get $0)
+    (i32.const -1)
+   )
+  )
+ )
+ (func $optimized_out_function_panic_handler (param $0 i32)
+  (unreachable)
+ )
+ (func $run
+  (drop
+   (call $unused
+    (call $square
+     (i32.const 3)
+    )
+   )
+  )
+ )
+ ;; custom section "producers", size 28
+)
+"""
+
+
+@pytest.fixture
+def wasm_dis_wat():
+    return WASM_DIS_WAT
+
+
+@pytest.fixture
+def wasm_dis_output_path():
+    "Output of wasm-dis (binaryen 123) for WASM_DIS_WAT, plus a custom section, as written, with its trailing newline"
+    return Path(__file__).parent / "data" / "wasm_dis.wat"
+
+
+@pytest.fixture
+def wasm_bytes():
+    return wasmtime.wat2wasm(WASM_DIS_WAT)
+
+
+@pytest.fixture
+def wasm_dis():
+    try:
+        return get_binary_path("wasm-dis")
+    except FileNotFoundError:
+        pytest.skip("wasm-dis binary not available")
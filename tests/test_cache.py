@@ -0,0 +1,217 @@
+from collections import OrderedDict
+
+import pytest
+import wasmtime
+
+from cpython_near_wasm_opt import core
+from cpython_near_wasm_opt.core import (
+    compile_to_bytecode_cached,
+    hash_inputs,
+    load_cached,
+    load_wasmtime_module,
+    optimize_stage_key,
+    trace_stage_key,
+    verify_stage_key,
+)
+
+TEST_RUNS = [("get", b""), ("set", b'{"value": 1}')]
+TRACE_INPUTS = {
+    "wasm_hash": "0" * 64,
+    "pipeline": "binary",
+    "binaryen_version": None,
+    "wasm_data": b"frozen modules",
+    "contract_module": "contract",
+    "test_runs": TEST_RUNS,
+    "fuel_limit": None,
+    "timeout": None,
+}
+OPTIMIZE_INPUTS = {
+    "trace_key": trace_stage_key(**TRACE_INPUTS),
+    "module_opt": True,
+    "function_opt": "aggressive",
+    "pinned_functions": ["a", "b"],
+    "compression": True,
+    "debug_info": True,
+    "wasm_opt_version": "wasm-opt version 116",
+}
+
+
+def test_hash_inputs():
+    assert hash_inputs(b"a", "b", [1, (2, None)]) == hash_inputs(
+        b"a", "b", [1, (2, None)]
+    )
+    # values are typed and length-prefixed, so differently split or typed inputs don't collide
+    assert hash_inputs("ab", "c") != hash_inputs("a", "bc")
+    assert hash_inputs(b"1") != hash_inputs("1") != hash_inputs(1)
+    assert hash_inputs([1, 2]) != hash_inputs([1], 2)
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("wasm_hash", "1" * 64),
+        ("pipeline", "text"),
+        ("binaryen_version", "version 116"),
+        ("wasm_data", b"other frozen modules"),
+        ("contract_module", "other_contract"),
+        ("test_runs", TEST_RUNS[:1]),
+        ("fuel_limit", 10**9),
+        ("timeout", 5.0),
+    ],
+)
+def test_trace_stage_invalidation(name, value):
+    changed = trace_stage_key(**{**TRACE_INPUTS, name: value})
+    assert changed != trace_stage_key(**TRACE_INPUTS)
+    # invalidating the trace stage invalidates the optimize stage built on it
+    assert optimize_stage_key(
+        **{**OPTIMIZE_INPUTS, "trace_key": changed}
+    ) != optimize_stage_key(**OPTIMIZE_INPUTS)
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("module_opt", False),
+        ("function_opt", "safe"),
+        ("pinned_functions", ["a", "b", "c"]),
+        ("pinned_functions", []),
+        ("compression", False),
+        ("debug_info", False),
+        ("wasm_opt_version", "wasm-opt version 117"),
+    ],
+)
+def test_optimize_stage_invalidation(name, value):
+    assert optimize_stage_key(**{**OPTIMIZE_INPUTS, name: value}) != optimize_stage_key(
+        **OPTIMIZE_INPUTS
+    )
+
+
+def test_stage_keys_ignore_pinned_function_order():
+    assert optimize_stage_key(
+        **{**OPTIMIZE_INPUTS, "pinned_functions": ["b", "a"]}
+    ) == optimize_stage_key(**OPTIMIZE_INPUTS)
+
+
+def test_verify_stage_invalidation():
+    key = verify_stage_key(b"wasm", TEST_RUNS, None, None)
+    assert key == verify_stage_key(b"wasm", list(TEST_RUNS), None, None)
+    assert key != verify_stage_key(b"other wasm", TEST_RUNS, None, None)
+    assert key != verify_stage_key(b"wasm", TEST_RUNS[1:], None, None)
+    assert key != verify_stage_key(b"wasm", TEST_RUNS, 10**9, None)
+    assert key != verify_stage_key(b"wasm", TEST_RUNS, None, 5.0)
+
+
+def test_load_cached(tmp_path, monkeypatch):
+    computed = []
+
+    def compute(value):
+        def compute_value():
+            computed.append(value)
+            return value
+
+        return compute_value
+
+    assert load_cached(tmp_path, "stage-a", compute(1)) == 1
+    assert load_cached(tmp_path, "stage-a", compute(2)) == 1
+    assert load_cached(tmp_path, "stage-b", compute(3)) == 3
+    assert load_cached(tmp_path, "stage-a", compute(4), refresh=True) == 4
+    assert load_cached(tmp_path, "stage-a", compute(5)) == 4
+    assert computed == [1, 3, 4]
+    # stored for other processes too, which don't share the in-process values
+    monkeypatch.setattr(core, "_loaded_values", OrderedDict())
+    assert load_cached(tmp_path, "stage-a", compute(6)) == 4
+    assert load_cached(tmp_path / "other", "stage-a", compute(7)) == 7
+    assert computed == [1, 3, 4, 7]
+
+
+def test_load_cached_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, "_loaded_values", OrderedDict())
+    monkeypatch.setattr(core, "MAX_LOADED_VALUES", 2)
+    load_cached(tmp_path, "stage-a", lambda: 1)
+    load_cached(tmp_path, "stage-b", lambda: 2)
+    load_cached(tmp_path, "stage-a", lambda: None)
+    load_cached(tmp_path, "stage-c", lambda: 3)
+    assert list(core._loaded_values) == [
+        tmp_path / "stage-a.pickle",
+        tmp_path / "stage-c.pickle",
+    ]
+    # evicted values are still loaded from the cache directory
+    assert load_cached(tmp_path, "stage-b", lambda: None) == 2
+
+
+def test_load_cached_unreadable_file(tmp_path):
+    (tmp_path / "stage.pickle").write_bytes(b"not a pickle")
+    assert load_cached(tmp_path, "stage", lambda: "recomputed") == "recomputed"
+    assert load_cached(tmp_path, "stage", lambda: "again") == "recomputed"
+
+
+def test_load_wasmtime_module(tmp_path, monkeypatch):
+    wasm_bytes = wasmtime.wat2wasm('(module (func (export "f")))')
+    monkeypatch.setattr(core, "_wasmtime_modules", OrderedDict())
+    load_wasmtime_module(wasm_bytes, tmp_path)
+    [cache_file] = tmp_path.glob("module-*.cwasm")
+    # other processes load the compiled module, unusable files are recompiled and replaced
+    for data in (cache_file.read_bytes(), b"not a module"):
+        cache_file.unlink()  # the loaded module maps the file, replace it rather than overwrite it
+        cache_file.write_bytes(data)
+        monkeypatch.setattr(core, "_wasmtime_modules", OrderedDict())
+        assert load_wasmtime_module(wasm_bytes, tmp_path).exports[0].name == "f"
+    assert cache_file.read_bytes() != b"not a module"
+
+
+def test_load_wasmtime_module_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(core, "_wasmtime_modules", OrderedDict())
+    monkeypatch.setattr(core, "MAX_WASMTIME_MODULES", 2)
+    wasm_a, wasm_b, wasm_c = [
+        wasmtime.wat2wasm(f'(module (func (export "{name}")))') for name in "abc"
+    ]
+    module_a = load_wasmtime_module(wasm_a)
+    load_wasmtime_module(wasm_b)
+    assert load_wasmtime_module(wasm_a) is module_a
+    load_wasmtime_module(wasm_c)
+    assert [module.exports[0].name for module in core._wasmtime_modules.values()] == [
+        "a",
+        "c",
+    ]
+
+
+def test_compile_to_bytecode_cached(tmp_path, monkeypatch):
+    compiled = []
+    monkeypatch.setattr(
+        core,
+        "compile_to_bytecode",
+        lambda compiler, wasm_data, source_code, filename: (
+            compiled.append(filename) or f"{filename}:{source_code}".encode()
+        ),
+    )
+    created = []
+
+    class Compiler:
+        def reset(self):
+            pass
+
+    def create_compiler(wasm_bytes, stdlib_zip, cache_dir=None):
+        created.append(Compiler())
+        return created[-1]
+
+    monkeypatch.setattr(core, "create_compiler", create_compiler)
+    monkeypatch.setattr(core, "_compilers", {})
+
+    def compile_sources(sources, compiler_hash="python.wasm", refresh=False):
+        return compile_to_bytecode_cached(
+            b"", "python_stdlib.zip", sources, tmp_path, compiler_hash, refresh
+        )
+
+    sources = [("a.py", "a = 1"), ("b.py", "b = 1")]
+    assert compile_sources(sources) == [b"a.py:a = 1", b"b.py:b = 1"]
+    assert compile_sources(sources) == [b"a.py:a = 1", b"b.py:b = 1"]
+    assert (compiled, len(created)) == (["a.py", "b.py"], 1)
+    # only the edited source is recompiled
+    assert compile_sources([("a.py", "a = 1"), ("b.py", "b = 2")])[1] == b"b.py:b = 2"
+    # with the warm compiler of the first call
+    assert (compiled, len(created)) == (["a.py", "b.py", "b.py"], 1)
+    # a new python.wasm or a refresh recompiles everything
+    compile_sources(sources, compiler_hash="other python.wasm")
+    compile_sources(sources, refresh=True)
+    assert compiled[3:] == ["a.py", "b.py"] * 2
+    assert len(created) == 2
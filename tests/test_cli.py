@@ -0,0 +1,79 @@
+import pytest
+
+from cpython_near_wasm_opt import cli
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    for name in ("optimize_wasm_file", "watch_wasm_file", "benchmark_wasm_files"):
+        monkeypatch.setattr(
+            cli,
+            name,
+            lambda *args, name=name, **kwargs: calls.append((name, args, kwargs)),
+        )
+    return calls
+
+
+@pytest.mark.parametrize(
+    "argv, contract_file",
+    [
+        ([], "contract.py"),
+        (["-O4", "my_contract.py"], "my_contract.py"),
+        (["optimize", "-O4", "my_contract.py"], "my_contract.py"),
+        # contract files named like a command
+        (["optimize", "bench"], "bench"),
+    ],
+)
+def test_optimize_is_the_default_command(calls, argv, contract_file):
+    cli.main(argv)
+    [(name, _, kwargs)] = calls
+    assert name == "optimize_wasm_file"
+    assert kwargs["contract_file"] == contract_file
+
+
+def test_watch(calls):
+    cli.main(["--watch", "--jobs", "2"])
+    [(name, _, kwargs)] = calls
+    assert name == "watch_wasm_file"
+    assert kwargs["jobs"] == 2
+
+
+def test_bench_command(calls):
+    cli.main(["bench", "a.wasm", "b.wasm", "-e", "get, set", "-n", "3"])
+    [(name, args, kwargs)] = calls
+    assert name == "benchmark_wasm_files"
+    assert args == (["a.wasm", "b.wasm"], ["get", "set"], {})
+    assert kwargs["repeat"] == 3
+
+
+def test_compile(tmp_path, monkeypatch):
+    (tmp_path / "lib" / "pkg").mkdir(parents=True)
+    (tmp_path / "lib" / "pkg" / "mod.py").write_text("a = 1")
+    (tmp_path / "contract.py").write_text("b = 2")
+    (tmp_path / "python.wasm").write_bytes(b"")
+    monkeypatch.setattr(cli, "create_compiler", lambda *args: None)
+    compiled = []
+
+    def compile_many(compiler, sources, isolate=True):
+        compiled.append((sources, isolate))
+        return [source_code.encode() for _, source_code in sources]
+
+    monkeypatch.setattr(cli, "compile_many", compile_many)
+    cli.main(
+        ["compile", str(tmp_path / "lib"), str(tmp_path / "contract.py")]
+        + ["-i", str(tmp_path / "python.wasm"), "-o", str(tmp_path / "out")]
+    )
+    assert compiled == [([("mod.py", "a = 1"), ("contract.py", "b = 2")], True)]
+    assert (tmp_path / "out" / "pkg" / "mod.pyc").read_bytes() == b"a = 1"
+    assert (tmp_path / "out" / "contract.pyc").read_bytes() == b"b = 2"
+
+
+def test_command_errors(calls, capsys):
+    with pytest.raises(SystemExit):
+        cli.main(["bench"])
+    assert " bench: error: " in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        cli.main(["compile"])
+    assert " compile: error: " in capsys.readouterr().err
+    assert calls == []
@@ -0,0 +1,195 @@
+import io
+import pickle
+import subprocess
+
+import pytest
+import wasmtime
+
+from cpython_near_wasm_opt.core import (
+    TRACE_GUARDS_EXPORT,
+    SexpTree,
+    WasmRunner,
+    WatIndex,
+    escape_data_str,
+    fnv1a_32,
+    instrument_wat,
+    parse_sexp,
+    read_sexp,
+    tokenize_sexp,
+    tokenize_sexp_bytes,
+    unescape_data_str,
+    write_sexp,
+    write_sexp_to_string,
+)
+
+
+def parse_text(text):
+    "The nested list parse of the original (pre-SexpTree) parser, comments dropped"
+    return parse_sexp(tokenize_sexp(text))
+
+
+def test_bytes_tokenizer_matches_legacy(wasm_dis_wat):
+    assert tokenize_sexp_bytes(wasm_dis_wat.encode("ascii")) == tokenize_sexp(
+        wasm_dis_wat
+    )
+
+
+@pytest.mark.parametrize(
+    "trailer", ["", "\n", "  \n\n", " ;; trailing comment\n", " ;; c", ";;\n;;\n"]
+)
+def test_trailing_whitespace_and_comments(tmp_path, trailer):
+    text = "(module (func $f (nop)))" + trailer
+    tokens = tokenize_sexp_bytes(text.encode("ascii"))
+    assert tokens == tokenize_sexp(text)
+    assert "" not in tokens
+    path = tmp_path / "module.wat"
+    path.write_text(text)
+    assert read_sexp(path) == read_sexp(path, legacy_tokenizer=True)
+
+
+def test_unclosed_strings():
+    for data in (b'(data "abc', b'(data "abc\\'):
+        with pytest.raises(ValueError):
+            tokenize_sexp_bytes(data)
+
+
+def test_checked_in_wasm_dis_output(wasm_dis_output_path):
+    data = wasm_dis_output_path.read_bytes()
+    assert data.endswith(b")\n\n")
+    text = data.decode("ascii")
+    assert tokenize_sexp_bytes(data) == tokenize_sexp(text)
+    expected = read_sexp(wasm_dis_output_path, legacy_tokenizer=True)
+    assert read_sexp(wasm_dis_output_path) == expected
+    assert write_sexp_to_string(SexpTree.parse(data)) == write_sexp_to_string(expected)
+    assert parse_text(write_sexp_to_string(WatIndex.parse(data))) == parse_text(text)
+
+
+def test_wasm_dis_output(tmp_path, wasm_bytes, wasm_dis):
+    wasm_path = tmp_path / "module.wasm"
+    wat_path = tmp_path / "module.wat"
+    wasm_path.write_bytes(wasm_bytes)
+    subprocess.run([wasm_dis, wasm_path, "-o", wat_path], check=True)
+    data = wat_path.read_bytes()
+    assert tokenize_sexp_bytes(data) == tokenize_sexp(data.decode("ascii"))
+
+
+@pytest.mark.parametrize("chunk_size", [16, 1 << 20])
+def test_sexp_tree_round_trip(wasm_dis_wat, chunk_size):
+    tree = SexpTree.parse(wasm_dis_wat.encode("ascii"), chunk_size)
+    expected = parse_text(wasm_dis_wat)
+    assert write_sexp_to_string(tree) == write_sexp_to_string(expected)
+    assert parse_text(write_sexp_to_string(tree)) == expected
+
+
+def test_sexp_tree_edits(wasm_dis_wat, tmp_path):
+    tree = SexpTree.parse(wasm_dis_wat.encode("ascii"))
+    edited = tree.copy()
+    edited.append(edited.root, ["export", '"unused"', ["func", "$unused"]])
+    expected = parse_text(wasm_dis_wat)
+    assert parse_text(write_sexp_to_string(tree)) == expected
+    expected.append(["export", '"unused"', ["func", "$unused"]])
+    path = tmp_path / "edited.wat"
+    write_sexp(edited, path, parts_per_chunk=7)
+    assert read_sexp(path) == expected
+    # text file objects (e.g. pipes) are written to, not closed
+    f = io.StringIO()
+    write_sexp(edited, f, parts_per_chunk=7)
+    assert f.getvalue() == path.read_text()
+
+
+def prepend_nop(wat: WatIndex, parse_first: bool):
+    for form in wat.forms:
+        if form.kind == "func":
+            if parse_first:
+                wat.tree(form)
+            wat.prepend_to_function(form, ["nop"])
+    return wat
+
+
+@pytest.mark.parametrize("parse_first", [False, True])
+def test_wat_index_round_trip(wasm_dis_wat, parse_first):
+    data = wasm_dis_wat.encode("ascii")
+    wat = WatIndex.parse(data)
+    assert parse_text(write_sexp_to_string(wat)) == parse_text(wasm_dis_wat)
+    # the same edits on verbatim forms (as insertions) and on parsed ones
+    edited = prepend_nop(wat.copy(), parse_first)
+    expected = parse_text(wasm_dis_wat)
+    for form in expected:
+        if isinstance(form, list) and form[0] == "func":
+            body_start = next(
+                i
+                for i, item in enumerate(form)
+                if i > 1
+                and not (
+                    isinstance(item, list) and item[0] in ("param", "result", "local")
+                )
+            )
+            form.insert(body_start, ["nop"])
+    assert parse_text(write_sexp_to_string(edited)) == expected
+    # the copy is independent of the original
+    assert parse_text(write_sexp_to_string(wat)) == parse_text(wasm_dis_wat)
+    # pickling (as done for worker processes) keeps both the verbatim and the edited forms
+    unpickled = pickle.loads(pickle.dumps(edited))
+    assert write_sexp_to_string(unpickled) == write_sexp_to_string(edited)
+
+
+def test_wat_index_parse_file_in_parallel(tmp_path, wasm_dis_wat):
+    # enough forms to split the file into several chunks per job
+    funcs = "".join(
+        f" (func $f{i} (result i32)\n  (i32.const {i})\n )\n" for i in range(64)
+    )
+    text = wasm_dis_wat.replace(" ;; custom section", funcs + " ;; custom section")
+    path = tmp_path / "module.wat"
+    path.write_text(text)
+    serial = WatIndex.parse(text.encode("ascii"))
+    parallel = WatIndex.parse_file(path, jobs=2)
+
+    def spans(wat):
+        return [(f.kind, f.name, f.start, f.stop) for f in wat.forms]
+
+    assert spans(parallel) == spans(serial)
+    assert parallel.header_stop == serial.header_stop
+    assert write_sexp_to_string(parallel) == write_sexp_to_string(serial)
+    assert parse_text(write_sexp_to_string(parallel)) == parse_text(text)
+
+
+def test_data_str_escapes(wasm_dis_wat, wasm_bytes):
+    all_bytes = bytes(range(256))
+    assert unescape_data_str(escape_data_str(all_bytes)) == all_bytes
+    # the string as wasm-dis escapes it unescapes to the bytes which end up in linear memory
+    wat = WatIndex.parse(wasm_dis_wat.encode("ascii"))
+    tree = wat.tree(next(f for f in wat.forms if f.name == "$.rodata"))
+    *_, data_str = tree.children()
+    data = unescape_data_str(tree.atom(data_str))
+    store = wasmtime.Store()
+    log_utf8 = wasmtime.Func(
+        store,
+        wasmtime.FuncType([wasmtime.ValType.i64()] * 2, []),
+        lambda length, ptr: None,
+    )
+    instance = wasmtime.Instance(
+        store, wasmtime.Module(store.engine, wasm_bytes), [log_utf8]
+    )
+    memory = instance.exports(store)["memory"]
+    assert memory.read(store, 1024, 1024 + len(data)) == data
+    assert unescape_data_str(escape_data_str(data)) == data
+
+
+def test_instrument_wat_first_hit_only(wasm_dis_wat):
+    wat = WatIndex.parse(wasm_dis_wat.encode("ascii"))
+    for first_hit_only in (True, False):
+        instrumented = instrument_wat(wat, first_hit_only)
+        wasm_runner = WasmRunner(wasmtime.wat2wasm(write_sexp_to_string(instrumented)))
+        for _ in range(2):
+            wasm_runner.export("run")()
+            wasm_runner.reset()
+        assert wasm_runner.called_functions == {
+            fnv1a_32(name) for name in ("run", "unused", "square")
+        }
+        # the guards are neither snapshotted nor restored, so they stay set across runs
+        exports = wasm_runner.instance.exports(wasm_runner.store)
+        if first_hit_only:
+            assert TRACE_GUARDS_EXPORT not in wasm_runner.global_names
+            assert exports[TRACE_GUARDS_EXPORT].value(wasm_runner.store) == 1
+        else:
+            assert TRACE_GUARDS_EXPORT not in exports
@@ -0,0 +1,257 @@
+import pytest
+import wasmtime
+
+from cpython_near_wasm_opt.core import (
+    COVERAGE_SECTION_NAME,
+    WasmDataStore,
+    fnv1a_32,
+    instrument_module,
+    read_coverage_section,
+    remove_module_functions,
+)
+from cpython_near_wasm_opt.wasm_module import (
+    WasmModule,
+    decode_sleb128,
+    decode_uleb128,
+    encode_sleb128,
+    encode_uleb128,
+)
+
+
+def validate(wasm_bytes):
+    wasmtime.Module.validate(wasmtime.Engine(), wasm_bytes)
+
+
+def instantiate(wasm_bytes, **host_funcs):
+    "Instantiates a module, with the function imports named in host_funcs (and no-op ones for the others)"
+    store = wasmtime.Store()
+    module = wasmtime.Module(store.engine, wasm_bytes)
+    imports = []
+    for imp in module.imports:
+        imports.append(
+            wasmtime.Func(store, imp.type, host_funcs.get(imp.name, lambda *args: None))
+        )
+    return store, wasmtime.Instance(store, module, imports)
+
+
+def custom_section_names(module: WasmModule):
+    return [
+        module.sections[i][1][1 : 1 + module.sections[i][1][0]].decode()
+        for i in range(len(module.sections))
+        if module.sections[i][0] == 0
+    ]
+
+
+@pytest.mark.parametrize(
+    "value", [0, 1, 63, 64, 127, 128, 255, 624485, 2**32 - 1, 2**63 - 1]
+)
+def test_leb128(value):
+    assert decode_uleb128(encode_uleb128(value), 0) == (
+        value,
+        len(encode_uleb128(value)),
+    )
+    for signed_value in (value, -value, -value - 1):
+        encoded = encode_sleb128(signed_value)
+        assert decode_sleb128(encoded, 0) == (signed_value, len(encoded))
+
+
+def test_round_trip(wasm_bytes):
+    module = WasmModule(wasm_bytes)
+    # decoding sections doesn't make them dirty
+    assert len(module.bodies) == len(module.functions) == 4
+    assert module.function_name(module.function_index("square")) == "square"
+    assert module.to_bytes() == wasm_bytes
+    assert module.copy().to_bytes() == wasm_bytes
+
+
+def test_unnamed_functions():
+    # no name section: wasm-dis numbers the functions among the imports and among the defined functions
+    wasm_bytes = wasmtime.wat2wasm(
+        '(module (import "env" "f" (func)) (func) (func (export "g") (call 0)))'
+    )
+    module = WasmModule(wasm_bytes)
+    names = [name for _, name in module.defined_functions()]
+    assert module.function_name(0) == "fimport$0"
+    assert names == ["0", "1"]
+    # instrumentation shifts the function indices, not the names
+    instrumented_module = instrument_module(module, 4096, 16)
+    assert [name for _, name in instrumented_module.defined_functions()] == names
+    assert read_coverage_section(instrumented_module)[1] == [fnv1a_32(n) for n in names]
+
+
+def test_instrumented_function_calls(wasm_bytes):
+    module = instrument_module(WasmModule(wasm_bytes))
+    instrumented_wasm_bytes = module.to_bytes()
+    validate(instrumented_wasm_bytes)
+    called = []
+    store, instance = instantiate(
+        instrumented_wasm_bytes,
+        trace_function_call=lambda name_hash: called.append(name_hash & 0xFFFFFFFF),
+    )
+    # calls through the shifted function indices still reach the same functions
+    assert instance.exports(store)["square"](store, 7) == 49
+    instance.exports(store)["run"](store)
+    assert called == [
+        fnv1a_32(name) for name in ["square", "run", "square", "unused", "square"]
+    ]
+
+
+def test_instrumented_coverage_bitmap(wasm_bytes):
+    module = instrument_module(WasmModule(wasm_bytes), 4096, 16)
+    instrumented_module = WasmModule(module.to_bytes())
+    validate(instrumented_module.to_bytes())
+    addr, hashes = read_coverage_section(instrumented_module)
+    assert addr == 4096
+    assert hashes == [
+        fnv1a_32(name)
+        for name in ["square", "unused", "optimized_out_function_panic_handler", "run"]
+    ]
+    store, instance = instantiate(instrumented_module.to_bytes())
+    instance.exports(store)["square"](store, 2)
+    memory = instance.exports(store)["memory"]
+    assert memory.read(store, addr, addr + 4) == b"\1\0\0\0"
+    with pytest.raises(ValueError):
+        instrument_module(WasmModule(module.to_bytes()), 4096, 2)
+    assert COVERAGE_SECTION_NAME in custom_section_names(instrumented_module)
+
+
+def test_removed_functions(wasm_bytes):
+    module = WasmModule(wasm_bytes)
+    wasm_data = WasmDataStore()
+    removed = remove_module_functions(module, lambda name: name == "unused", wasm_data)
+    assert removed == {"unused"}
+    removed_wasm_bytes = module.to_bytes()
+    validate(removed_wasm_bytes)
+    store, instance = instantiate(removed_wasm_bytes)
+    assert instance.exports(store)["square"](store, 3) == 9
+    # "run" calls the removed function, that call now goes to the panic handler, which traps in this module
+    with pytest.raises(wasmtime.Trap):
+        instance.exports(store)["run"](store)
+
+
+def test_code_edits_drop_debug_info(wasm_bytes):
+    module = WasmModule(wasm_bytes)
+    module.add_custom_section(".debug_info", b"\0")
+    module.add_custom_section("sourceMappingURL", b"\0")
+    module.add_custom_section("producers", b"\0")
+    assert custom_section_names(WasmModule(module.to_bytes()))[-3:] == [
+        ".debug_info",
+        "sourceMappingURL",
+        "producers",
+    ]
+    module.prepend_to_function(module.function_index("run"), b"\x01")  # nop
+    edited_module = WasmModule(module.to_bytes())
+    assert ".debug_info" not in custom_section_names(edited_module)
+    assert "sourceMappingURL" not in custom_section_names(edited_module)
+    assert "producers" in custom_section_names(edited_module)
+    validate(edited_module.to_bytes())
+
+
+def test_simd_is_rejected():
+    wasm_bytes = wasmtime.wat2wasm(
+        """(module
+         (func $lane (result i32)
+          (i32x4.extract_lane 0 (v128.const i32x4 1 2 3 4))))"""
+    )
+    with pytest.raises(ValueError, match="SIMD"):
+        instrument_module(WasmModule(wasm_bytes), 4096, 16)
+
+
+CALL_SITES_WAT = """(module
+ (type $i2i (func (param i32) (result i32)))
+ (import "env" "value" (func $value (result i32)))
+ (global $panicked_with (mut i32) (i32.const 0))
+ (table 2 funcref)
+ (elem (i32.const 0) $gone $kept)
+ (export "panicked_with" (global $panicked_with))
+ (export "gone" (func $gone))
+ (export "kept" (func $kept))
+ (export "direct" (func $direct))
+ (export "tail" (func $tail))
+ (export "indirect" (func $indirect))
+ (export "ref" (func $ref))
+ (func $optimized_out_function_panic_handler (param i32)
+  (global.set $panicked_with (local.get 0))
+ )
+ (func $gone (param i32) (result i32)
+  (i32.add (local.get 0) (call $value))
+ )
+ (func $kept (param i32) (result i32)
+  (i32.mul (local.get 0) (i32.const 2))
+ )
+ (func $direct (param i32) (result i32)
+  (if (result i32) (local.get 0)
+   (then (call $gone (call $kept (local.get 0))))
+   (else (call $kept (i32.const 5)))
+  )
+ )
+ (func $tail (param i32) (result i32)
+  (return_call $gone (local.get 0))
+ )
+ (func $indirect (param i32) (param i32) (result i32)
+  (call_indirect (type $i2i) (local.get 0) (local.get 1))
+ )
+ (func $ref (result funcref)
+  (ref.func $gone)
+ )
+)"""
+
+
+def test_removed_function_call_sites():
+    module = WasmModule(wasmtime.wat2wasm(CALL_SITES_WAT))
+    wasm_data = WasmDataStore()
+    assert remove_module_functions(module, lambda name: name == "gone", wasm_data) == {
+        "gone"
+    }
+    removed_wasm_bytes = module.to_bytes()
+    validate(removed_wasm_bytes)
+    store, instance = instantiate(removed_wasm_bytes, value=lambda: 1)
+    exports = instance.exports(store)
+    gone_name_address = wasm_data.allocate_string("gone")
+
+    # calls to kept functions are untouched
+    assert exports["direct"](store, 0) == 10
+    assert exports["panicked_with"].value(store) == 0
+    # direct and tail calls to the removed function report it to the panic handler, then trap
+    for name in ("direct", "tail"):
+        exports["panicked_with"].set_value(store, 0)
+        with pytest.raises(wasmtime.Trap):
+            exports[name](store, 1)
+        assert exports["panicked_with"].value(store) == gone_name_address
+    # table elements, exports and ref.func still refer to the same functions, the removed one traps when reached
+    exports["panicked_with"].set_value(store, 0)
+    assert exports["indirect"](store, 4, 1) == 8
+    with pytest.raises(wasmtime.Trap):
+        exports["indirect"](store, 4, 0)
+    assert exports["kept"](store, 4) == 8
+    with pytest.raises(wasmtime.Trap):
+        exports["gone"](store, 4)
+    assert exports["panicked_with"].value(store) == 0
+    assert isinstance(exports["ref"](store), wasmtime.Func)
+    assert (
+        WasmModule(removed_wasm_bytes).bodies[
+            module.function_index("gone") - module.num_func_imports
+        ]
+        == b"\0\0\x0b"
+    )
+
+
+def test_coverage_bitmap_reservation():
+    def data_store(size, coverage_bitmap=False):
+        wasm_data = WasmDataStore(coverage_bitmap)
+        wasm_data.add_frozen_module("big", bytes(size))
+        return wasm_data
+
+    # frozen module data may use the coverage bitmap area unless it's reserved for instrumentation
+    size = (
+        WasmDataStore.COVERAGE_BITMAP_ADDR
+        - WasmDataStore.BASE_ADDR
+        - WasmDataStore.STRINGS_OFFSET
+        + 1
+    )
+    assert len(data_store(size).to_bytes()) == WasmDataStore.STRINGS_OFFSET + size
+    with pytest.raises(AssertionError):
+        data_store(size, coverage_bitmap=True).to_bytes()
+    data_store(size - 1, coverage_bitmap=True).to_bytes()
+    with pytest.raises(AssertionError):
+        data_store(size + WasmDataStore.COVERAGE_BITMAP_SIZE).to_bytes()
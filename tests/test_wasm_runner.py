@@ -0,0 +1,257 @@
+import json
+
+import pytest
+import wasmtime
+
+from cpython_near_wasm_opt.core import (
+    WasmRunner,
+    benchmark_wasm_files,
+    instrument_module,
+    profile_wasm,
+    run_entry_point,
+    trace_wasm_parallel,
+    trace_wasm_runs,
+    write_call_count_profile,
+    write_fuel_report,
+)
+from cpython_near_wasm_opt.wasm_module import WasmModule
+
+# "bump" increments the (unexported) global and stores it at address 0, "grow" adds a memory page
+SNAPSHOT_WAT = """(module
+  (memory (export "memory") 1)
+  (global $counter (mut i32) (i32.const 5))
+  (func (export "bump") (result i32)
+    (global.set $counter (i32.add (global.get $counter) (i32.const 1)))
+    (i32.store (i32.const 0) (global.get $counter))
+    (global.get $counter))
+  (func (export "grow")
+    (drop (memory.grow (i32.const 1))))
+)"""
+
+# "spin" loops forever on inputs longer than one byte
+RUNNER_WAT = """(module
+  (import "env" "input" (func $input (param i64)))
+  (import "env" "register_len" (func $register_len (param i64) (result i64)))
+  (memory (export "memory") 1)
+  (func (export "spin")
+    (call $input (i64.const 0))
+    (if (i64.gt_u (call $register_len (i64.const 0)) (i64.const 1))
+      (then (loop $forever (br $forever)))))
+)"""
+
+# "write" stores key "k", "check" and "probe" trace whether keys "k" and "q" are in storage, "echo" traces the input
+# length (read back from register 0), "unset" traces the length of register 5, which nothing writes
+HOST_STATE_WAT = """(module
+  (import "env" "trace_function_call" (func $trace (param i32)))
+  (import "env" "input" (func $input (param i64)))
+  (import "env" "register_len" (func $register_len (param i64) (result i64)))
+  (import "env" "storage_write" (func $storage_write (param i64 i64 i64 i64 i64) (result i64)))
+  (import "env" "storage_has_key" (func $storage_has_key (param i64 i64) (result i64)))
+  (memory (export "memory") 1)
+  (data (i32.const 0) "kq")
+  (func (export "echo")
+    (call $input (i64.const 0))
+    (call $trace (i32.wrap_i64 (call $register_len (i64.const 0)))))
+  (func (export "write")
+    (drop (call $storage_write (i64.const 1) (i64.const 0) (i64.const 1) (i64.const 0) (i64.const 9))))
+  (func (export "check")
+    (call $trace (i32.add (i32.const 10) (i32.wrap_i64 (call $storage_has_key (i64.const 1) (i64.const 0))))))
+  (func (export "probe")
+    (call $trace (i32.add (i32.const 20) (i32.wrap_i64 (call $storage_has_key (i64.const 1) (i64.const 1))))))
+  (func (export "unset")
+    (call $trace (i32.add (i32.const 30) (i32.wrap_i64 (call $register_len (i64.const 5))))))
+)"""
+
+
+def run_all(wasm_runner, inputs):
+    for input_bytes in inputs:
+        run_entry_point(wasm_runner, "spin", input_bytes)
+
+
+def test_aborted_runs_are_flagged(tmp_path):
+    wasm_bytes = wasmtime.wat2wasm(RUNNER_WAT)
+    fuel_limited = WasmRunner(wasm_bytes, fuel_limit=10**5)
+    run_all(fuel_limited, [b"x", b"yy"])
+    timed = WasmRunner(wasm_bytes, consume_fuel=True, timeout=0.1)
+    run_all(timed, [b"x", b"yy"])
+
+    assert fuel_limited.aborted_runs == [("spin", b"yy", "fuel")]
+    assert timed.aborted_runs == [("spin", b"yy", "timeout")]
+    assert [usage[3] for usage in fuel_limited.fuel_usage] == [None, "fuel"]
+    assert [usage[3] for usage in timed.fuel_usage] == [None, "timeout"]
+
+    json_path = tmp_path / "fuel.json"
+    write_fuel_report(
+        {"before": fuel_limited.fuel_usage, "after": timed.fuel_usage}, json_path
+    )
+    report = json.loads(json_path.read_text())
+    completed_fuel = fuel_limited.fuel_usage[0][2]
+    assert report["methods"]["spin"] == {
+        "runs": 1,
+        "aborted": 1,
+        "before": completed_fuel,
+        "after": timed.fuel_usage[0][2],
+    }
+    assert "aborted" not in report["runs"][0]
+    assert report["runs"][1]["aborted"] == {"before": "fuel", "after": "timeout"}
+
+
+def test_reset_restores_memory_and_globals():
+    wasm_runner = WasmRunner(wasmtime.wat2wasm(SNAPSHOT_WAT))
+    for grow in (False, True):
+        assert wasm_runner.export("bump")() == 6
+        assert wasm_runner.export("bump")() == 7
+        if grow:
+            wasm_runner.export("grow")()
+        assert wasm_runner.memory_grown() == grow
+        wasm_runner.reset()
+        assert not wasm_runner.memory_grown()
+        assert wasm_runner.memory.data_len(wasm_runner.store) == 65536
+        assert wasm_runner.memory.read(wasm_runner.store, 0, 4) == bytes(4)
+        assert wasm_runner.export("bump")() == 6
+        wasm_runner.reset()
+
+
+def test_memory_accessors():
+    wasm_runner = WasmRunner(wasmtime.wat2wasm(SNAPSHOT_WAT))
+    wasm_runner.write(100, b"abc\0def")
+    assert wasm_runner.read(100, 7) == b"abc\0def"
+    assert wasm_runner.read_cstr(100) == b"abc"
+    assert wasm_runner.read_cstr(104, max_length=2) == b"de"
+    wasm_runner.write(65533, b"xyz")
+    assert wasm_runner.read_cstr(65533) == b"xyz"
+    with pytest.raises(IndexError):
+        wasm_runner.read(65534, 3)
+    with pytest.raises(IndexError):
+        wasm_runner.write(-1, b"x")
+
+
+def trace_serially(wasm_bytes, runs):
+    wasm_runner = WasmRunner(wasm_bytes)
+    trace_wasm_runs(wasm_runner, runs)
+    return wasm_runner
+
+
+def test_parallel_trace_with_independent_host_state():
+    wasm_bytes = wasmtime.wat2wasm(HOST_STATE_WAT)
+    # the second shard reads key "q" which nobody wrote and key "k" only after writing it itself
+    runs = [
+        ("probe", b""),
+        ("echo", b"abc"),
+        ("echo", b"x"),
+        ("write", b""),
+        ("check", b""),
+        ("probe", b""),
+    ]
+    serial = trace_serially(wasm_bytes, runs)
+    parallel = WasmRunner(wasm_bytes)
+    assert trace_wasm_parallel(parallel, runs, 2)
+    assert parallel.called_functions == serial.called_functions == {20, 3, 1, 11}
+    assert dict(parallel.storage) == dict(serial.storage) == {b"k": b"k"}
+    assert dict(parallel.registers) == dict(serial.registers)
+
+
+def test_parallel_trace_with_absent_keys_read_by_both_shards():
+    wasm_bytes = wasmtime.wat2wasm(HOST_STATE_WAT)
+    # reading an absent register doesn't store it, so the second shard's read doesn't depend on the first one
+    runs = [("unset", b""), ("unset", b"")]
+    parallel = WasmRunner(wasm_bytes)
+    assert trace_wasm_parallel(parallel, runs, 2)
+    assert (
+        parallel.called_functions
+        == trace_serially(wasm_bytes, runs).called_functions
+        == {30}
+    )
+    assert 5 not in dict(parallel.registers)
+
+
+def test_parallel_trace_falls_back_on_shared_host_state():
+    wasm_bytes = wasmtime.wat2wasm(HOST_STATE_WAT)
+    # the second shard reads key "k" written by the first one
+    runs = [("write", b""), ("check", b"")]
+    assert trace_serially(wasm_bytes, runs).called_functions == {11}
+    parallel = WasmRunner(wasm_bytes)
+    assert not trace_wasm_parallel(parallel, runs, 2)
+    assert parallel.called_functions == set()
+    # state held by the runner beforehand counts as written by an earlier shard
+    parallel.storage[b"k"] = b"k"
+    assert not trace_wasm_parallel(parallel, [("probe", b""), ("check", b"")], 2)
+
+
+def test_call_count_profile(wasm_bytes, tmp_path):
+    profiled_module = instrument_module(WasmModule(wasm_bytes))
+    wasm_runner = WasmRunner(profiled_module.to_bytes(), count_calls=True)
+    profile = profile_wasm(wasm_runner, ["run"], {"run": [b"", b"x"]})
+    # "run" calls square directly and through unused, the counts start over for every run
+    for _, _, call_counts in profile:
+        assert sorted(call_counts.values()) == [1, 1, 2]
+    write_call_count_profile(
+        profile,
+        ["run", "unused", "square"],
+        tmp_path / "profile.json",
+        tmp_path / "profile.csv",
+    )
+    with open(tmp_path / "profile.json") as f:
+        profile_json = json.load(f)
+    assert profile_json["total"][0] == {"function": "square", "calls": 4}
+    assert [run["input"] for run in profile_json["runs"]] == ["", "x"]
+    assert (tmp_path / "profile.csv").read_text().splitlines()[1] == "*,,square,4"
+
+
+def test_fuel_usage(tmp_path):
+    wasm_bytes = wasmtime.wat2wasm(HOST_STATE_WAT)
+    runs = [("echo", b"abc"), ("write", b""), ("echo", b"x"), ("probe", b"")]
+    serial = WasmRunner(wasm_bytes, consume_fuel=True)
+    trace_wasm_runs(serial, runs)
+    assert [run[:2] for run in serial.fuel_usage] == runs
+    assert all(fuel > 0 for _, _, fuel, _ in serial.fuel_usage)
+    # the shards' fuel usage is merged in run order
+    parallel = WasmRunner(wasm_bytes, consume_fuel=True)
+    assert trace_wasm_parallel(parallel, runs, 2)
+    assert parallel.fuel_usage == serial.fuel_usage
+    write_fuel_report(
+        {"serial": serial.fuel_usage, "parallel": parallel.fuel_usage},
+        tmp_path / "fuel.json",
+    )
+    with open(tmp_path / "fuel.json") as f:
+        methods = json.load(f)["methods"]
+    assert methods["echo"]["runs"] == 2
+    assert methods["echo"]["serial"] == methods["echo"]["parallel"] > 0
+
+
+def test_benchmark_repeats_start_from_the_same_host_state(tmp_path):
+    # "append" stores its input after what the earlier runs stored, "length" returns the stored length
+    wasm_path = tmp_path / "state.wasm"
+    wasm_path.write_bytes(
+        wasmtime.wat2wasm(
+            """(module
+  (import "env" "input" (func $input (param i64)))
+  (import "env" "read_register" (func $read_register (param i64 i64)))
+  (import "env" "register_len" (func $register_len (param i64) (result i64)))
+  (import "env" "storage_read" (func $storage_read (param i64 i64 i64) (result i64)))
+  (import "env" "storage_write" (func $storage_write (param i64 i64 i64 i64 i64) (result i64)))
+  (import "env" "value_return" (func $value_return (param i64 i64)))
+  (memory (export "memory") 1)
+  (data (i32.const 0) "k")
+  (func (export "append") (local $len i64) (local $input_len i64)
+    (if (i64.ne (call $storage_read (i64.const 1) (i64.const 0) (i64.const 1)) (i64.const 0))
+      (then
+        (local.set $len (call $register_len (i64.const 1)))
+        (call $read_register (i64.const 1) (i64.const 16))))
+    (call $input (i64.const 2))
+    (local.set $input_len (call $register_len (i64.const 2)))
+    (call $read_register (i64.const 2) (i64.add (i64.const 16) (local.get $len)))
+    (drop (call $storage_write
+      (i64.const 1) (i64.const 0) (i64.add (local.get $len) (local.get $input_len)) (i64.const 16) (i64.const 9))))
+  (func (export "length")
+    (drop (call $storage_read (i64.const 1) (i64.const 0) (i64.const 1)))
+    (call $value_return (call $register_len (i64.const 1)) (i64.const 0)))
+)"""
+        )
+    )
+    results = benchmark_wasm_files(
+        [wasm_path], ["append", "length"], {"append": [b"ab", b"c"]}, repeat=3
+    )
+    append_ab, append_c, length = (run["results"][0] for run in results["runs"])
+    assert not append_ab["fuel_varies"] and not append_c["fuel_varies"]
+    assert length["output_size"] == 3